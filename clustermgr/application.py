@@ -4,7 +4,11 @@ import re
 
 from flask import Flask
 
-from clustermgr.extensions import db, csrf, migrate, wlogger
+from clustermgr.extensions import db, csrf, migrate, wlogger, rcpool, \
+    ldappool, mmrsnapshots
+from clustermgr.core.remote import task_deadline
+from clustermgr.core.history import task_history
+from clustermgr.core.hosts import hostindex
 
 
 def init_celery(app, celery):
@@ -13,10 +17,27 @@ def init_celery(app, celery):
 
     class ContextTask(TaskBase):
         abstract = True
+        # seconds all the remote commands of a task must finish in, set per
+        # task with @celery.task(command_deadline=...)
+        command_deadline = None
 
         def __call__(self, *args, **kwargs):
-            with app.app_context():
-                return TaskBase.__call__(self, *args, **kwargs)
+            deadline = self.command_deadline or \
+                app.config.get('TASK_COMMAND_DEADLINE')
+            with app.app_context(), task_deadline(deadline), \
+                    wlogger.buffered():
+                if not app.config.get('TASK_HISTORY'):
+                    return TaskBase.__call__(self, *args, **kwargs)
+                # keeps how long every remote step took once the log is gone
+                with task_history(self.request.id, self.name,
+                                  app.config.get('TASK_HISTORY_BATCH', 50)):
+                    return TaskBase.__call__(self, *args, **kwargs)
+
+        def after_return(self, status, retval, task_id, args, kwargs, einfo):
+            # wakes up the clients streaming the log of the task
+            wlogger.finish(task_id, status)
+            TaskBase.after_return(self, status, retval, task_id, args, kwargs,
+                                  einfo)
     celery.Task = ContextTask
 
 
@@ -44,6 +65,10 @@ def create_app():
     migrate.init_app(app, db, directory=os.path.join(os.path.dirname(__file__),
                                                      "migrations"))
     wlogger.init_app(app)
+    rcpool.init_app(app)
+    ldappool.init_app(app)
+    mmrsnapshots.init_app(app)
+    hostindex.init_app(app)
 
     # setup the instance's working directories
     if not os.path.isdir(app.config['SCHEMA_DIR']):
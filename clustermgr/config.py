@@ -11,10 +11,36 @@ class Config(object):
     BASE_DN = 'o=gluu'
     CELERY_BROKER_URL = 'redis://localhost:6379'
     CELERY_RESULT_BACKEND = 'redis://localhost:6379'
+    # tells the running tasks apart from the queued ones, refer cancel_task
+    CELERY_TRACK_STARTED = True
     REDIS_HOST = 'localhost'
     REDIS_PORT = 6379
     REDIS_LOG_DB = 0
+    WEBLOGGER_BUFFER_SIZE = 100
+    WEBLOGGER_BUFFER_AGE = 0.5
+    WEBLOGGER_TTL = 86400
+    WEBLOGGER_MAX_ITEMS = 10000
+    WEBLOGGER_MAX_ITEM_SIZE = 65536
+    WEBLOGGER_SPILL_SIZE = 8192
+    WEBLOGGER_PREVIEW_SIZE = 1024
+    WEBLOGGER_MAX_OUTPUT_SIZE = 16777216
     OX11_PORT = '8190'
+    SSH_POOL_TTL = 300
+    SSH_COMMAND_TIMEOUT = 3600
+    SSH_WATCHDOG_INTERVAL = 60
+    SSH_WATCHDOG_GRACE = 30
+    LDAP_POOL_TTL = 300
+    LDAP_POOL_SIZE = 4
+    LDAP_POOL_CHECK_INTERVAL = 30
+    TASK_COMMAND_DEADLINE = None
+    TASK_HISTORY = True
+    TASK_HISTORY_BATCH = 50
+    FANOUT_WORKERS = 10
+    FANOUT_TIMEOUT = 3600
+    MMR_STATUS_TIMEOUT = 5
+    MMR_STATUS_MAX_AGE = 300
+    MMR_STATUS_REFRESH = 60.0
+    HOST_INDEX_TTL = 60
     SCHEDULE_REFRESH = 30.0
     CELERYBEAT_SCHEDULE = {
         'add-every-30-seconds': {
@@ -22,6 +48,16 @@ class Config(object):
             'schedule': timedelta(seconds=SCHEDULE_REFRESH),
             'args': (),
         },
+        'sweep-task-logs': {
+            'task': 'clustermgr.tasks.all.sweep_task_logs',
+            'schedule': timedelta(hours=1),
+            'args': (),
+        },
+        'snapshot-replication-status': {
+            'task': 'clustermgr.tasks.cluster.snapshot_replication_status',
+            'schedule': timedelta(seconds=MMR_STATUS_REFRESH),
+            'args': (),
+        },
     }
     DATA_DIR = os.environ.get(
         "DATA_DIR",
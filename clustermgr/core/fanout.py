@@ -0,0 +1,203 @@
+"""fanout.py - run an operation on many servers of the cluster concurrently.
+"""
+import logging
+import threading
+import time
+
+from flask import current_app, has_app_context
+
+from clustermgr.core.remote import recording_steps, step_recorder
+
+
+class HostResult(object):
+    """Outcome of running the operation on a single server.
+
+    Attributes:
+        item: the server (or any other object) the operation was run for
+        value: the return value of the operation
+        error (Exception): exception raised by the operation, if any
+        timed_out (bool): whether the operation ran past the per-host timeout
+        duration (float): seconds taken by the operation
+    """
+
+    def __init__(self, item):
+        self.item = item
+        self.value = None
+        self.error = None
+        self.timed_out = False
+        self.duration = None
+        self.done = False
+        self.started = None
+
+    @property
+    def ok(self):
+        return self.done and not self.error and not self.timed_out
+
+    def __repr__(self):
+        if self.timed_out:
+            state = 'timed out'
+        elif self.error:
+            state = 'error: {0}'.format(self.error)
+        else:
+            state = 'ok'
+        return "<HostResult {0!r} {1}>".format(self.item, state)
+
+
+class FanOutResult(object):
+    """Aggregate of the :class:`HostResult` of every server, in the same order
+    as the servers were given to :meth:`FanOut.run`.
+    """
+
+    def __init__(self, results):
+        self.results = results
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    @property
+    def succeeded(self):
+        return [r for r in self.results if r.ok]
+
+    @property
+    def failed(self):
+        return [r for r in self.results if r.error]
+
+    @property
+    def timed_out(self):
+        return [r for r in self.results if r.timed_out]
+
+    @property
+    def all_ok(self):
+        return all(r.ok for r in self.results)
+
+    def values(self):
+        """Returns the return values of the operations which succeeded."""
+        return [r.value for r in self.results if r.ok]
+
+
+class FanOut(object):
+    """Runs a callable for each server in a list of servers using a bounded
+    number of threads, so the whole run takes roughly the time of the slowest
+    server instead of the sum of all of them.
+
+    The Flask application context of the caller, if any, is pushed in every
+    worker thread, and so is the recorder of the remote steps. The database
+    session however is thread local, so the callable should only read the
+    attributes already loaded in the objects passed to it, and changes should
+    be committed by the caller once `run()` returns.
+
+    Args:
+        max_workers (int, optional): max number of servers handled at once
+        timeout (int, optional): seconds after which a server is given up and
+            marked as timed out. Python threads cannot be killed, so the
+            operation keeps running in the background but its result is
+            discarded.
+        tid (string, optional): id of the task to log failures to
+        logger (:class:`clustermgr.weblogger.WebLogger`, optional): logger
+            used to report failures and timeouts against the `server_id`
+    """
+
+    def __init__(self, max_workers=10, timeout=None, tid=None, logger=None):
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.tid = tid
+        self.logger = logger
+        self._cond = threading.Condition()
+
+    def run(self, func, items):
+        """Calls `func(item)` for every item.
+
+        Args:
+            func (callable): the operation to be run for every server
+            items (list): the servers to run the operation for
+
+        Returns:
+            :class:`FanOutResult` of the run
+        """
+        results = [HostResult(item) for item in items]
+        pending = list(results)
+        running = []
+        app = current_app._get_current_object() if has_app_context() else None
+        recorder = step_recorder()
+
+        with self._cond:
+            while pending or running:
+                while pending and len(running) < self.max_workers:
+                    result = pending.pop(0)
+                    result.started = time.time()
+                    running.append(result)
+                    t = threading.Thread(target=self._work,
+                                         args=(func, result, app, recorder))
+                    t.daemon = True
+                    t.start()
+
+                self._cond.wait(self._wait_time(running))
+
+                now = time.time()
+                for result in list(running):
+                    if result.done:
+                        running.remove(result)
+                        if result.error:
+                            self._log(result.item, "Operation failed. Error: "
+                                      "{0}".format(result.error), "error")
+                    elif self.timeout and \
+                            now - result.started >= self.timeout:
+                        result.timed_out = True
+                        result.duration = now - result.started
+                        running.remove(result)
+                        self._log(result.item, "Operation timed out after {0} "
+                                  "seconds".format(self.timeout), "error")
+
+        return FanOutResult(results)
+
+    def _wait_time(self, running):
+        if not self.timeout:
+            return None
+        deadline = min(r.started for r in running) + self.timeout
+        return max(0, deadline - time.time())
+
+    def _work(self, func, result, app, recorder=None):
+        value, error = None, None
+        try:
+            with recording_steps(recorder):
+                if app is not None:
+                    with app.app_context():
+                        value = func(result.item)
+                else:
+                    value = func(result.item)
+        except Exception as e:
+            logging.exception("Fan-out operation failed for %r", result.item)
+            error = e
+
+        with self._cond:
+            if result.timed_out:
+                return
+            result.value = value
+            result.error = error
+            result.duration = time.time() - result.started
+            result.done = True
+            self._cond.notify()
+
+    def _log(self, item, message, level):
+        if not (self.logger and self.tid):
+            return
+        hostname = getattr(item, 'hostname', None)
+        if hostname:
+            message = "{0}: {1}".format(hostname, message)
+        self.logger.log(self.tid, message, level,
+                        server_id=getattr(item, 'id', None))
+
+
+def fan_out(func, items, **kwargs):
+    """Shorthand for `FanOut(**kwargs).run(func, items)`. The number of
+    workers and the timeout default to the FANOUT_WORKERS and FANOUT_TIMEOUT
+    values of the application config.
+    """
+    if has_app_context():
+        kwargs.setdefault('max_workers',
+                          current_app.config.get('FANOUT_WORKERS', 10))
+        kwargs.setdefault('timeout', current_app.config.get('FANOUT_TIMEOUT'))
+    return FanOut(**kwargs).run(func, items)
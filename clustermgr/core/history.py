@@ -0,0 +1,277 @@
+"""history.py - durable record of the task runs and of their remote steps.
+"""
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+
+import redis
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from clustermgr.extensions import db, wlogger
+from clustermgr.models import TaskRun, TaskStep
+from clustermgr.core.remote import recording_steps, record_step
+
+
+class TaskHistory(object):
+    """Recorder of the remote steps done by a run of a task, to be passed to
+    :func:`clustermgr.core.remote.recording_steps`.
+
+    The steps are kept in memory and written in batches of `batch_size` rows
+    with a single statement. The writes go through connections of their own,
+    so the database session of the task is never committed by them, and
+    they only happen in the thread of the task; the steps recorded by the
+    fan-out threads wait for it. The run itself is only stored once it has
+    a step, so the tasks which do nothing remote leave no trace.
+
+    Args:
+        task_id (string): id of the celery task
+        name (string): name of the celery task
+        batch_size (int, optional): number of steps written at a time
+    """
+
+    def __init__(self, task_id, name, batch_size=50):
+        self.task_id = task_id
+        self.name = name
+        self.batch_size = batch_size
+        self.started = time.time()
+        self.run_id = None
+        self._steps = []
+        self._lock = threading.Lock()
+        self._owner = threading.current_thread()
+
+    def __call__(self, step):
+        with self._lock:
+            self._steps.append(dict(
+                host=step['host'],
+                kind=step['kind'],
+                command=step['command'][:2000],
+                started_at=datetime.utcfromtimestamp(step['started']),
+                ended_at=datetime.utcfromtimestamp(step['ended']),
+                duration=step['ended'] - step['started'],
+                exit_status=step['exit_status'],
+                bytes_sent=step['sent'],
+                bytes_received=step['received'],
+                os=step.get('os'),
+            ))
+            full = len(self._steps) >= self.batch_size
+        if full and threading.current_thread() is self._owner:
+            self.flush()
+
+    def flush(self):
+        """Writes the steps recorded since the last write."""
+        with self._lock:
+            steps, self._steps = self._steps, []
+        if not steps:
+            return
+
+        if self.run_id is None:
+            result = self._write(TaskRun.__table__.insert(), dict(
+                task_id=self.task_id, name=self.name,
+                started_at=datetime.utcfromtimestamp(self.started)))
+            if result is None:
+                return
+            self.run_id = result.inserted_primary_key[0]
+
+        for step in steps:
+            step['task_run_id'] = self.run_id
+        self._write(TaskStep.__table__.insert(), steps)
+
+    def finish(self, state):
+        """Writes the remaining steps and the end of the run.
+
+        Args:
+            state (string): the final celery state of the task
+        """
+        self.flush()
+        if self.run_id is None:
+            return
+        table = TaskRun.__table__
+        self._write(table.update().where(table.c.id == self.run_id),
+                    dict(state=state, ended_at=datetime.utcnow()))
+
+    def _write(self, statement, params):
+        # the history is not worth failing the task for
+        try:
+            with db.engine.begin() as conn:
+                return conn.execute(statement, params)
+        except SQLAlchemyError:
+            logging.exception("Could not write the history of the task %s",
+                              self.task_id)
+
+
+@contextmanager
+def task_history(task_id, name, batch_size=50):
+    """Records the remote steps done inside the block as a run of the task.
+
+    Args:
+        task_id (string): id of the celery task
+        name (string): name of the celery task
+        batch_size (int, optional): number of steps written at a time
+    """
+    history = TaskHistory(task_id, name, batch_size)
+    state = 'FAILURE'
+    try:
+        with recording_steps(history):
+            yield history
+        state = 'SUCCESS'
+    finally:
+        history.finish(state)
+
+
+def slowest_steps(limit=50, name=None):
+    """Returns the slowest steps across all the recorded runs. The phases
+    recorded by :class:`TaskProgress` span many steps, so they are left out.
+
+    Args:
+        limit (int, optional): number of steps to return
+        name (string, optional): only return the steps of the runs of the
+            task with this name
+
+    Returns:
+        list of :class:`clustermgr.models.TaskStep` with their run loaded
+    """
+    query = TaskStep.query.join(TaskRun).options(db.contains_eager(
+        TaskStep.run)).filter(TaskStep.kind != 'phase')
+    if name:
+        query = query.filter(TaskRun.name == name)
+    return query.order_by(TaskStep.duration.desc()).limit(limit).all()
+
+
+def phase_estimates(name):
+    """Returns the average duration of the phases of the past runs of a task,
+    refer :class:`TaskProgress`.
+
+    Args:
+        name (string): name of the celery task
+
+    Returns:
+        dict of the seconds keyed by the label and the os of the phase, and
+        by the label and None for the average across all the os
+    """
+    step = TaskStep.__table__
+    run = TaskRun.__table__
+    query = select([step.c.command, step.c.os, func.avg(step.c.duration),
+                    func.count(step.c.id)]).select_from(
+        step.join(run, step.c.task_run_id == run.c.id)).where(
+        (run.c.name == name) & (step.c.kind == 'phase')).group_by(
+        step.c.command, step.c.os)
+    try:
+        with db.engine.connect() as conn:
+            rows = conn.execute(query).fetchall()
+    except SQLAlchemyError:
+        logging.exception("Could not read the phases of the task %s", name)
+        return {}
+
+    estimates = {}
+    totals = {}
+    for label, os_type, average, count in rows:
+        average = float(average)
+        estimates[(label, os_type)] = average
+        seconds, runs = totals.get(label, (0, 0))
+        totals[label] = (seconds + average * count, runs + count)
+    for label, (seconds, runs) in totals.iteritems():
+        estimates[(label, None)] = seconds / runs
+    return estimates
+
+
+class TaskProgress(object):
+    """Tells how far a task is through its phases and how long it still
+    needs, estimated from how long the same phases took in the past runs of
+    the task on servers with the same os.
+
+    Calling step() at the start of every phase publishes the estimate with
+    :meth:`clustermgr.weblogger.WebLogger.set_eta` as a dict with the
+    number of the `step`, the number of `steps`, the `label` of the phase,
+    the `percent` done and the seconds `remaining`, less the time already
+    spent in the current phase. The percent counts the phases done when some
+    phase was never timed before, and the remaining time is None then. Every
+    phase done is recorded as a step of kind `phase` in the history of the
+    task, for the next runs to be estimated by it.
+
+    Args:
+        task_id (string): id of the celery task
+        name (string): name of the celery task
+        phases (list): the labels of the phases, in the order they are done
+        os_type (string, optional): os of the server the phases are done in
+        host (string, optional): hostname of the server
+    """
+
+    def __init__(self, task_id, name, phases, os_type=None, host=None):
+        self.task_id = task_id
+        self.name = name
+        self.phases = list(phases)
+        self.os_type = os_type
+        self.host = host
+        self.current = None
+        self.started = None
+        self._where = (host, os_type)
+        self.estimates = phase_estimates(name)
+
+    def estimate(self, label):
+        """Returns the seconds the phase is expected to take, or None."""
+        seconds = self.estimates.get((label, self.os_type))
+        if seconds is None:
+            seconds = self.estimates.get((label, None))
+        return seconds
+
+    def step(self, label):
+        """Ends the current phase and starts the phase with the label. Phases
+        can be skipped but not gone back to. The phase is done in the server
+        set as `host` and `os_type` at its start.
+
+        Args:
+            label (string): one of the phases of the task
+        """
+        now = time.time()
+        self._record(now)
+        self.current = self.phases.index(label)
+        self.started = now
+        self._where = (self.host, self.os_type)
+        self._publish()
+
+    def done(self):
+        """Ends the last phase and publishes the task as complete."""
+        self._record(time.time())
+        self.current = len(self.phases)
+        self._publish()
+
+    def eta(self):
+        """Returns the estimate of the task as published by step()."""
+        total = len(self.phases)
+        current = self.current or 0
+        if current >= total:
+            return {'step': total, 'steps': total, 'label': None,
+                    'percent': 100, 'remaining': 0}
+
+        estimates = [self.estimate(label) for label in self.phases]
+        if None in estimates or not sum(estimates):
+            percent = 100.0 * current / total
+            remaining = None
+        else:
+            percent = 100.0 * sum(estimates[:current]) / sum(estimates)
+            elapsed = time.time() - self.started if self.started else 0
+            remaining = int(round(max(estimates[current] - elapsed, 0) +
+                                  sum(estimates[current + 1:])))
+        return {'step': current + 1, 'steps': total,
+                'label': self.phases[current], 'percent': int(percent),
+                'remaining': remaining}
+
+    def _record(self, now):
+        if self.current is None or self.current >= len(self.phases):
+            return
+        host, os_type = self._where
+        record_step(host, 'phase', self.phases[self.current], self.started,
+                    now, os_type=os_type)
+
+    def _publish(self):
+        # the estimate is not worth failing the task for
+        try:
+            wlogger.set_eta(self.task_id, self.eta())
+        except redis.RedisError:
+            logging.exception("Could not publish the progress of the task %s",
+                              self.task_id)
@@ -0,0 +1,101 @@
+"""hosts.py - in memory index of the hostnames and ip addresses of the servers.
+"""
+import threading
+import time
+
+from sqlalchemy import event
+
+from clustermgr.extensions import db
+from clustermgr.models import Server
+
+
+class HostIndex(object):
+    """Index of the hostname and the ip address of every server, both ways.
+
+    The replication status parses the syncrepl providers of every server, and
+    the providers may be given by ip address. Rather than querying the server
+    table for every one of them, the lookups are answered from this index,
+    which is built with a single query. It is dropped whenever a server is
+    added, changed or removed by this process, and rebuilt after `ttl`
+    seconds in any case, for the changes made by the other processes (the
+    web application and the celery workers) to be seen.
+
+    Configuration:
+        HOST_INDEX_TTL - seconds the index is used before it is rebuilt.
+        Defaults to 60.
+
+    Initialization::
+
+        hostindex = HostIndex()
+        hostindex.init_app(app)
+
+        hostindex.hostname('10.0.0.2')
+    """
+
+    def __init__(self, app=None, ttl=60):
+        self.ttl = ttl
+        self._index = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('HOST_INDEX_TTL', self.ttl)
+
+    def invalidate(self):
+        """Drops the index, for the next lookup to build it again."""
+        with self._lock:
+            self._generation += 1
+            self._index = None
+
+    def hostname(self, ip):
+        """Returns the hostname of the server with the ip address, None when
+        there is no such server."""
+        return self._load()[1].get(ip)
+
+    def ip(self, hostname):
+        """Returns the ip address of the server with the hostname, None when
+        there is no such server."""
+        return self._load()[0].get(hostname)
+
+    def address(self, hostname, use_ip=False):
+        """Returns the address the other servers reach the server at, which
+        is its ip address when the cluster is configured to use ip addresses
+        in place of hostnames, refer AppConfiguration.use_ip.
+
+        Args:
+            hostname (string): hostname of the server
+            use_ip (boolean, optional): whether to return the ip address
+        """
+        if use_ip:
+            return self.ip(hostname) or hostname
+        return hostname
+
+    def _load(self):
+        index = self._index
+        if index is not None and time.time() - index[2] <= self.ttl:
+            return index
+
+        with self._lock:
+            generation = self._generation
+        rows = db.session.query(Server.hostname, Server.ip).all()
+        index = (dict((h, ip) for h, ip in rows),
+                 dict((ip, h) for h, ip in rows if ip),
+                 time.time())
+        with self._lock:
+            # a server changed while it was read, the next lookup reads again
+            if generation == self._generation:
+                self._index = index
+        return index
+
+
+hostindex = HostIndex()
+
+
+def _server_changed(mapper, connection, target):
+    hostindex.invalidate()
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Server, _event, _server_changed)
@@ -3,10 +3,12 @@ import time
 import logging
 import json
 
-from ldap3 import Server, Connection, SUBTREE, BASE, LEVEL, \
-    MODIFY_REPLACE, MODIFY_ADD, MODIFY_DELETE
+from ldap3 import SUBTREE, BASE, LEVEL, MODIFY_REPLACE, MODIFY_ADD, \
+    MODIFY_DELETE
 
-from clustermgr.models import Server as ServerModel
+from clustermgr.extensions import ldappool, mmrsnapshots
+from clustermgr.core.hosts import hostindex
+from clustermgr.core.fanout import fan_out
 from clustermgr.core.utils import ldap_encode
 
 logger = logging.getLogger(__name__)
@@ -18,15 +20,190 @@ def get_host_port(addr):
 
 
 def get_hostname_by_ip(ipaddr):
-    ldp = ServerModel.query.filter_by(ip=ipaddr).first()
-    if ldp:
-        return ldp.hostname
+    return hostindex.hostname(ipaddr)
 
 
 def get_ip_by_hostname(hostname):
-    ldp = ServerModel.query.filter_by(hostname=hostname).first()
-    if ldp:
-        return ldp.ip
+    return hostindex.ip(hostname)
+
+
+def parse_providers(syncrepls):
+    """Parses the olcSyncrepl values of a database into its providers.
+
+    Args:
+        syncrepls (list): the olcSyncrepl values
+
+    Returns:
+        dict keyed by the provider hostname of (rid, port, host) tuples
+    """
+    pDict = {}
+    for pe in syncrepls:
+        for e in pe.split():
+            es = e.split("=")
+            if re.search('(\{\d*\})*rid',  es[0]):
+                pid = es[1]
+            elif es[0] == 'provider':
+                host, port = get_host_port(es[1])
+                dkey = host
+                if re.match(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", host):
+                    dkey = get_hostname_by_ip(host)
+
+        pDict[dkey] = (pid, port, host)
+
+    return pDict
+
+
+def collect_mmr_status(servers, timeout=5):
+    """Reads the replication status of the LDAP servers concurrently, so
+    that a server which does not answer in time does not hold the others.
+
+    Args:
+        servers (list): the :class:`clustermgr.models.Server` to read
+        timeout (int, optional): seconds to wait for every server
+
+    Returns:
+        dict keyed by hostname of dicts with the `status` returned by
+        :meth:`LdapOLC.getMMRStatus`, None when it could not be read, the
+        connection `error` if any, and whether the server `timed_out`
+    """
+    def read_status(server):
+        s = LdapOLC("ldaps://{0}:1636".format(server.hostname), "cn=config",
+                    server.ldap_password)
+        if not s.connect(timeout):
+            return None
+        return s.getMMRStatus()
+
+    status = {}
+    for result in fan_out(read_status, servers, timeout=timeout):
+        status[result.item.hostname] = {
+            'status': result.value if result.ok else None,
+            'error': str(result.error) if result.error else None,
+            'timed_out': result.timed_out,
+        }
+    return status
+
+
+def mmr_status(servers, refresh=False, timeout=5):
+    """Returns the last snapshot of the replication status of the servers,
+    taking a new one when it is stale, refer
+    :class:`clustermgr.core.snapshots.ReplicationSnapshots`.
+
+    Args:
+        servers (list): the :class:`clustermgr.models.Server` of the cluster
+        refresh (boolean, optional): take a new snapshot in any case
+        timeout (int, optional): seconds to wait for every server when a
+            new snapshot is taken
+
+    Returns:
+        the snapshot as a dict with the time it was `taken_at` and the
+        status of the `servers` as returned by :func:`collect_mmr_status`
+    """
+    snapshot = None if refresh else mmrsnapshots.get()
+    if mmrsnapshots.is_fresh(snapshot, [s.hostname for s in servers]):
+        return snapshot
+    return mmrsnapshots.store(collect_mmr_status(servers, timeout))
+
+
+class ReplicationConfig(object):
+    """The replication related entries of the cn=config of a server, read
+    with a single search by :meth:`LdapOLC.getReplicationConfig`. The checks
+    are evaluated on the entries read, without asking the server again, so
+    they reflect the configuration at the time of the search.
+
+    Args:
+        entries (list): the search response, dicts with the `dn` and the
+            `attributes` of every entry
+    """
+    #the global entry, the databases and their overlays, not the schema
+    SEARCH_FILTER = ('(|(objectClass=olcGlobal)(objectClass=olcDatabaseConfig)'
+                     '(objectClass=olcOverlayConfig))')
+    ATTRIBUTES = ['objectClass', 'olcServerID', 'olcSuffix', 'olcOverlay',
+                  'olcMirrorMode', 'olcSyncrepl', 'olcAccessLogPurge']
+
+    def __init__(self, entries):
+        self.entries = {}
+        for entry in entries:
+            if entry.get('type', 'searchResEntry') != 'searchResEntry':
+                continue
+            attributes = dict((k.lower(), v) for k, v in
+                              entry['attributes'].items())
+            self.entries[entry['dn'].lower().replace(' ', '')] = attributes
+
+    def _values(self, dn, attribute):
+        values = self.entries.get(dn, {}).get(attribute.lower())
+        if values is None:
+            return []
+        if isinstance(values, (list, tuple)):
+            return list(values)
+        return [values]
+
+    def _with(self, attribute):
+        # (dn, values) of the entries which have the attribute
+        for dn in self.entries:
+            values = self._values(dn, attribute)
+            if values:
+                yield dn, values
+
+    @property
+    def server_id(self):
+        """olcServerID of the server, None when not set"""
+        values = self._values('cn=config', 'olcServerID')
+        return values[0] if values else None
+
+    def has_syncprov(self, database):
+        """Tells whether the database has a syncprov overlay
+
+        Args:
+            database (string): the olcDatabase, such as {1}mdb
+        """
+        suffix = ',olcdatabase={0},cn=config'.format(database.lower())
+        for dn, overlays in self._with('olcOverlay'):
+            # the overlays are ordered, such as {0}syncprov
+            overlays = [re.sub(r'^\{\d+\}', '', o) for o in overlays]
+            if dn.endswith(suffix) and 'syncprov' in overlays:
+                return True
+        return False
+
+    @property
+    def mirror_mode(self):
+        """olcMirrorMode of the main database, False when not set"""
+        return self.entries.get('olcdatabase={1}mdb,cn=config', {}).get(
+            'olcmirrormode') or False
+
+    @property
+    def has_accesslog_db(self):
+        """Tells whether the accesslog database (cn=accesslog) exists"""
+        for dn, suffixes in self._with('olcSuffix'):
+            if 'cn=accesslog' in [v.lower() for v in suffixes]:
+                return True
+        return False
+
+    @property
+    def has_accesslog_purge(self):
+        """Tells whether the accesslog overlay entry exists"""
+        for dn, classes in self._with('objectClass'):
+            if 'olcaccesslogconfig' in [c.lower() for c in classes]:
+                return True
+        return False
+
+    @property
+    def providers(self):
+        """providers of the main database, refer :func:`parse_providers`"""
+        return parse_providers(
+            self._values('olcdatabase={1}mdb,cn=config', 'olcSyncrepl'))
+
+    def status(self):
+        """Returns the multi master replication status in the form of
+        :meth:`LdapOLC.getMMRStatus`"""
+        return {
+            'server_id': self.server_id,
+            'overlaysDB1': self.has_syncprov('{1}mdb'),
+            'overlaysDB2': self.has_syncprov('{2}mdb'),
+            'mirrorMode': self.mirror_mode,
+            'accesslogDB': self.has_accesslog_db,
+            'accesslogPurge': self.has_accesslog_purge,
+            'providers': self.providers,
+        }
 
 
 class LdapOLC(object):
@@ -46,17 +223,30 @@ class LdapOLC(object):
         self.conn = None
         self.hostname = get_host_port(addr)[0]
 
-    def connect(self):
-        """Makes connection to ldap server and returns result
+    def connect(self, timeout=None):
+        """Borrows a connection bound to the ldap server from the pool and
+        returns result. It goes back to the pool with close(), or when this
+        object is garbage collected.
+
+        Args:
+            timeout (int, optional): seconds to wait for the server when a
+                new connection has to be opened
         
         Returns:
             the ldap connection result
         """
         logger.debug("Making Ldap Connection")
-        self.server = Server(self.addr, use_ssl=True)
-        self.conn = Connection(
-            self.server, user=self.binddn, password=self.passwd)
-        return self.conn.bind()
+        self.close()
+        self.conn = ldappool.get(self.addr, self.binddn, self.passwd,
+                                 owner=self, connect_timeout=timeout)
+        self.server = self.conn.server
+        return self.conn.bound
+
+    def close(self):
+        """Returns the connection to the pool"""
+        if self.conn is not None:
+            ldappool.release(self.conn)
+            self.conn = None
 
     def loadModules(self, *modules):
         """This function creates ldap entry on server for loading nodules.
@@ -540,28 +730,28 @@ class LdapOLC(object):
             provider dictionary.
         """
 
-        pDict = {}
-        
         #Search provider entries
         if self.conn.search(search_base='olcDatabase={1}mdb,cn=config',
                             search_filter='(objectClass=*)',
                             search_scope=BASE, attributes=["olcSyncRepl"]):
-            
-            #Iterate all providers and parse it
-            for pe in self.conn.response[0]['attributes']['olcSyncrepl']:
-                for e in pe.split():
-                    es = e.split("=")
-                    if re.search('(\{\d*\})*rid',  es[0]):
-                        pid = es[1]
-                    elif es[0] == 'provider':
-                        host, port = get_host_port(es[1])
-                        dkey = host
-                        if re.match(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", host):
-                            dkey = get_hostname_by_ip(host)
-
-                pDict[dkey] = (pid, port, host)
-
-        return pDict
+            return parse_providers(
+                self.conn.response[0]['attributes']['olcSyncrepl'])
+
+        return {}
+
+    def getReplicationConfig(self):
+        """Reads the replication related entries of cn=config with a single
+        search, for the checks to be evaluated locally.
+
+        Returns:
+            :class:`ReplicationConfig`, empty when the search failed
+        """
+        if not self.conn.search(search_base='cn=config',
+                                search_filter=ReplicationConfig.SEARCH_FILTER,
+                                search_scope=SUBTREE,
+                                attributes=ReplicationConfig.ATTRIBUTES):
+            return ReplicationConfig([])
+        return ReplicationConfig(self.conn.response)
 
     def getMMRStatus(self):
         """Returns multi master replication status for this server
@@ -569,21 +759,7 @@ class LdapOLC(object):
         Returns:
             dictionary includes replicator results
         """
-        
-        retDict = {}
-        retDict["server_id"] = None
-        if self.checkServerID():
-            if self.conn.response[0]['attributes']['olcServerID']:
-                retDict["server_id"] = self.conn.response[0]['attributes']['olcServerID'][0]
-
-        retDict["overlaysDB1"] = self.checkSyncprovOverlaysDB1()
-        retDict["overlaysDB2"] = self.checkSyncprovOverlaysDB2()
-        retDict["mirrorMode"] = self.checkMirroMode()
-        retDict["accesslogDB"] = self.checkAccesslogDBEntry()
-        retDict["accesslogPurge"] = self.checkAccesslogPurge()
-        retDict["providers"] = self.getProviders()
-
-        return retDict
+        return self.getReplicationConfig().status()
 
     def getMainDbDN(self):
         """Returns dn of main db 
@@ -701,15 +877,20 @@ class DBManager(object):
         ip (string, optional): ip address of the server for connection fallback
     """
     def __init__(self, hostname, port, password, ssl=True, ip=None):
-        self.server = Server(hostname, port=port, use_ssl=ssl)
-        self.conn = Connection(self.server, user="cn=directory manager,o=gluu",
-                               password=password, auto_bind=True)
+        self.conn = ldappool.get(hostname, "cn=directory manager,o=gluu",
+                                 password, port=port, use_ssl=ssl,
+                                 auto_bind=True, owner=self)
 
         if not self.conn.bound and ip:
-            self.server = Server(ip, port=port, use_ssl=ssl)
-            self.conn = Connection(
-                self.server, user="cn=directory manager,o=gluu",
-                password=password, auto_bind=True)
+            ldappool.release(self.conn)
+            self.conn = ldappool.get(ip, "cn=directory manager,o=gluu",
+                                     password, port=port, use_ssl=ssl,
+                                     auto_bind=True, owner=self)
+        self.server = self.conn.server
+
+    def close(self):
+        """Returns the connection to the pool"""
+        ldappool.release(self.conn)
 
     def get_appliance_attributes(self, *args):
         """Returns the value of the attribute under the gluuAppliance entry
@@ -0,0 +1,227 @@
+"""ldap_pool.py - process wide pool of bound LDAP connections.
+"""
+import logging
+import os
+import threading
+import time
+import weakref
+
+from ldap3 import Server, Connection, BASE
+from ldap3.core.exceptions import LDAPException
+
+logger = logging.getLogger(__name__)
+
+
+class LdapConnectionPool(object):
+    """A process wide pool of bound ldap3 connections.
+
+    The pages and the tasks keep talking to the LDAP servers of the same
+    handful of Gluu servers. Instead of doing a TLS handshake and a bind every
+    time, they borrow a connection which is already bound from the pool,
+    keyed by (address, port, ssl, bind dn). A connection is lent to one
+    borrower at a time, as ldap3 connections are not safe to share between
+    threads.
+
+    Connections which have been idle for `check_interval` seconds are checked
+    with a read of the root DSE before being lent, and are bound again when
+    the check fails or the server dropped them. Connections which have been
+    idle for `ttl` seconds are unbound. At most `max_size` idle connections
+    are kept for every key, the ones returned past that are unbound.
+
+    Configuration:
+        LDAP_POOL_TTL - seconds a connection can stay idle in the pool before
+        it is unbound. Defaults to 300.
+        LDAP_POOL_SIZE - idle connections kept for every address and bind dn.
+        Defaults to 4.
+        LDAP_POOL_CHECK_INTERVAL - seconds a connection can stay idle before
+        it is checked again. Defaults to 30.
+
+    Initialization::
+
+        ldappool = LdapConnectionPool()
+        ldappool.init_app(app)
+
+        conn = ldappool.get('ldaps://ldap.example.com:1636', 'cn=config',
+                            password)
+        conn.search(...)
+        ldappool.release(conn)
+    """
+
+    def __init__(self, app=None, ttl=300, max_size=4, check_interval=30):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self._idle = {}
+        self._leases = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('LDAP_POOL_TTL', self.ttl)
+        self.max_size = app.config.get('LDAP_POOL_SIZE', self.max_size)
+        self.check_interval = app.config.get('LDAP_POOL_CHECK_INTERVAL',
+                                             self.check_interval)
+
+    def get(self, addr, user, password, port=None, use_ssl=True,
+            auto_bind=False, owner=None, connect_timeout=None):
+        """Returns a connection to the LDAP server bound as the user, reusing
+        a pooled one when it is still alive.
+
+        Args:
+            addr (string): hostname, ip address or uri of the LDAP server
+            user (string): the dn to bind as
+            password (string): the password of the dn
+            port (int, optional): port of the server when not given in `addr`
+            use_ssl (boolean, optional): whether to connect over ssl
+            auto_bind (boolean, optional): raise LDAPBindError when the bind
+                fails, like the auto_bind of ldap3. Otherwise the connection
+                is returned unbound, with the reason in its result
+            owner (object, optional): the connection goes back to the pool
+                when the owner is garbage collected, in case it is never
+                released
+            connect_timeout (int, optional): seconds to wait for a new
+                connection to be opened
+
+        Returns:
+            :class:`ldap3.Connection`
+
+        Raises:
+            LDAPException: when a new connection cannot be made
+        """
+        key = (addr, port, use_ssl, user)
+        self._check_pid()
+        self.evict_idle()
+
+        conn = None
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                # the most recently used is the most likely to be alive
+                entry = idle.pop() if idle else None
+            if entry is None:
+                break
+            candidate, secret, used = entry
+            if secret == password and self._usable(candidate, used):
+                logger.debug("Reusing pooled LDAP connection to %s", addr)
+                conn = candidate
+                break
+            self._unbind(candidate)
+
+        if conn is None:
+            server = Server(addr, port=port, use_ssl=use_ssl,
+                            connect_timeout=connect_timeout)
+            conn = Connection(server, user=user, password=password,
+                              auto_bind=auto_bind)
+            if not auto_bind:
+                conn.bind()
+        self._lend(conn, key, password, owner)
+        return conn
+
+    def release(self, conn):
+        """Puts the connection back in the pool for the next borrower. The
+        connections which are not bound, or not lent by the pool, are unbound.
+
+        Args:
+            conn (:class:`ldap3.Connection`): the connection returned by get()
+        """
+        with self._lock:
+            lease = self._leases.pop(id(conn), None)
+        if lease is None or lease[0] is not conn:
+            self._unbind(conn)
+            return
+        _, key, password = lease
+
+        if conn.bound and not conn.closed:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_size:
+                    idle.append((conn, password, time.time()))
+                    return
+        self._unbind(conn)
+
+    def evict_idle(self):
+        """Unbinds the connections which have been idle for longer than the
+        ttl.
+
+        Returns:
+            the number of connections evicted
+        """
+        now = time.time()
+        stale = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                stale.extend(e[0] for e in idle if now - e[2] > self.ttl)
+                idle[:] = [e for e in idle if now - e[2] <= self.ttl]
+
+        for conn in stale:
+            logger.debug("Unbinding idle LDAP connection")
+            self._unbind(conn)
+        return len(stale)
+
+    def close_all(self):
+        """Unbinds all the idle connections in the pool."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for entries in idle.values():
+            for entry in entries:
+                self._unbind(entry[0])
+
+    def _lend(self, conn, key, password, owner):
+        lease = (conn, key, password)
+        with self._lock:
+            self._leases[id(conn)] = lease
+        if owner is None:
+            return
+
+        def returned(ref):
+            with self._lock:
+                self._owners.pop(id(ref), None)
+                # the connection may have been released and lent again since
+                ours = self._leases.get(id(conn)) is lease
+            if ours:
+                self.release(conn)
+
+        ref = weakref.ref(owner, returned)
+        with self._lock:
+            self._owners[id(ref)] = ref
+
+    def _usable(self, conn, used):
+        if conn.closed or not conn.bound:
+            return self._rebind(conn)
+        if time.time() - used < self.check_interval:
+            return True
+        try:
+            if conn.search('', '(objectClass=*)', search_scope=BASE,
+                           attributes=['1.1']):
+                return True
+        except LDAPException:
+            pass
+        logger.debug("Pooled LDAP connection failed the check. Rebinding")
+        return self._rebind(conn)
+
+    def _rebind(self, conn):
+        # bind() opens the connection again after the unbind
+        self._unbind(conn)
+        try:
+            return conn.bind()
+        except LDAPException:
+            return False
+
+    def _unbind(self, conn):
+        try:
+            conn.unbind()
+        except LDAPException:
+            pass
+
+    def _check_pid(self):
+        # the sockets of a forked parent are not ours to use or unbind
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            self._idle = {}
+            self._leases = {}
+            self._owners = {}
+            self._pid = os.getpid()
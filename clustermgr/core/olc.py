@@ -1,15 +1,16 @@
 """A LDAP3 based module that provides classes to handle manipulation of the
 On-Line Configuration (OLC) of OpenLDAP server.
 """
-from ldap3 import Server, Connection, BASE, SUBTREE, MODIFY_ADD, \
-        MODIFY_DELETE, MODIFY_REPLACE
+from ldap3 import BASE, SUBTREE, MODIFY_ADD, MODIFY_DELETE, MODIFY_REPLACE
+
+from clustermgr.extensions import ldappool
 
 
 class CnManager(object):
     def __init__(self, addr, port, ssl, username, password):
-        self.server = Server(addr, port=port, use_ssl=ssl)
-        self.conn = Connection(self.server, user=username, password=password,
-                               auto_bind=True)
+        self.conn = ldappool.get(addr, username, password, port=port,
+                                 use_ssl=ssl, auto_bind=True, owner=self)
+        self.server = self.conn.server
         self.gluu_db_dn = None
 
     def __get_gluu_db_dn(self):
@@ -69,8 +70,9 @@ class CnManager(object):
             return self.conn.modify(self.gluu_db_dn, mod)
 
     def close(self):
-        """Unbinds from the connection and closes it down"""
-        self.conn.unbind()
+        """Returns the connection to the pool, which unbinds it when it is
+        not kept for reuse"""
+        ldappool.release(self.conn)
 
     def recent_result(self):
         """This function returns the connection.result value at the requested
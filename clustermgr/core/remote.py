@@ -1,17 +1,754 @@
+import re
+import fnmatch
+import functools
+import hashlib
+import os
+import pipes
+import Queue
 import StringIO
 import socket
 import logging
+import tarfile
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
 
 from paramiko import SSHException
 from paramiko.client import SSHClient, AutoAddPolicy
 
 
+# ssh command to reach the shell of the Gluu Server container on the OSes
+# where the container runs systemd and cannot be entered with chroot
+GLUU_CONSOLE_SSH = ("ssh -o IdentityFile=/etc/gluu/keys/gluu-console "
+                    "-o Port=60022 -o LogLevel=QUIET "
+                    "-o StrictHostKeyChecking=no "
+                    "-o UserKnownHostsFile=/dev/null "
+                    "-o PubkeyAuthentication=yes root@localhost")
+GLUU_CONSOLE_OS = ('CentOS 7', 'RHEL 7')
+
+# file types reported by `stat -c %F` mapped to the ones used by stat_many
+STAT_TYPES = {
+    'regular file': 'file',
+    'regular empty file': 'file',
+    'directory': 'dir',
+    'symbolic link': 'link',
+}
+
+
 class ClientNotSetupException(Exception):
     """Exception raised when the client is not initialized because
     of connection failures."""
     pass
 
 
+class CommandTimeout(Exception):
+    """Exception raised when a command runs past its deadline. By the time it
+    is raised the process group of the command has been killed in the remote
+    server."""
+    pass
+
+
+_task_deadline = threading.local()
+
+
+@contextmanager
+def task_deadline(seconds):
+    """Sets a deadline for all the commands run by the current thread inside
+    the block, on top of the timeout of every single command. Blocks can be
+    nested, the earliest deadline wins.
+
+    Args:
+        seconds (int): seconds from now the commands must finish in. No
+            deadline is set if it is None.
+    """
+    previous = getattr(_task_deadline, 'value', None)
+    if seconds is not None:
+        deadline = time.time() + seconds
+        if previous is None or deadline < previous:
+            _task_deadline.value = deadline
+    try:
+        yield
+    finally:
+        _task_deadline.value = previous
+
+
+def command_deadline(timeout=None):
+    """Returns the time a command started now must finish by, which is the
+    earliest of the timeout given and the deadline of the task, or None
+    when neither is set.
+    """
+    deadlines = [getattr(_task_deadline, 'value', None)]
+    if timeout is not None:
+        deadlines.append(time.time() + timeout)
+    deadlines = [d for d in deadlines if d is not None]
+    return min(deadlines) if deadlines else None
+
+
+_step_recorder = threading.local()
+
+
+@contextmanager
+def recording_steps(recorder):
+    """Passes every remote step, a command or a file transfer, done by the
+    current thread inside the block to `recorder`. Blocks can be nested, the
+    innermost recorder wins.
+
+    Args:
+        recorder (callable): called with a dict with the keys `host`, `kind`
+            (`command`, `upload` or `download`), `command`, `started`,
+            `ended`, `exit_status`, `sent` and `received`. Nothing is
+            recorded if it is None.
+    """
+    previous = getattr(_step_recorder, 'value', None)
+    _step_recorder.value = recorder
+    try:
+        yield
+    finally:
+        _step_recorder.value = previous
+
+
+def step_recorder():
+    """Returns the recorder set by recording_steps() for the current thread,
+    so it can be passed on to the threads started on its behalf."""
+    return getattr(_step_recorder, 'value', None)
+
+
+def record_step(host, kind, command, started, ended=None, exit_status=None,
+                sent=0, received=0, os_type=None):
+    """Hands a step over to the recorder of the current thread, if any.
+    Recording never makes the step itself fail."""
+    recorder = step_recorder()
+    if recorder is None:
+        return
+    try:
+        recorder(dict(host=host, kind=kind, command=command, started=started,
+                      ended=time.time() if ended is None else ended,
+                      exit_status=exit_status, sent=sent, received=received,
+                      os=os_type))
+    except Exception:
+        logging.exception("Could not record the step %s on %s", command,
+                          host)
+
+
+def build_batch_script(commands, token, stop_on_error=False):
+    """Builds a bash script that runs the commands one after another and
+    frames the output of every command with markers in both stdout and stderr
+    so that it can be split by :func:`parse_batch_output`.
+
+    Args:
+        commands (list): the commands to be run
+        token (string): a random string unique to the batch used in markers
+        stop_on_error (boolean, optional): exit at the first failing command
+
+    Returns:
+        the script as a string
+    """
+    lines = []
+    for i, command in enumerate(commands):
+        begin = "__BATCH_{0}_BEGIN_{1}".format(token, i)
+        lines.append("printf '\\n{0}\\n'; printf '\\n{0}\\n' >&2".format(begin))
+        lines.append("__s=$(date +%s%N)")
+        lines.append("( {0}\n) < /dev/null".format(command))
+        lines.append("__rc=$?")
+        lines.append("__e=$(date +%s%N)")
+        # date without nanosecond support leaves a literal N in the output
+        lines.append('case "$__s$__e" in *[!0-9]*) __d= ;; '
+                     '*) __d=$(( __e - __s )) ;; esac')
+        lines.append("printf '\\n__BATCH_{0}_END_{1}_%s_%s\\n' "
+                     "\"$__rc\" \"$__d\"".format(token, i))
+        lines.append("printf '\\n__BATCH_{0}_END_{1}\\n' >&2".format(token, i))
+        if stop_on_error:
+            lines.append('[ "$__rc" -eq 0 ] || exit "$__rc"')
+    return "\n".join(lines) + "\n"
+
+
+def _split_framed_output(text, token):
+    """Splits the output of a batch into a dict of index -> (text, status,
+    duration) using the BEGIN and END markers written by the batch script.
+    """
+    begin = re.compile(r'^__BATCH_{0}_BEGIN_(\d+)$'.format(token))
+    end = re.compile(r'^__BATCH_{0}_END_(\d+)(?:_(\d+)_(\d*))?$'.format(
+        token))
+
+    sections = {}
+    current = None
+    buf = []
+    for line in text.splitlines(True):
+        stripped = line.rstrip('\n')
+        m = begin.match(stripped)
+        if m:
+            current = int(m.group(1))
+            buf = []
+            continue
+        m = end.match(stripped)
+        if m and current is not None:
+            # the marker is printed with a leading newline, drop it
+            content = ''.join(buf)
+            if content.endswith('\n'):
+                content = content[:-1]
+            status = int(m.group(2)) if m.group(2) else None
+            duration = None
+            if m.group(3):
+                duration = int(m.group(3)) / 1e9
+            sections[current] = (content, status, duration)
+            current = None
+            continue
+        if current is not None:
+            buf.append(line)
+
+    # output of a command which never reached its END marker
+    if current is not None:
+        sections[current] = (''.join(buf), None, None)
+    return sections
+
+
+def parse_batch_output(commands, token, stdout, stderr):
+    """Parses the stdout and stderr of a batch run by
+    :meth:`RemoteClient.run_batch` into per command results.
+
+    Args:
+        commands (list): the commands that were sent in the batch
+        token (string): the token used to build the batch script
+        stdout (string): the complete stdout of the batch
+        stderr (string): the complete stderr of the batch
+
+    Returns:
+        list of result dicts for the commands which were started
+    """
+    outs = _split_framed_output(stdout, token)
+    errs = _split_framed_output(stderr, token)
+
+    results = []
+    for i, command in enumerate(commands):
+        if i not in outs and i not in errs:
+            break
+        out, status, duration = outs.get(i, ('', None, None))
+        results.append({
+            'command': command,
+            'stdout': out,
+            'stderr': errs.get(i, ('', None, None))[0],
+            'exit_status': status,
+            'duration': duration,
+        })
+    return results
+
+
+def tree_member_selected(name, include=None, exclude=None):
+    """Checks a path relative to the root of a directory tree against the
+    include and exclude filters of a tree transfer. Patterns are matched
+    with fnmatch against both the relative path and the file name.
+
+    Args:
+        name (string): path of the member relative to the tree root
+        include (list, optional): patterns of the files to transfer, all
+            files are transferred when not given
+        exclude (list, optional): patterns of the files to skip
+
+    Returns:
+        boolean whether the member should be transferred
+    """
+    name = name[2:] if name.startswith('./') else name
+    candidates = (name, os.path.basename(name))
+
+    def matches(patterns):
+        return any(fnmatch.fnmatch(c, p) for p in patterns for c in candidates)
+
+    if exclude and matches(exclude):
+        return False
+    return not include or matches(include)
+
+
+def copy_tar_members(src, dst, include=None, exclude=None):
+    """Copies the regular files and directories from one tar stream to
+    another, applying the include and exclude filters.
+
+    Args:
+        src (:class:`tarfile.TarFile`): tar opened for reading
+        dst (:class:`tarfile.TarFile`): tar opened for writing
+        include (list, optional): see tree_member_selected()
+        exclude (list, optional): see tree_member_selected()
+
+    Returns:
+        list of the names of the files copied
+    """
+    copied = []
+    for member in src:
+        if member.isdir():
+            dst.addfile(member)
+        elif member.isfile() and \
+                tree_member_selected(member.name, include, exclude):
+            dst.addfile(member, src.extractfile(member))
+            copied.append(member.name)
+    return copied
+
+
+class RunningCommand(object):
+    """A command started by :class:`RemoteClient` with a deadline.
+
+    The command is wrapped so that the shell running it writes its pid to a
+    pidfile. sshd starts every command in a new session, so that pid is also
+    the id of the process group holding the command and all its children,
+    and the whole group can be killed from another channel when the command
+    times out or the task running it is cancelled.
+
+    Args:
+        client (:class:`RemoteClient`): the client the command runs in
+        command (string): the command to be run
+        deadline (float): time the command must finish by
+    """
+
+    def __init__(self, client, command, deadline):
+        self.client = client
+        self.command = command
+        self.deadline = deadline
+        self.started = time.time()
+        self.channel = None
+        self.pidfile = '/tmp/clustermgr-{0}.pid'.format(uuid.uuid4().hex)
+
+    def wrap(self):
+        return 'echo $$ > {0}; ( {1}\n); __rc=$?; rm -f {0}; exit $__rc'.format(
+            self.pidfile, self.command)
+
+    def expired(self, grace=0):
+        return time.time() > self.deadline + grace
+
+    def done(self):
+        self.client._finish(self)
+
+    def abort(self):
+        """Kills the process group of the command in the remote server and
+        closes its channel, so anything blocked reading it returns.
+        """
+        logging.warning("Killing command on %s: %s", self.client.host,
+                        self.command)
+        kill = ('p=$(cat {0} 2>/dev/null) && [ -n "$p" ] && '
+                '{{ kill -TERM -- -$p; sleep 2; kill -KILL -- -$p; }} '
+                '2>/dev/null; rm -f {0}'.format(self.pidfile))
+        try:
+            cin, cout, cerr = self.client.client.exec_command(kill)
+            cout.channel.recv_exit_status()
+        except (SSHException, socket.error, AttributeError) as err:
+            logging.error("Could not kill command on %s: %s",
+                          self.client.host, err)
+        if self.channel is not None:
+            self.channel.close()
+        self.done()
+
+
+class CommandStream(object):
+    """Iterable over the output of a command running in the remote server.
+
+    Output is yielded as it arrives in the form of (stream, text) tuples,
+    where stream is either `stdout` or `stderr` and text contains one or more
+    complete lines. Lines are held back for at most `flush_interval` seconds
+    so that chatty commands produce a few large chunks instead of many tiny
+    ones, and a partial line is flushed once it grows beyond `max_buffer`
+    characters, so memory stays bounded.
+
+    After the iteration is complete, `exit_status` holds the exit status of
+    the command and `stdout` / `stderr` hold the respective output, or only
+    its last `keep` characters when the output is just logged.
+
+    Args:
+        channel (:class:`paramiko.channel.Channel`): the channel the command
+            was executed in
+        chunk_size (int, optional): bytes to read from the channel at a time
+        max_buffer (int, optional): max size of a partial line held back
+        flush_interval (float, optional): seconds complete lines can be held
+            back before they are yielded
+        keep (int, optional): number of characters of the output to retain.
+            All of it is retained when None, the default
+        guard (:class:`RunningCommand`, optional): deadline of the command.
+            :class:`CommandTimeout` is raised once it is past, and the remote
+            command is killed if the iteration is interrupted for any reason,
+            like a Celery soft time limit or revoke.
+        record (tuple, optional): host and command to pass to record_step()
+            once the iteration ends
+    """
+    poll_interval = 0.05
+
+    def __init__(self, channel, chunk_size=4096, max_buffer=65536,
+                 flush_interval=0.5, keep=None, guard=None, record=None):
+        self.channel = channel
+        self.guard = guard
+        self.record = record
+        self.received = 0
+        self.chunk_size = chunk_size
+        self.max_buffer = max_buffer
+        self.flush_interval = flush_interval
+        self.keep = keep
+        self.exit_status = None
+        self.stdout = ''
+        self.stderr = ''
+        self._buffers = {'stdout': '', 'stderr': ''}
+
+    def __iter__(self):
+        started = time.time()
+        try:
+            if self.guard is None:
+                for item in self._read():
+                    yield item
+                return
+
+            try:
+                for item in self._read():
+                    yield item
+            except BaseException:
+                self.guard.abort()
+                raise
+            self.guard.done()
+        finally:
+            if self.record:
+                record_step(self.record[0], 'command', self.record[1],
+                            started, exit_status=self.exit_status,
+                            received=self.received)
+
+    def _read(self):
+        channel = self.channel
+        last_flush = time.time()
+        while True:
+            received = False
+            if channel.recv_ready():
+                self._buffers['stdout'] += channel.recv(self.chunk_size)
+                received = True
+            if channel.recv_stderr_ready():
+                self._buffers['stderr'] += channel.recv_stderr(
+                    self.chunk_size)
+                received = True
+
+            force = time.time() - last_flush >= self.flush_interval
+            for name in ('stdout', 'stderr'):
+                chunk = self._take(name, force)
+                if chunk:
+                    last_flush = time.time()
+                    yield name, chunk
+
+            if not received:
+                if channel.exit_status_ready() and not channel.recv_ready() \
+                        and not channel.recv_stderr_ready():
+                    break
+                if self.guard is not None and self.guard.expired():
+                    raise CommandTimeout(
+                        "Command timed out: {0}".format(self.guard.command))
+                time.sleep(self.poll_interval)
+
+        for name in ('stdout', 'stderr'):
+            chunk = self._buffers[name]
+            self._buffers[name] = ''
+            if chunk:
+                self._retain(name, chunk)
+                yield name, chunk
+
+        self.exit_status = channel.recv_exit_status()
+
+    def _take(self, name, force):
+        buf = self._buffers[name]
+        if len(buf) >= self.max_buffer:
+            chunk = buf
+        else:
+            end = buf.rfind('\n')
+            if end == -1 or (not force and len(buf) < self.chunk_size):
+                return ''
+            chunk = buf[:end + 1]
+        self._buffers[name] = buf[len(chunk):]
+        self._retain(name, chunk)
+        return chunk
+
+    def _retain(self, name, chunk):
+        self.received += len(chunk)
+        value = getattr(self, name) + chunk
+        if self.keep is not None:
+            value = value[max(len(value) - self.keep, 0):]
+        setattr(self, name, value)
+
+
+class FramedChannel(object):
+    """Channel like view over one command of a :class:`ContainerSession`.
+
+    The output of the command is read from the channel of the session until
+    the END markers written after it, which are stripped. The exit status
+    comes from the stdout marker.
+    Quacks enough like :class:`paramiko.channel.Channel` to be read with
+    :class:`CommandStream`.
+
+    Args:
+        channel (:class:`paramiko.channel.Channel`): channel of the session
+        token (string): random string unique to the command used in markers
+    """
+    chunk_size = 32768
+
+    def __init__(self, channel, token):
+        self.channel = channel
+        self.status = None
+        self._markers = {
+            'stdout': re.compile(r'__CS_{0}_END_(\d+)\n'.format(token)),
+            'stderr': re.compile(r'__CS_{0}_END\n'.format(token)),
+        }
+        self._prefix = '__CS_{0}_END'.format(token)
+        self._received = {'stdout': '', 'stderr': ''}
+        self._ready = {'stdout': '', 'stderr': ''}
+        self._done = {'stdout': False, 'stderr': False}
+
+    def _fill(self, name):
+        if self._done[name]:
+            return
+        if name == 'stdout' and self.channel.recv_ready():
+            self._received[name] += self.channel.recv(self.chunk_size)
+        elif name == 'stderr' and self.channel.recv_stderr_ready():
+            self._received[name] += self.channel.recv_stderr(self.chunk_size)
+        elif self.channel.exit_status_ready():
+            # the shell of the session died before the command finished
+            self._ready[name] += self._received[name]
+            self._received[name] = ''
+            self._done[name] = True
+            return
+
+        buf = self._received[name]
+        m = self._markers[name].search(buf)
+        if m:
+            self._ready[name] += buf[:m.start()]
+            self._received[name] = ''
+            self._done[name] = True
+            if name == 'stdout':
+                self.status = int(m.group(1))
+            return
+
+        # hold back the tail which may be the beginning of the marker
+        keep = 0
+        for i in range(1, min(len(buf), len(self._prefix)) + 1):
+            if self._prefix.startswith(buf[-i:]):
+                keep = i
+        self._ready[name] += buf[:len(buf) - keep]
+        self._received[name] = buf[len(buf) - keep:]
+
+    def _recv(self, name, size):
+        data = self._ready[name][:size]
+        self._ready[name] = self._ready[name][size:]
+        return data
+
+    def recv_ready(self):
+        self._fill('stdout')
+        return bool(self._ready['stdout'])
+
+    def recv_stderr_ready(self):
+        self._fill('stderr')
+        return bool(self._ready['stderr'])
+
+    def recv(self, size):
+        return self._recv('stdout', size)
+
+    def recv_stderr(self, size):
+        return self._recv('stderr', size)
+
+    def exit_status_ready(self):
+        return self._done['stdout'] and self._done['stderr']
+
+    def recv_exit_status(self):
+        return self.status
+
+
+class SessionCommand(object):
+    """Deadline of a single command run in a :class:`ContainerSession`. The
+    deadline is applied to the :class:`RunningCommand` of the session while
+    the command runs, for the watchdog to see it.
+
+    The command runs in a process group of its own, whose id is written to
+    `pidfile` inside the container, so timing out kills the command and its
+    children but not the shell of the session.
+    """
+
+    def __init__(self, session, command, deadline, pidfile):
+        self.session = session
+        self.command = command
+        self.pidfile = pidfile
+        self.guard = session.guard
+        self.guard.deadline = deadline
+
+    def expired(self, grace=0):
+        return self.guard.expired(grace)
+
+    def done(self):
+        self.guard.deadline = float('inf')
+
+    def abort(self):
+        """Kills the process group of the command and closes the session,
+        for the next command not to read what is left of the output of this
+        one. The whole session is killed when the command cannot be.
+        """
+        client = self.session.client
+        logging.warning("Killing command on %s: %s", client.host,
+                        self.command)
+        kill = ('p=$(cat {0} 2>/dev/null); rm -f {0}; [ -n "$p" ] || exit 1; '
+                'kill -TERM -- -$p 2>/dev/null; sleep 2; '
+                'kill -KILL -- -$p 2>/dev/null; exit 0'.format(self.pidfile))
+        try:
+            cin, cout, cerr = client.client.exec_command(
+                self.session.enter(kill))
+            killed = cout.channel.recv_exit_status() == 0
+        except (SSHException, socket.error, AttributeError) as err:
+            logging.error("Could not kill command on %s: %s", client.host,
+                          err)
+            killed = False
+        if killed:
+            self.session.close()
+        else:
+            self.session.abort()
+
+
+class ContainerSession(object):
+    """A shell opened once inside the Gluu Server container which runs many
+    commands, instead of paying for a `chroot` or a nested SSH handshake to
+    the console of the Gluu Server for every command.
+
+    Every command is run in a process group of its own with stdin redirected
+    from /dev/null and is followed by markers carrying its exit status, so its
+    output can be told apart from the one of the next command. The session
+    offers run(), run_stream() and run_batch() like :class:`RemoteClient`,
+    and can be passed in its place to the helpers that take a client. It
+    must be used by a single thread at a time. If the shell dies or a command
+    times out, the session is closed and reopened by the next command.
+
+    Args:
+        client (:class:`RemoteClient`): client of the host of the container
+        container (string): path of the container, `/` for running the
+            commands directly in the host
+        console (boolean, optional): whether the container is entered through
+            its SSH console, refer GLUU_CONSOLE_SSH, whatever its path
+    """
+
+    def __init__(self, client, container, console=False):
+        self.client = client
+        self.container = container
+        self.console = console
+        self.guard = None
+        self.stdin = None
+
+    @property
+    def shell(self):
+        if self.console:
+            return '{0} /bin/bash -s'.format(GLUU_CONSOLE_SSH)
+        if not self.container or self.container == '/':
+            return '/bin/bash -s'
+        return 'chroot {0} /bin/bash -s'.format(self.container)
+
+    def enter(self, command):
+        """Returns the command which runs `command` inside the container
+        from a channel of its own."""
+        if self.console:
+            return '{0} {1}'.format(GLUU_CONSOLE_SSH, pipes.quote(command))
+        if not self.container or self.container == '/':
+            return command
+        return 'chroot {0} /bin/bash -c {1}'.format(self.container,
+                                                     pipes.quote(command))
+
+    def is_open(self):
+        channel = self.guard and self.guard.channel
+        return bool(channel) and not channel.closed and \
+            not channel.exit_status_ready()
+
+    def open(self):
+        """Starts the shell of the session in the container."""
+        self.close()
+        # the session lives as long as it is used, every command moves the
+        # deadline of its guard while it runs
+        (cin, cout, cerr), self.guard = self.client._exec(
+            self.shell, timeout=float('inf'))
+        self.stdin = cin
+        logging.debug("Container session opened on %s: %s",
+                      self.client.host, self.shell)
+
+    def close(self):
+        """Ends the shell of the session by closing its stdin."""
+        if self.guard is None:
+            return
+        guard, self.guard = self.guard, None
+        try:
+            self.stdin.close()
+            guard.channel.shutdown_write()
+        except (SSHException, socket.error, EOFError):
+            pass
+        guard.done()
+
+    def abort(self):
+        """Kills the shell of the session and the command it is running."""
+        if self.guard is None:
+            return
+        guard, self.guard = self.guard, None
+        guard.abort()
+
+    def run_stream(self, command, timeout=None, **kwargs):
+        """Runs a command in the container and streams its output.
+
+        Args:
+            command (string): the command to be run in the container
+            timeout (int, optional): seconds after which the command is
+                killed. Defaults to the `command_timeout` of the client.
+            **kwargs: options passed on to :class:`CommandStream`
+
+        Returns:
+            :class:`CommandStream` to be iterated over for the output
+        """
+        if not self.is_open():
+            self.open()
+
+        token = uuid.uuid4().hex
+        pidfile = '/tmp/clustermgr-{0}.pid'.format(token)
+        # setsid starts the command in a new process group, which can be
+        # killed without the shell of the session
+        self.stdin.write(
+            "setsid /bin/bash -c {0} < /dev/null &\n"
+            "echo $! > {2}; wait $!; __rc=$?; rm -f {2}\n"
+            "printf '__CS_{1}_END_%s\\n' \"$__rc\"\n"
+            "printf '__CS_{1}_END\\n' >&2\n".format(pipes.quote(command),
+                                                  token, pidfile))
+        self.stdin.flush()
+
+        if timeout is None:
+            timeout = self.client.command_timeout
+        guard = SessionCommand(self, command,
+                               command_deadline(timeout) or float('inf'),
+                               pidfile)
+        return CommandStream(FramedChannel(self.guard.channel, token),
+                             guard=guard, record=(self.client.host, command),
+                             **kwargs)
+
+    def run(self, command, timeout=None):
+        """Runs a command in the container and waits for it to finish.
+
+        Returns:
+            tuple of three strings containing text from stdin, stdout an stderr
+        """
+        stream = self.run_stream(command, timeout, keep=None)
+        for _ in stream:
+            pass
+        return '', stream.stdout, stream.stderr
+
+    def run_batch(self, commands, stop_on_error=False, timeout=None):
+        """Runs a list of commands in the container one after another.
+
+        Returns:
+            list of dicts like :meth:`RemoteClient.run_batch`
+        """
+        results = []
+        for command in commands:
+            started = time.time()
+            stream = self.run_stream(command, timeout, keep=None)
+            for _ in stream:
+                pass
+            results.append({
+                'command': command,
+                'stdout': stream.stdout,
+                'stderr': stream.stderr,
+                'exit_status': stream.exit_status,
+                'duration': time.time() - started,
+            })
+            if stop_on_error and stream.exit_status:
+                break
+        return results
+
+
 class RemoteClient(object):
     """Remote Client is a wrapper over SSHClient with utility functions.
 
@@ -28,7 +765,10 @@ class RemoteClient(object):
             for all the communications with the remote server.
         sftpclient (:class:`paramiko.sftp_client.SFTPClient`): The SFTP object
             for all the file transfer operations over the SSH.
+        command_timeout (int): default timeout in seconds of the commands
+            run with run(), run_stream() and run_batch(). None for no timeout.
     """
+    command_timeout = None
 
     def __init__(self, host, ip=None, user='root'):
         self.host = host
@@ -36,6 +776,9 @@ class RemoteClient(object):
         self.user = user
         self.client = SSHClient()
         self.sftpclient = None
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._sessions = {}
         self.client.set_missing_host_key_policy(AutoAddPolicy())
         self.client.load_system_host_keys()
         logging.debug("RemoteClient created for host: %s", host)
@@ -80,7 +823,11 @@ class RemoteClient(object):
                 'Cannot download file. Client not initialized')
 
         try:
+            started = time.time()
             self.sftpclient.get(remote, local)
+            if step_recorder() is not None:
+                record_step(self.host, 'download', remote, started,
+                            received=os.path.getsize(local))
             return "Download successful. File at: {0}".format(local)
         except OSError:
             return "Error: Local file %s doesn't exist." % local
@@ -99,7 +846,10 @@ class RemoteClient(object):
                 'Cannot upload file. Client not initialized')
 
         try:
-            self.sftpclient.put(local, remote)
+            started = time.time()
+            attrs = self.sftpclient.put(local, remote)
+            record_step(self.host, 'upload', remote, started,
+                        sent=attrs.st_size)
             return "Upload successful. File at: {0}".format(remote)
         except OSError:
             return "Error: Local file %s doesn't exist." % local
@@ -115,30 +865,116 @@ class RemoteClient(object):
         Returns:
             True if it exists, False if it doesn't
         """
+        return self.stat_many([filepath])[filepath]['exists']
+
+    def stat_many(self, paths):
+        """Stats a number of paths in the remote server using a single
+        command, instead of running one command per path.
+
+        Args:
+            paths (list): paths of the files and directories to check
+
+        Returns:
+            dict mapping each path to a dict with the keys `exists`, `type`
+            (one of `file`, `dir`, `link`, `other` or None), `size`, `mtime`
+            and `mode` (permission bits as int). All but `exists` are None
+            for paths that do not exist.
+
+        Raises:
+            CommandTimeout: when the command runs past its deadline
+        """
         if not self.client:
             raise ClientNotSetupException(
                 'Cannot run procedure. Client not initialized')
-        cin, cout, cerr = self.client.exec_command('stat {0}'.format(filepath))
-        if len(cout.read()) > 5:
-            return True
-        elif len(cerr.read()) > 5:
-            return False
 
-    def run(self, command):
+        paths = list(paths)
+        stats = dict((path, dict(exists=False, type=None, size=None,
+                                 mtime=None, mode=None)) for path in paths)
+        if not paths:
+            return stats
+
+        command = '; '.join(
+            "stat -c '{0}|%s|%Y|%a|%F' -- {1} 2>/dev/null || echo '{0}|'".format(
+                index, pipes.quote(path))
+            for index, path in enumerate(paths))
+        cin, cout, cerr = self.run(command)
+
+        for line in cout.splitlines():
+            fields = line.split('|', 4)
+            if len(fields) != 5 or not fields[0].isdigit():
+                continue
+            index, size, mtime, mode, ftype = fields
+            stats[paths[int(index)]].update(
+                exists=True,
+                type=STAT_TYPES.get(ftype.strip(), 'other'),
+                size=int(size),
+                mtime=int(mtime),
+                mode=int(mode, 8),
+            )
+        return stats
+
+    def _exec(self, command, timeout=None):
+        """Starts the command, wrapped in a :class:`RunningCommand` when it
+        has a deadline. Returns the stdin, stdout and stderr of the command
+        and the RunningCommand or None.
+        """
+        if not self.client:
+            raise ClientNotSetupException(
+                'Cannot run procedure. Client not initialized')
+
+        if timeout is None:
+            timeout = self.command_timeout
+        deadline = command_deadline(timeout)
+        if deadline is None:
+            return self.client.exec_command(command), None
+
+        guard = RunningCommand(self, command, deadline)
+        buffers = self.client.exec_command(guard.wrap())
+        guard.channel = buffers[1].channel
+        with self._running_lock:
+            self._running.add(guard)
+        return buffers, guard
+
+    def _finish(self, guard):
+        with self._running_lock:
+            self._running.discard(guard)
+
+    def stuck_commands(self, grace=0):
+        """Returns the commands which are still running `grace` seconds past
+        their deadline.
+
+        Args:
+            grace (int, optional): seconds a command may overrun its deadline
+
+        Returns:
+            list of :class:`RunningCommand`
+        """
+        with self._running_lock:
+            return [c for c in self._running if c.expired(grace)]
+
+    def run(self, command, timeout=None):
         """Run a command in the remote server.
 
         Args:
             command (string): the command to be run on the remote server
+            timeout (int, optional): seconds after which the command is
+                killed. Defaults to `command_timeout`.
 
         Returns:
             tuple of three strings containing text from stdin, stdout an stderr
+
+        Raises:
+            CommandTimeout: when the command runs past its deadline
         """
-        if not self.client:
-            raise ClientNotSetupException(
-                'Cannot run procedure. Client not initialized')
-        
-        #buffers = self.client.exec_command(command, timeout=30)
-        buffers = self.client.exec_command(command)
+        started = time.time()
+        buffers, guard = self._exec(command, timeout)
+        if guard is not None:
+            stream = CommandStream(guard.channel, keep=None, guard=guard,
+                                   record=(self.host, command))
+            for _ in stream:
+                pass
+            return '', stream.stdout, stream.stderr
+
         output = []
         for buf in buffers:
             try:
@@ -146,8 +982,93 @@ class RemoteClient(object):
             except IOError:
                 output.append('')
 
+        record_step(self.host, 'command', command, started,
+                    exit_status=buffers[1].channel.recv_exit_status(),
+                    received=len(output[1]) + len(output[2]))
         return tuple(output)
 
+    def run_stream(self, command, timeout=None, **kwargs):
+        """Run a command in the remote server and stream its output instead
+        of waiting for the command to finish.
+
+        Args:
+            command (string): the command to be run on the remote server
+            timeout (int, optional): seconds after which the command is
+                killed. Defaults to `command_timeout`.
+            **kwargs: options passed on to :class:`CommandStream`
+
+        Returns:
+            :class:`CommandStream` to be iterated over for the output
+        """
+        (cin, cout, cerr), guard = self._exec(command, timeout)
+        cin.close()
+        return CommandStream(cout.channel, guard=guard,
+                             record=(self.host, command), **kwargs)
+
+    def run_batch(self, commands, stop_on_error=False, timeout=None):
+        """Run a list of commands in the remote server through a single SSH
+        channel. Each command is executed in its own subshell with stdin
+        redirected from /dev/null, so `cd` or `exit` in one command doesn't
+        affect the following ones.
+
+        Args:
+            commands (list): the commands to be run, in order
+            stop_on_error (boolean, optional): stop running the batch at the
+                first command which exits with a non-zero status
+            timeout (int, optional): seconds after which the whole batch is
+                killed. Defaults to `command_timeout`.
+
+        Returns:
+            list of dicts, one per executed command, with the keys `command`,
+            `stdout`, `stderr`, `exit_status` and `duration` (seconds, None if
+            the remote `date` doesn't support nanoseconds). Commands skipped
+            because of `stop_on_error` are not in the list.
+
+        Raises:
+            CommandTimeout: when the batch runs past its deadline
+        """
+        token = uuid.uuid4().hex
+        script = build_batch_script(commands, token, stop_on_error)
+
+        started = time.time()
+        (cin, cout, cerr), guard = self._exec('/bin/bash -s', timeout)
+        cin.write(script)
+        cin.flush()
+        cin.channel.shutdown_write()
+
+        if guard is not None:
+            stream = CommandStream(guard.channel, keep=None, guard=guard)
+            for _ in stream:
+                pass
+            results = parse_batch_output(commands, token, stream.stdout,
+                                         stream.stderr)
+        else:
+            output = []
+            for buf in (cout, cerr):
+                try:
+                    output.append(buf.read())
+                except IOError:
+                    output.append('')
+            results = parse_batch_output(commands, token, output[0],
+                                         output[1])
+
+        self._record_batch(results, started)
+        return results
+
+    def _record_batch(self, results, started):
+        # every command of the batch is a step of its own, timed by the
+        # remote `date` when it could be
+        ended = time.time()
+        for result in results:
+            duration = result['duration']
+            step_ended = ended if duration is None else \
+                min(ended, started + duration)
+            record_step(self.host, 'command', result['command'], started,
+                        step_ended, result['exit_status'],
+                        received=len(result['stdout'] or '') +
+                        len(result['stderr'] or ''))
+            started = step_ended
+
     def get_file(self, filename):
         """Reads content of filename on remote server
 
@@ -159,7 +1080,10 @@ class RemoteClient(object):
         """
         f = StringIO.StringIO()
         try:
+            started = time.time()
             r = self.sftpclient.getfo(filename, f)
+            record_step(self.host, 'download', filename, started,
+                        received=r)
             f.seek(0)
             return r, f
         except Exception as err:
@@ -180,11 +1104,300 @@ class RemoteClient(object):
         f.seek(0)
 
         try:
+            started = time.time()
             r = self.sftpclient.putfo(f, filename)
+            record_step(self.host, 'upload', filename, started,
+                        sent=r.st_size)
             return True, r.st_size
         except Exception as err:
             return False, err
 
+    def checksum(self, filename):
+        """Computes the md5 checksum of a file on remote server
+
+        Args:
+            filename (string): name of file on the remote server
+
+        Returns:
+            the hex digest of the file or None if it could not be read
+
+        Raises:
+            CommandTimeout: when the command runs past its deadline
+        """
+        cin, cout, cerr = self.run(
+            'md5sum -- {0} 2>/dev/null'.format(pipes.quote(filename)))
+        out = cout.split()
+        if out and re.match('^[0-9a-f]{32}$', out[0]):
+            return out[0]
+
+    def sync_file(self, filename, content=None, local_path=None):
+        """Puts a file on remote server only if the content of the remote copy
+        differs, so unchanged files are not transferred again. Either the
+        content or the path of a local file must be given.
+
+        Args:
+            filename (string): name of file to be written on remote server
+            content (string or file, optional): the content of the file, or a
+                file like object to read it from; unicode is written as UTF-8
+            local_path (string, optional): the path of a local file to upload
+
+        Returns:
+            tuple: True/False, whether the remote file was changed / error
+        """
+        if (content is None) == (local_path is None):
+            raise ValueError("Either content or local_path must be given")
+        try:
+            if local_path is not None:
+                with open(local_path, 'rb') as f:
+                    content = f.read()
+            elif hasattr(content, 'read'):
+                content = content.read()
+        except (IOError, OSError) as err:
+            return False, err
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+
+        if self.checksum(filename) == hashlib.md5(content).hexdigest():
+            return True, False
+
+        r = self.put_file(filename, content)
+        if not r[0]:
+            return r
+        return True, True
+
+    def relay_file(self, filename, targets, target_filename=None,
+                   chunk_size=32768, max_chunks=8):
+        """Copies a file of this server to one or more other servers without
+        holding it in memory. The file is read over SFTP in chunks which are
+        handed to one writer thread per target, so all the targets are
+        written concurrently and writing starts before the read finishes.
+
+        Args:
+            filename (string): name of the file to be read from this server
+            targets (list): the :class:`RemoteClient` of the servers to copy
+                the file to
+            target_filename (string, optional): name of the file to be
+                written on the targets, defaults to `filename`
+            chunk_size (int, optional): bytes read from the source at a time
+            max_chunks (int, optional): chunks queued for a target before the
+                read waits for it to catch up
+
+        Returns:
+            list: True/False, file size / error for every target, in the same
+            order as the targets
+        """
+        if not self.sftpclient:
+            raise ClientNotSetupException(
+                'Cannot relay file. Client not initialized')
+
+        target_filename = target_filename or filename
+        results = [None] * len(targets)
+        queues = []
+        writers = []
+        for i, target in enumerate(targets):
+            chunks = Queue.Queue(max_chunks)
+            t = threading.Thread(target=self._relay_writer, args=(
+                target, target_filename, chunks, results, i))
+            t.daemon = True
+            t.start()
+            queues.append(chunks)
+            writers.append(t)
+
+        try:
+            src = self.sftpclient.open(filename, 'rb')
+            try:
+                src.prefetch()
+                while True:
+                    chunk = src.read(chunk_size)
+                    for chunks in queues:
+                        chunks.put(chunk)
+                    if not chunk:
+                        break
+            finally:
+                src.close()
+        except Exception as err:
+            for chunks in queues:
+                chunks.put(err)
+
+        for t in writers:
+            t.join()
+        return results
+
+    @staticmethod
+    def _relay_writer(target, filename, chunks, results, index):
+        # keeps consuming the queue after a failure so the reader never blocks
+        dst, error, size = None, None, 0
+        try:
+            if not target.sftpclient:
+                raise ClientNotSetupException(
+                    'Cannot relay file. Client not initialized')
+            dst = target.sftpclient.open(filename, 'wb')
+            dst.set_pipelined(True)
+        except Exception as err:
+            error = err
+
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                error = error or chunk
+                break
+            if not chunk:
+                break
+            if error is None:
+                try:
+                    dst.write(chunk)
+                    size += len(chunk)
+                except Exception as err:
+                    error = err
+
+        if dst is not None:
+            try:
+                dst.close()
+            except Exception as err:
+                error = error or err
+        results[index] = (False, error) if error else (True, size)
+
+    def _tar_channel(self, command):
+        if not self.client:
+            raise ClientNotSetupException(
+                'Cannot run procedure. Client not initialized')
+        return self.client.exec_command(command)
+
+    @staticmethod
+    def _tar_status(cout, cerr):
+        status = cout.channel.recv_exit_status()
+        if status:
+            return False, cerr.read().strip() or \
+                'tar exited with status {0}'.format(status)
+        return True, None
+
+    def push_tree(self, local_dir, remote_dir, include=None, exclude=None):
+        """Uploads the files of a local directory to the remote server as a
+        single compressed tar stream over one channel.
+
+        Args:
+            local_dir (string): local directory to upload
+            remote_dir (string): remote directory to extract the files in,
+                it is created if it doesn't exist
+            include (list, optional): fnmatch patterns of files to upload
+            exclude (list, optional): fnmatch patterns of files to skip
+
+        Returns:
+            tuple: True/False, list of the uploaded files / error
+        """
+        started = time.time()
+        cin, cout, cerr = self._tar_channel(
+            'mkdir -p {0} && tar -xzf - -C {0}'.format(pipes.quote(remote_dir)))
+        pushed = []
+        sent = 0
+        try:
+            tar = tarfile.open(fileobj=cin, mode='w|gz')
+            for root, dirs, files in os.walk(local_dir):
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    arcname = os.path.relpath(path, local_dir)
+                    if tree_member_selected(arcname, include, exclude):
+                        tar.add(path, arcname)
+                        pushed.append(arcname)
+                        sent += os.path.getsize(path)
+            tar.close()
+            cin.flush()
+            cin.channel.shutdown_write()
+        except (IOError, OSError, SSHException, socket.error) as err:
+            cin.channel.close()
+            return False, err
+
+        status, err = self._tar_status(cout, cerr)
+        record_step(self.host, 'upload', remote_dir, started,
+                    exit_status=0 if status else 1, sent=sent)
+        return (True, pushed) if status else (False, err)
+
+    def pull_tree(self, remote_dir, local_dir, include=None, exclude=None):
+        """Downloads the files of a remote directory as a single compressed
+        tar stream over one channel.
+
+        Args:
+            remote_dir (string): remote directory to download
+            local_dir (string): local directory to extract the files in
+            include (list, optional): fnmatch patterns of files to download
+            exclude (list, optional): fnmatch patterns of files to skip
+
+        Returns:
+            tuple: True/False, list of the downloaded files / error
+        """
+        started = time.time()
+        cin, cout, cerr = self._tar_channel(
+            'tar -czf - -C {0} .'.format(pipes.quote(remote_dir)))
+        cin.close()
+        pulled = []
+        received = 0
+        try:
+            tar = tarfile.open(fileobj=cout, mode='r|gz')
+            for member in tar:
+                name = os.path.normpath(member.name)
+                if not member.isfile() or name.startswith('..') or \
+                        os.path.isabs(name) or \
+                        not tree_member_selected(name, include, exclude):
+                    continue
+                path = os.path.join(local_dir, name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'wb') as f:
+                    f.write(tar.extractfile(member).read())
+                pulled.append(name)
+                received += member.size
+            tar.close()
+        except (IOError, OSError, tarfile.TarError, SSHException,
+                socket.error) as err:
+            return False, err
+
+        status, err = self._tar_status(cout, cerr)
+        record_step(self.host, 'download', remote_dir, started,
+                    exit_status=0 if status else 1, received=received)
+        return (True, pulled) if status else (False, err)
+
+    def relay_tree(self, remote_dir, target, target_dir, include=None,
+                   exclude=None):
+        """Copies the files of a directory of this server to another server,
+        streaming the tar from one channel into the other without storing it
+        locally.
+
+        Args:
+            remote_dir (string): directory in this server to copy
+            target (:class:`RemoteClient`): client of the destination server
+            target_dir (string): directory to extract the files in the
+                destination server, it is created if it doesn't exist
+            include (list, optional): fnmatch patterns of files to copy
+            exclude (list, optional): fnmatch patterns of files to skip
+
+        Returns:
+            tuple: True/False, list of the copied files / error
+        """
+        sin, sout, serr = self._tar_channel(
+            'tar -czf - -C {0} .'.format(pipes.quote(remote_dir)))
+        sin.close()
+        tin, tout, terr = target._tar_channel(
+            'mkdir -p {0} && tar -xzf - -C {0}'.format(pipes.quote(target_dir)))
+        try:
+            src = tarfile.open(fileobj=sout, mode='r|gz')
+            dst = tarfile.open(fileobj=tin, mode='w|gz')
+            copied = copy_tar_members(src, dst, include, exclude)
+            dst.close()
+            src.close()
+            tin.flush()
+            tin.channel.shutdown_write()
+        except (IOError, OSError, tarfile.TarError, SSHException,
+                socket.error) as err:
+            sout.channel.close()
+            tin.channel.close()
+            return False, err
+
+        for cout, cerr in ((sout, serr), (tout, terr)):
+            status, err = self._tar_status(cout, cerr)
+            if not status:
+                return False, err
+        return True, copied
+
     def mkdir(self,  dirname):
         """Creates a new directory.
 
@@ -218,11 +1431,297 @@ class RemoteClient(object):
         except Exception as err:
             return False, err
 
+    def is_alive(self):
+        """Checks whether the SSH transport of the client is still usable by
+        sending a keepalive packet over it.
+
+        Returns:
+            True if the transport is active and accepted the keepalive,
+            False otherwise
+        """
+        if not self.client or not self.sftpclient:
+            return False
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (SSHException, socket.error, EOFError):
+            return False
+        return True
+
+    def container_session(self, container, console=False):
+        """Returns the :class:`ContainerSession` of the container, which is
+        kept open for the following calls while the client is alive.
+
+        Args:
+            container (string): path of the container
+            console (boolean, optional): whether to enter the container
+                through its SSH console instead of chroot
+
+        Returns:
+            :class:`ContainerSession`
+        """
+        key = (container, bool(console))
+        with self._running_lock:
+            if key not in self._sessions:
+                self._sessions[key] = ContainerSession(self, container,
+                                                       bool(console))
+            return self._sessions[key]
+
     def close(self):
         """Close the SSH Connection
         """
+        for session in self._sessions.values():
+            session.guard = None
+        self._sessions = {}
         self.client.close()
 
     def __repr__(self):
         return "RemoteClient({0}, ip={1}, user={2})".format(self.host, self.ip,
                                                             self.user)
+
+
+
+class RemoteClientPool(object):
+    """A process wide pool of connected :class:`RemoteClient` sessions.
+
+    Celery tasks talk to the same handful of servers over and over. Instead of
+    paying for a TCP connection, SSH handshake and SFTP subsystem every time,
+    tasks borrow a live session from the pool which is keyed by
+    (host, ip, user). Sessions are checked with a keepalive before being
+    handed out and are transparently reconnected if the transport died.
+    Every get() must be paired with a release(), as the pool counts the
+    borrowers of every session. Sessions which have no borrower and have not
+    been used for `ttl` seconds are closed. Functions decorated with
+    releasing() have the sessions they borrowed released when they return.
+
+    A watchdog thread kills the commands which overran their deadline by
+    more than a grace period, for instance because the task reading them is
+    stuck elsewhere, and closes their session so that the worker is freed.
+
+    Configuration:
+        SSH_POOL_TTL - seconds a session can stay idle in the pool before it
+        is closed. Defaults to 300.
+        SSH_COMMAND_TIMEOUT - default timeout in seconds of the commands run
+        with the pooled clients. Defaults to None, no timeout.
+        SSH_WATCHDOG_INTERVAL - seconds between the checks for stuck
+        commands. Defaults to 60, 0 disables the watchdog.
+        SSH_WATCHDOG_GRACE - seconds a command may overrun its deadline
+        before the watchdog reaps it. Defaults to 30.
+
+    Initialization::
+
+        rcpool = RemoteClientPool()
+        rcpool.init_app(app)
+
+        c = rcpool.get(server.hostname, ip=server.ip)
+        c.run('hostname')
+        rcpool.release(c)
+
+        @rcpool.releasing
+        def task(server):
+            c = rcpool.get(server.hostname, ip=server.ip)
+            c.run('hostname')
+    """
+
+    def __init__(self, app=None, ttl=300, command_timeout=None,
+                 watchdog_interval=60, watchdog_grace=30):
+        self.ttl = ttl
+        self.command_timeout = command_timeout
+        self.watchdog_interval = watchdog_interval
+        self.watchdog_grace = watchdog_grace
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._watchdog = None
+        self._watchdog_pid = None
+        self._scope = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('SSH_POOL_TTL', self.ttl)
+        self.command_timeout = app.config.get('SSH_COMMAND_TIMEOUT',
+                                              self.command_timeout)
+        self.watchdog_interval = app.config.get('SSH_WATCHDOG_INTERVAL',
+                                                self.watchdog_interval)
+        self.watchdog_grace = app.config.get('SSH_WATCHDOG_GRACE',
+                                             self.watchdog_grace)
+
+    def get(self, host, ip=None, user='root'):
+        """Returns a connected client for the host, reusing a pooled session
+        when it is still alive.
+
+        Args:
+            host (string): hostname of the server
+            ip (string, optional): ip address used as connection fallback
+            user (string, optional): user to connect as. Defaults to root
+
+        Returns:
+            :class:`RemoteClient` with an active SSH and SFTP session
+
+        Raises:
+            ClientNotSetupException: when a new connection cannot be made
+        """
+        key = (host, ip, user)
+        self.evict_idle()
+        self._start_watchdog()
+
+        with self._lock:
+            entry = self._sessions.get(key)
+
+        if entry:
+            client = entry[0]
+            if client.is_alive():
+                logging.debug("Reusing pooled SSH session for %s", host)
+                with self._lock:
+                    entry[1] = time.time()
+                    entry[2] += 1
+                return self._borrowed(client)
+            logging.debug("Pooled SSH session for %s is dead. Reconnecting",
+                          host)
+            self.discard(client)
+
+        client = RemoteClient(host, ip=ip, user=user)
+        client.command_timeout = self.command_timeout
+        client.startup()
+        self._store(key, client)
+        return self._borrowed(client)
+
+    def _borrowed(self, client):
+        # the client is released at the end of the releasing() scope of the
+        # thread, if any
+        clients = getattr(self._scope, 'clients', None)
+        if clients is not None:
+            clients.append(client)
+        return client
+
+    @contextmanager
+    def borrowing(self):
+        """Releases the sessions the current thread gets from the pool inside
+        the block, and has not released yet, when the block ends.
+        """
+        outer = getattr(self._scope, 'clients', None)
+        self._scope.clients = []
+        try:
+            yield
+        finally:
+            clients, self._scope.clients = self._scope.clients, outer
+            for client in clients:
+                self.release(client)
+
+    def releasing(self, func):
+        """Decorator running the function inside borrowing(), for the tasks
+        not to leave sessions borrowed whichever way they return.
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.borrowing():
+                return func(*args, **kwargs)
+        return wrapper
+
+    def release(self, client):
+        """Returns the client borrowed with get() to the pool, where it stays
+        for another `ttl` seconds once nobody else borrows it. Clients not
+        created by the pool are closed.
+
+        Args:
+            client (:class:`RemoteClient`): the client returned by get()
+        """
+        clients = getattr(self._scope, 'clients', None)
+        if clients and client in clients:
+            clients.remove(client)
+        key = (client.host, client.ip, client.user)
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry and entry[0] is client:
+                entry[1] = time.time()
+                entry[2] = max(entry[2] - 1, 0)
+                return
+        client.close()
+
+    def discard(self, client):
+        """Removes the client from the pool and closes its connection.
+
+        Args:
+            client (:class:`RemoteClient`): the client to be discarded
+        """
+        key = (client.host, client.ip, client.user)
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry and entry[0] is client:
+                del self._sessions[key]
+        client.close()
+
+    def evict_idle(self):
+        """Closes the sessions which are not borrowed and have been idle for
+        longer than the ttl.
+
+        Returns:
+            the number of sessions evicted
+        """
+        now = time.time()
+        with self._lock:
+            stale = [k for k, (_, used, borrowed) in self._sessions.items()
+                     if not borrowed and now - used > self.ttl]
+            clients = [self._sessions.pop(k)[0] for k in stale]
+
+        for client in clients:
+            logging.debug("Closing idle SSH session for %s", client.host)
+            client.close()
+        return len(clients)
+
+    def reap_stuck(self):
+        """Kills the commands which are running past their deadline plus the
+        watchdog grace and discards their sessions. Closing the session makes
+        the reads blocked on it fail, which frees the worker running them.
+
+        Returns:
+            the number of commands reaped
+        """
+        with self._lock:
+            clients = [entry[0] for entry in self._sessions.values()]
+
+        reaped = 0
+        for client in clients:
+            stuck = client.stuck_commands(self.watchdog_grace)
+            if not stuck:
+                continue
+            for command in stuck:
+                command.abort()
+            reaped += len(stuck)
+            self.discard(client)
+        return reaped
+
+    def _start_watchdog(self):
+        # threads do not survive a fork, so every worker process starts its own
+        if not self.watchdog_interval:
+            return
+        with self._lock:
+            if self._watchdog_pid == os.getpid() and self._watchdog.is_alive():
+                return
+            self._watchdog = threading.Thread(target=self._watch)
+            self._watchdog.daemon = True
+            self._watchdog_pid = os.getpid()
+            self._watchdog.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.watchdog_interval)
+            try:
+                self.reap_stuck()
+            except Exception:
+                logging.exception("SSH watchdog failed to reap commands")
+
+    def close_all(self):
+        """Closes all the sessions in the pool."""
+        with self._lock:
+            clients = [entry[0] for entry in self._sessions.values()]
+            self._sessions = {}
+        for client in clients:
+            client.close()
+
+    def _store(self, key, client):
+        with self._lock:
+            # the client, when it was last used and how many borrow it
+            self._sessions[key] = [client, time.time(), 1]
@@ -0,0 +1,78 @@
+"""snapshots.py - last known replication status of the LDAP servers.
+"""
+import json
+import time
+
+import redis
+
+
+class ReplicationSnapshots(object):
+    """Keeps the last snapshot of the replication status of the LDAP servers
+    in Redis, so that the pages can show it without searching the cn=config
+    of every server. The snapshots are taken periodically by a beat task and
+    on demand, refer :func:`clustermgr.core.ldap_functions.mmr_status`.
+
+    A snapshot is a dict with the time it was `taken_at` and the status of
+    the `servers` by hostname.
+
+    Configuration:
+        MMR_STATUS_MAX_AGE - seconds after which a snapshot is too old to be
+        shown and a new one is taken. Defaults to 300.
+
+    Initialization::
+
+        mmrsnapshots = ReplicationSnapshots()
+        mmrsnapshots.init_app(app)
+    """
+
+    def __init__(self, app=None, max_age=300):
+        self.r = redis.Redis()
+        self.key = 'clustermgr:mmr:status'
+        self.max_age = max_age
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.key = "{0}:mmr:status".format(app.name)
+        self.max_age = app.config.get('MMR_STATUS_MAX_AGE', self.max_age)
+        self.r.connection_pool.disconnect()
+        self.r = redis.Redis(host=app.config['REDIS_HOST'],
+                             port=app.config['REDIS_PORT'],
+                             db=app.config['REDIS_LOG_DB'])
+
+    def get(self):
+        """Returns the last snapshot, or None when none was taken."""
+        snapshot = self.r.get(self.key)
+        return json.loads(snapshot) if snapshot else None
+
+    def store(self, servers):
+        """Stores the status of the servers as the last snapshot.
+
+        Args:
+            servers (dict): the status of every server by hostname
+
+        Returns:
+            the snapshot stored
+        """
+        snapshot = {'taken_at': time.time(), 'servers': servers}
+        self.r.set(self.key, json.dumps(snapshot))
+        return snapshot
+
+    def clear(self):
+        """Drops the last snapshot, for the next reader to take a new one.
+        Meant to be called once the replication has been changed."""
+        self.r.delete(self.key)
+
+    def is_fresh(self, snapshot, hostnames):
+        """Tells whether the snapshot can still be shown for the servers.
+
+        Args:
+            snapshot (dict): a snapshot returned by get()
+            hostnames (list): the hostnames of the servers in the cluster, a
+                snapshot which misses some or has removed ones is not fresh
+        """
+        if not snapshot:
+            return False
+        if set(snapshot['servers']) != set(hostnames):
+            return False
+        return time.time() - snapshot['taken_at'] <= self.max_age
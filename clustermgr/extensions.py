@@ -3,6 +3,9 @@ from flask_migrate import Migrate
 from celery import Celery
 
 from .weblogger import WebLogger
+from .core.remote import RemoteClientPool
+from .core.ldap_pool import LdapConnectionPool
+from .core.snapshots import ReplicationSnapshots
 
 from clustermgr.config import Config
 
@@ -17,6 +20,9 @@ db = SQLAlchemy()
 csrf = CSRFProtect()
 migrate = Migrate()
 wlogger = WebLogger()
+rcpool = RemoteClientPool()
+ldappool = LdapConnectionPool()
+mmrsnapshots = ReplicationSnapshots()
 celery = Celery('clustermgr.application', backend=Config.CELERY_RESULT_BACKEND,
                 broker=Config.CELERY_BROKER_URL
                 )
@@ -149,3 +149,73 @@ class LoggingServer(db.Model):
 
     # # encrypted password; need to decrypt it before using the value
     # mq_password = db.Column(db.String(255))
+
+
+class TaskRun(db.Model):
+    __tablename__ = "task_run"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # id of the celery task
+    task_id = db.Column(db.String(50), unique=True)
+
+    # name of the celery task like clustermgr.tasks.cluster.installGluuServer
+    name = db.Column(db.String(250), index=True)
+
+    # final celery state of the task, None while it runs
+    state = db.Column(db.String(20))
+
+    started_at = db.Column(db.DateTime)
+    ended_at = db.Column(db.DateTime)
+
+    steps = db.relationship("TaskStep", backref="run", lazy="dynamic",
+                            cascade="all, delete-orphan")
+
+    @property
+    def duration(self):
+        if not self.ended_at:
+            return None
+        return (self.ended_at - self.started_at).total_seconds()
+
+    def __repr__(self):
+        return '<TaskRun %s %s>' % (self.name, self.task_id)
+
+
+class TaskStep(db.Model):
+    __tablename__ = "task_step"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    task_run_id = db.Column(db.Integer, db.ForeignKey("task_run.id"),
+                            index=True)
+
+    # hostname of the server the step was done in
+    host = db.Column(db.String(250))
+
+    # command, upload, download or phase
+    kind = db.Column(db.String(20))
+
+    # operating system of the server, kept for the phases of the tasks to
+    # estimate them by it
+    os = db.Column(db.String(150))
+
+    # the command run, the remote path of the file transferred or the label
+    # of the phase
+    command = db.Column(db.Text)
+
+    started_at = db.Column(db.DateTime)
+    ended_at = db.Column(db.DateTime)
+
+    # seconds taken by the step, kept apart for sorting by it
+    duration = db.Column(db.Float, index=True)
+
+    # exit status of the command, None if it was killed or not known
+    exit_status = db.Column(db.Integer)
+
+    # bytes sent to and received from the server
+    bytes_sent = db.Column(db.Integer)
+    bytes_received = db.Column(db.Integer)
+
+    def __repr__(self):
+        return '<TaskStep %s %s %.1fs>' % (self.host, self.kind,
+                                           self.duration or 0)
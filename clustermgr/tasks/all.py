@@ -5,11 +5,12 @@ from datetime import datetime
 from ldap3 import Connection, BASE, MODIFY_REPLACE
 from ldap3 import Server as Ldap3Server
 
-from clustermgr.extensions import celery, db
+from clustermgr.extensions import celery, db, rcpool, wlogger
 from clustermgr.models import Server, KeyRotation, OxelevenKeyID
 from clustermgr.core.utils import decrypt_text, random_chars
 from clustermgr.core.ox11 import generate_key, delete_key
 from clustermgr.core.keygen import generate_jks
+from clustermgr.core.fanout import fan_out
 
 
 def starttls(server):
@@ -155,16 +156,18 @@ def _rotate_keys(kr, javalibs_dir, jks_path):
         db.session.commit()
 
         if kr.type == "jks":
-            from clustermgr.core.remote import RemoteClient
-            for server in Server.query:
-                c = RemoteClient(server.hostname)
+            def copy_jks(server):
                 try:
-                    c.startup()
+                    c = rcpool.get(server.hostname)
                 except Exception:
                     print "Couldn't connect to server %s. Can't copy JKS" % server.hostname
-                    continue
-                c.upload(jks_path, server.jks_path)
-                c.close()
+                    return
+                try:
+                    c.upload(jks_path, server.jks_path)
+                finally:
+                    rcpool.release(c)
+
+            fan_out(copy_jks, Server.query.all())
 
 
 @celery.task
@@ -194,3 +197,10 @@ def setup_periodic_tasks(sender, **kwargs):
         schedule_key_rotation.s(),
         name='add every 30',
     )
+
+
+@celery.task
+def sweep_task_logs():
+    """Bounds the Redis memory used by the task logs, see WebLogger.sweep().
+    """
+    return wlogger.sweep()
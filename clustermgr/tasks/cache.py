@@ -6,9 +6,11 @@ import socket
 from StringIO import StringIO
 
 from clustermgr.models import Server, AppConfiguration
-from clustermgr.extensions import db, celery, wlogger
-from clustermgr.core.remote import RemoteClient
+from clustermgr.extensions import db, celery, wlogger, rcpool
 from clustermgr.core.ldap_functions import DBManager
+from clustermgr.core.fanout import fan_out
+from clustermgr.core.remote import CommandTimeout
+from clustermgr.core.history import TaskProgress
 from clustermgr.tasks.cluster import get_os_type
 
 from ldap3.core.exceptions import LDAPSocketOpenError
@@ -27,8 +29,9 @@ class BaseInstaller(object):
     def __init__(self, server, tid):
         self.server = server
         self.tid = tid
-        self.rc = RemoteClient(server.hostname, ip=server.ip)
+        self.rc = None
 
+    @rcpool.releasing
     def install(self):
         """install() detects the os of the server and calls the appropriate
         function to install redis on that server.
@@ -37,7 +40,7 @@ class BaseInstaller(object):
             boolean status of the install process
         """
         try:
-            self.rc.startup()
+            self.rc = rcpool.get(self.server.hostname, ip=self.server.ip)
         except Exception as e:
             wlogger.log(self.tid, "Could not connect to {0}".format(e),
                         "error", server_id=self.server.id)
@@ -55,7 +58,7 @@ class BaseInstaller(object):
         else:
             wlogger.log(self.tid, "Server OS is not supported. {0}".format(
                 cout), "error", server_id=self.server.id)
-        self.rc.close()
+        rcpool.release(self.rc)
         return status
 
     def install_in_ubuntu(self):
@@ -77,8 +80,8 @@ class BaseInstaller(object):
         pass
 
     def run_command(self, cmd):
-        wlogger.log(self.tid, cmd, "debug", server_id=self.server.id)
-        return self.rc.run(cmd)
+        stream = _stream_and_log(self.rc, cmd, self.tid, self.server.id)
+        return None, stream.stdout, stream.stderr
 
 
 class RedisInstaller(BaseInstaller):
@@ -93,9 +96,6 @@ class RedisInstaller(BaseInstaller):
         self.run_command("add-apt-repository ppa:chris-lea/redis-server -y")
         self.run_command("apt-get update")
         cin, cout, cerr = self.run_command("apt-get install redis-server -y")
-        wlogger.log(self.tid, cout, "debug", server_id=self.server.id)
-        if cerr:
-            wlogger.log(self.tid, cerr, "cerror", server_id=self.server.id)
         # verifying that redis-server is succesfully installed
         cin, cout, cerr = self.rc.run("apt-get install redis-server -y")
 
@@ -112,9 +112,6 @@ class RedisInstaller(BaseInstaller):
         self.run_command("yum update -y")
 
         cin, cout, cerr = self.run_command("yum install redis -y")
-        wlogger.log(self.tid, cout, "debug", server_id=self.server.id)
-        if cerr:
-            wlogger.log(self.tid, cerr, "cerror", server_id=self.server.id)
         # verifying installation
         cin, cout, cerr = self.rc.run("yum install redis -y")
         if "already installed" in cout:
@@ -127,9 +124,6 @@ class StunnelInstaller(BaseInstaller):
     def install_in_ubuntu(self):
         self.run_command("apt-get update")
         cin, cout, cerr = self.run_command("apt-get install stunnel4 -y")
-        wlogger.log(self.tid, cout, "debug", server_id=self.server.id)
-        if cerr:
-            wlogger.log(self.tid, cerr, "cerror", server_id=self.server.id)
 
         # Verifying installation by trying to reinstall
         cin, cout, cerr = self.rc.run("apt-get install stunnel4 -y")
@@ -141,9 +135,6 @@ class StunnelInstaller(BaseInstaller):
     def install_in_centos(self):
         self.run_command("yum update -y")
         cin, cout, cerr = self.run_command("yum install stunnel -y")
-        wlogger.log(self.tid, cout, "debug", server_id=self.server.id)
-        if cerr:
-            wlogger.log(self.tid, cerr, "cerror", server_id=self.server.id)
         # verifying installation
         cin, cout, cerr = self.rc.run("yum install stunnel -y")
         if "already installed" in cout:
@@ -152,7 +143,17 @@ class StunnelInstaller(BaseInstaller):
             return False
 
 
+CACHE_PHASES = (
+    'Installing Redis and Stunnel on the servers',
+    'Installing Stunnel on the proxy',
+    'Preparing the build tools',
+    'Building Twemproxy',
+    'Installing the Twemproxy service',
+)
+
+
 @celery.task(bind=True)
+@rcpool.releasing
 def install_cache_components(self, method):
     """Celery task that installs the redis, stunnel and twemproxy applications
     in the required servers.
@@ -167,19 +168,19 @@ def install_cache_components(self, method):
         successfully
     """
     tid = self.request.id
-    installed = 0
     servers = Server.query.all()
-    for server in servers:
+    phases = CACHE_PHASES if method == 'STANDALONE' else CACHE_PHASES[:1]
+    progress = TaskProgress(tid, self.name, phases)
+
+    def install_in_server(server):
         wlogger.log(tid, "Installing Redis in server {0}".format(
             server.hostname), "info", server_id=server.id)
         ri = RedisInstaller(server, tid)
         redis_installed = ri.install()
         if redis_installed:
-            server.redis = True
             wlogger.log(tid, "Redis install successful", "success",
                         server_id=server.id)
         else:
-            server.redis = False
             wlogger.log(tid, "Redis install failed", "fail",
                         server_id=server.id)
 
@@ -187,37 +188,47 @@ def install_cache_components(self, method):
         si = StunnelInstaller(server, tid)
         stunnel_installed = si.install()
         if stunnel_installed:
-            server.stunnel = True
             wlogger.log(tid, "Stunnel install successful", "success",
                         server_id=server.id)
         else:
-            server.stunnel = False
             wlogger.log(tid, "Stunnel install failed", "fail",
                         server_id=server.id)
-        # Save the redis and stunnel install situation to the db
-        db.session.commit()
+        return bool(redis_installed), bool(stunnel_installed)
 
+    progress.step('Installing Redis and Stunnel on the servers')
+    results = fan_out(install_in_server, servers, tid=tid, logger=wlogger)
+    # Save the redis and stunnel install situation to the db
+    installed = 0
+    for result in results:
+        redis_installed, stunnel_installed = result.value or (False, False)
+        result.item.redis = redis_installed
+        result.item.stunnel = stunnel_installed
         if redis_installed and stunnel_installed:
             installed += 1
+    db.session.commit()
 
     if method != 'STANDALONE':
         # No need to install twemproxy for "SHARDED" configuration
+        progress.done()
         return True
 
     # Install twemproxy in the Nginx load balancing proxy server
     app_conf = AppConfiguration.query.first()
     host = app_conf.nginx_host
-    rc = RemoteClient(host)
     try:
-        rc.startup()
+        rc = rcpool.get(host)
     except Exception as e:
         wlogger.log(tid, "Could not connect to {0}".format(e), "error")
         return False
 
     server_os = get_os_type(rc)
+    # the remaining phases are done in the proxy server
+    progress.os_type = server_os
+    progress.host = host
 
     mock_server = Server()
     mock_server.hostname = host
+    progress.step('Installing Stunnel on the proxy')
     wlogger.log(tid, "Installing Stunnel in proxy server")
     si = StunnelInstaller(mock_server, tid)
     stunnel_installed = si.install()
@@ -228,71 +239,81 @@ def install_cache_components(self, method):
 
     wlogger.log(tid, "Cluster manager will now try to build Twemproxy")
     # 1. Setup the development tools for installation
+    progress.step('Preparing the build tools')
     if server_os in ["Ubuntu 16", "Ubuntu 14"]:
-        run_and_log(rc, "apt-get update", tid)
-        run_and_log(rc, "apt-get install -y build-essential autoconf libtool",
-                    tid)
+        run_batch_and_log(rc, [
+            "apt-get update",
+            "apt-get install -y build-essential autoconf libtool",
+        ], tid)
     elif server_os in ["CentOS 6", "CentOS 7", "RHEL 7"]:
-        run_and_log(rc, "yum install -y wget", tid)
-        run_and_log(rc, "yum groupinstall -y 'Development tools'", tid)
+        run_batch_and_log(rc, [
+            "yum install -y wget",
+            "yum groupinstall -y 'Development tools'",
+        ], tid)
 
     if server_os == "CentOS 6":
-        run_and_log(rc, "wget http://ftp.gnu.org/gnu/autoconf/autoconf-2.69.tar.gz",
-                    tid)
-        run_and_log(rc, "tar xvfvz autoconf-2.69.tar.gz", tid)
-        run_and_log(rc, "cd autoconf-2.69 && ./configure", tid)
-        run_and_log(rc, "cd autoconf-2.69 && make", tid)
-        run_and_log(rc, "cd autoconf-2.69 && make install", tid)
+        run_batch_and_log(rc, [
+            "wget http://ftp.gnu.org/gnu/autoconf/autoconf-2.69.tar.gz",
+            "tar xvfvz autoconf-2.69.tar.gz",
+            "cd autoconf-2.69 && ./configure",
+            "cd autoconf-2.69 && make",
+            "cd autoconf-2.69 && make install",
+        ], tid, stop_on_error=True)
 
     # 2. Get the source, build & install the nutcracker binaries
-    run_and_log(rc, "wget https://github.com/twitter/twemproxy/archive/v0.4.1.tar.gz",
-                tid)
-    run_and_log(rc, "tar -xf v0.4.1.tar.gz", tid)
-    run_and_log(rc, "cd twemproxy-0.4.1", tid)
-    run_and_log(rc, "cd twemproxy-0.4.1 && autoreconf -fvi", tid)
-    run_and_log(rc, "cd twemproxy-0.4.1 && ./configure --prefix=/usr", tid)
-    run_and_log(rc, "cd twemproxy-0.4.1 && make", tid)
-    run_and_log(rc, "cd twemproxy-0.4.1 && make install", tid)
+    progress.step('Building Twemproxy')
+    run_batch_and_log(rc, [
+        "wget https://github.com/twitter/twemproxy/archive/v0.4.1.tar.gz",
+        "tar -xf v0.4.1.tar.gz",
+        "cd twemproxy-0.4.1 && autoreconf -fvi",
+        "cd twemproxy-0.4.1 && ./configure --prefix=/usr",
+        "cd twemproxy-0.4.1 && make",
+        "cd twemproxy-0.4.1 && make install",
+    ], tid, stop_on_error=True)
 
     # 3. Post installation - setup user and logging
-    run_and_log(rc, "useradd nutcracker", tid)
-    run_and_log(rc, "mkdir /var/log/nutcracker", tid)
-    run_and_log(rc, "touch /var/log/nutcracker/nutcracker.log", tid)
-    run_and_log(rc, "chown -R nutcracker:nutcracker /var/log/nutcracker",
-                tid)
+    progress.step('Installing the Twemproxy service')
+    run_batch_and_log(rc, [
+        "useradd nutcracker",
+        "mkdir /var/log/nutcracker",
+        "touch /var/log/nutcracker/nutcracker.log",
+        "chown -R nutcracker:nutcracker /var/log/nutcracker",
+    ], tid)
     logrotate_conf = ["/var/log/nutcracker/nutcracker*.log {", "\tweekly",
                       "\tmissingok", "\trotate 12", "\tcompress",
                       "\tnotifempty", "}"]
-    rc.put_file("/etc/logrotate.d/nutcracker", "\n".join(logrotate_conf))
+    rc.sync_file("/etc/logrotate.d/nutcracker",
+                 content="\n".join(logrotate_conf))
 
     # 4. Add init/service scripts to run nutcracker as a service
     if server_os in ["Ubuntu 16", "CentOS 7", "RHEL 7"]:
         local = os.path.join(app.root_path, "templates", "twemproxy",
                              "twemproxy.service")
         remote = "/lib/systemd/system/nutcracker.service"
-        rc.upload(local, remote)
+        rc.sync_file(remote, local_path=local)
         run_and_log(rc, "systemctl enable nutcracker", tid, None)
     elif server_os == "Ubuntu 14":
         local = os.path.join(app.root_path, "templates", "twemproxy",
                              "nutcracker.init")
         remote = "/etc/init.d/nutcracker"
-        rc.upload(local, remote)
-        run_and_log(rc, 'chmod +x /etc/init.d/nutcracker', tid)
-        run_and_log(rc, "update-rc.d nutcracker defaults", tid)
+        rc.sync_file(remote, local_path=local)
+        run_batch_and_log(rc, ['chmod +x /etc/init.d/nutcracker',
+                               "update-rc.d nutcracker defaults"], tid)
     elif server_os == "CentOS 6":
         local = os.path.join(app.root_path, "templates", "twemproxy",
                              "nutcracker.centos.init")
         remote = "/etc/rc.d/init.d/nutcracker"
-        rc.upload(local, remote)
-        run_and_log(rc, "chmod +x /etc/init.d/nutcracker", tid)
-        run_and_log(rc, "chkconfig --add nutcracker", tid)
-        run_and_log(rc, "chkconfig nutcracker on", tid)
+        rc.sync_file(remote, local_path=local)
+        run_batch_and_log(rc, ["chmod +x /etc/init.d/nutcracker",
+                               "chkconfig --add nutcracker",
+                               "chkconfig nutcracker on"], tid)
 
     # 5. Create the default configuration file referenced in the init scripts
-    run_and_log(rc, "mkdir -p /etc/nutcracker", tid)
-    run_and_log(rc, "touch /etc/nutcracker/nutcracker.yml", tid)
+    run_batch_and_log(rc, ["mkdir -p /etc/nutcracker",
+                           "touch /etc/nutcracker/nutcracker.yml"], tid)
 
-    rc.close()
+    rcpool.release(rc)
+    progress.done()
     return installed
 
 
@@ -314,8 +335,8 @@ def setup_sharded(tid):
         Server.stunnel.is_(True)).all()
     appconf = AppConfiguration.query.first()
     chdir = "/opt/gluu-server-" + appconf.gluu_version
-    # Store the redis server info in the LDA
-    for server in servers:
+    # Store the redis server info in the LDAP
+    def setup_server(server):
         redis_instances = []
         stunnel_conf = [
             "cert = /etc/stunnel/cert.pem",
@@ -337,11 +358,13 @@ def setup_sharded(tid):
 
         connect_to = ",".join(redis_instances)
         __update_LDAP_cache_method(tid, server, connect_to, 'SHARDED')
-        stat = __configure_stunnel(tid, server, stunnel_conf, chdir)
-        if not stat:
-            continue
+        return __configure_stunnel(tid, server, stunnel_conf, chdir)
+
+    results = fan_out(setup_server, servers, tid=tid, logger=wlogger)
+    __save_os_types(results)
 
 
+@rcpool.releasing
 def __configure_stunnel(tid, server, stunnel_conf, chdir, setup_props=None):
     """Sets up Stunnel with given configuration, init or service scripts,
     SSL certificate ...etc., for use in a server
@@ -354,7 +377,8 @@ def __configure_stunnel(tid, server, stunnel_conf, chdir, setup_props=None):
         extract the required values to generate a SSL certificate
     :param setup_props: Optional - location of setup.properties file to get the
         details for SSL Cert generation for Stunnel
-    :return: boolean status fo the operation
+    :return: the OS type of the server if the setup succeeded, False
+        otherwise
     """
     wlogger.log(tid, "Setting up stunnel", "info", server_id=server.id)
     rc = __get_remote_client(server, tid)
@@ -362,8 +386,7 @@ def __configure_stunnel(tid, server, stunnel_conf, chdir, setup_props=None):
         wlogger.log(tid, "Stunnel setup failed", "error", server_id=server.id)
         return False
 
-    if not server.os:
-        server.os = get_os_type(rc)
+    server_os = server.os or get_os_type(rc)
 
     wlogger.log(tid, "Adding init/service scripts of boot time startup",
                 "info", server_id=server.id)
@@ -371,25 +394,25 @@ def __configure_stunnel(tid, server, stunnel_conf, chdir, setup_props=None):
     local = os.path.join(app.root_path, 'templates', 'stunnel',
                          'stunnel4.default')
     remote = '/etc/default/stunnel4'
-    rc.upload(local, remote)
+    rc.sync_file(remote, local_path=local)
 
-    if 'CentOS 6' == server.os:
+    if 'CentOS 6' == server_os:
         local = os.path.join(app.root_path, 'templates', 'stunnel',
                              'centos.init')
         remote = '/etc/rc.d/init.d/stunnel4'
-        rc.upload(local, remote)
+        rc.sync_file(remote, local_path=local)
         rc.run("chmod +x {0}".format(remote))
 
-    if 'CentOS 7' == server.os or 'RHEL 7' == server.os:
+    if 'CentOS 7' == server_os or 'RHEL 7' == server_os:
         local = os.path.join(app.root_path, 'templates', 'stunnel',
                              'stunnel.service')
         remote = '/lib/systemd/system/stunnel.service'
-        rc.upload(local, remote)
+        rc.sync_file(remote, local_path=local)
         rc.run("mkdir -p /var/log/stunnel4")
         wlogger.log(tid, "Setup auto-start on system boot", "info",
                     server_id=server.id)
-        run_and_log(rc, 'systemctl enable redis', tid, server.id)
-        run_and_log(rc, 'systemctl enable stunnel', tid, server.id)
+        run_batch_and_log(rc, ['systemctl enable redis',
+                               'systemctl enable stunnel'], tid, server.id)
 
     # setup the certificate file
     wlogger.log(tid, "Generating certificate for stunnel ...", "debug",
@@ -448,8 +471,22 @@ def __configure_stunnel(tid, server, stunnel_conf, chdir, setup_props=None):
     # Generate stunnel config
     wlogger.log(tid, "Setup stunnel listening and forwarding", "debug",
                 server_id=server.id)
-    rc.put_file("/etc/stunnel/stunnel.conf", "\n".join(stunnel_conf))
-    return True
+    rc.sync_file("/etc/stunnel/stunnel.conf",
+                 content="\n".join(stunnel_conf))
+    return server_os
+
+
+def __save_os_types(results):
+    """Saves the OS types returned by :func:`__configure_stunnel` on the
+    servers. The servers are updated here and not in the fan out threads
+    as they share the database session of the task.
+
+    :param results: :class:`clustermgr.core.fanout.FanOutResult` of the setup
+    """
+    for result in results.succeeded:
+        if result.value:
+            result.item.os = result.value
+    db.session.commit()
 
 
 def __update_LDAP_cache_method(tid, server, server_string, method):
@@ -486,6 +523,7 @@ def __update_LDAP_cache_method(tid, server, server_string, method):
                     server_id=server.id)
 
 
+@rcpool.releasing
 def setup_proxied(tid):
     """Configures the servers to use the Twemproxy installed in proxy server
     for Redis caching securely via stunnel.
@@ -512,7 +550,7 @@ def setup_proxied(tid):
 
 
     # Setup Stunnel and Redis in each server
-    for server in servers:
+    def setup_server(server):
         __update_LDAP_cache_method(tid, server, 'localhost:7000', 'STANDALONE')
         stunnel_conf = [
             "[redis-server]",
@@ -525,10 +563,15 @@ def setup_proxied(tid):
             "connect = {0}:8888".format(proxy_ip)
         ]
         stunnel_conf = stunnel_base_conf + stunnel_conf
-        status = __configure_stunnel(tid, server, stunnel_conf, chdir)
-        if not status:
-            continue
+        return __configure_stunnel(tid, server, stunnel_conf, chdir)
 
+    results = fan_out(setup_server, servers, tid=tid, logger=wlogger)
+    __save_os_types(results)
+
+    for result in results.succeeded:
+        if not result.value:
+            continue
+        server = result.item
         # if the setup was successful add the server to the list of stunnel
         # clients in the proxy server configuration
         client_conf = [
@@ -558,8 +601,10 @@ def setup_proxied(tid):
                           "install", "community-edition-setup",
                           "setup.properties.last")
     prc = __get_remote_client(primary, tid)
+    if not prc:
+        return False
     prc.download(remote, local)
-    prc.close()
+    rcpool.release(prc)
     rc.upload(local, "/tmp/setup.properties")
 
     twem_server_conf = [
@@ -590,7 +635,7 @@ def setup_proxied(tid):
     ]
     twemproxy_conf.extend(twemproxy_servers)
     remote = "/etc/nutcracker/nutcracker.yml"
-    rc.put_file(remote, "\n".join(twemproxy_conf))
+    rc.sync_file(remote, content="\n".join(twemproxy_conf))
 
     wlogger.log(tid, "Configuration complete", "success")
 
@@ -619,20 +664,22 @@ def setup_redis_cluster(tid):
                   "logfile /var/log/redis/redis-7001.log",
                   "save 900 1", "save 300 10", "save 60 10000",
                   ]
-    for server in servers:
+    @rcpool.releasing
+    def setup_server(server):
         rc = __get_remote_client(server, tid)
         if not rc:
-            continue
+            return False
 
         # upload the conf files
         wlogger.log(tid, "Uploading redis conf files...", "debug",
                     server_id=server.id)
-        rc.put_file("/etc/redis/redis_7000.conf", "\n".join(master_conf))
-        rc.put_file("/etc/redis/redis_7001.conf", "\n".join(slave_conf))
+        rc.sync_file("/etc/redis/redis_7000.conf",
+                     content="\n".join(master_conf))
+        rc.sync_file("/etc/redis/redis_7001.conf",
+                     content="\n".join(slave_conf))
         # upload the modified init.d file
-        rc.upload(os.path.join(
-            app.root_path, "templates", "redis", "redis-server"),
-            "/etc/init.d/redis-server")
+        rc.sync_file("/etc/init.d/redis-server", local_path=os.path.join(
+            app.root_path, "templates", "redis", "redis-server"))
         wlogger.log(tid, "Configuration upload complete.", "success",
                     server_id=server.id)
 
@@ -644,7 +691,7 @@ def setup_redis_cluster(tid):
         except Exception as e:
             wlogger.log(tid, "Failed to connect to LDAP server. Error: \n"
                              "{0}".format(e), "error")
-            continue
+            return False
         entry = dbm.get_appliance_attributes('oxCacheConfiguration')
         cache_conf = json.loads(entry.oxCacheConfiguration.value)
         cache_conf['cacheProviderType'] = 'REDIS'
@@ -654,17 +701,18 @@ def setup_redis_cluster(tid):
         if not result:
             wlogger.log(tid, "oxCacheConfiguration update failed", "error",
                         server_id=server.id)
-        else:
-            wlogger.log(tid, "Cache configuration update successful in LDAP",
-                        "success", server_id=server.id)
+            return False
+        wlogger.log(tid, "Cache configuration update successful in LDAP",
+                    "success", server_id=server.id)
+        return True
 
+    fan_out(setup_server, servers, tid=tid, logger=wlogger)
     return True
 
 
 def __get_remote_client(server, tid):
-    rc = RemoteClient(server.hostname, ip=server.ip)
     try:
-        rc.startup()
+        rc = rcpool.get(server.hostname, ip=server.ip)
         wlogger.log(tid, "Connecting to server: {0}".format(server.hostname),
                     "success", server_id=server.id)
     except Exception as e:
@@ -678,49 +726,79 @@ def run_and_log(rc, cmd, tid, server_id=None):
     """Runs a command using the provided RemoteClient instance and logs the
     cout and cerr to the wlogger using the task id and server id
 
-    :param rc: the remote client to run the command
+    :param rc: the remote client to run the command, or a ContainerSession
+        to run it in a container
     :param cmd: command that has to be executed
     :param tid: the task id of the celery task for logging
     :param server_id: OPTIONAL id of the server in which the cmd is executed
     :return: nothing
+    :raises CommandTimeout: when the command runs past its deadline
     """
+    # the output is only logged, none of it needs to be kept
+    _stream_and_log(rc, cmd, tid, server_id, keep=0)
+
+
+def _stream_and_log(rc, cmd, tid, server_id=None, keep=None):
+    # streams the output of the command to the wlogger as it is produced and
+    # returns the CommandStream, which holds the output retained
     wlogger.log(tid, cmd, "debug", server_id=server_id)
-    _, cout, cerr = rc.run(cmd)
-    if cout:
-        wlogger.log(tid, cout, "debug", server_id=server_id)
-    if cerr:
-        wlogger.log(tid, cerr, "cerror", server_id=server_id)
+    # the command may run for long, show the log up to here meanwhile
+    wlogger.flush()
+    stream = rc.run_stream(cmd, keep=keep)
+    try:
+        for name, chunk in stream:
+            level = "debug" if name == 'stdout' else "cerror"
+            wlogger.log(tid, chunk, level, server_id=server_id)
+    except CommandTimeout as e:
+        wlogger.log(tid, "{0}. The command was killed.".format(e), "error",
+                    server_id=server_id)
+        raise
+    return stream
+
+
+def run_batch_and_log(rc, cmds, tid, server_id=None, stop_on_error=False):
+    """Runs a list of commands through a single SSH channel using the provided
+    RemoteClient instance and logs every command with its cout and cerr to the
+    wlogger using the task id and server id
+
+    :param rc: the remote client to run the commands
+    :param cmds: list of commands that have to be executed in order
+    :param tid: the task id of the celery task for logging
+    :param server_id: OPTIONAL id of the server in which the cmds are executed
+    :param stop_on_error: OPTIONAL stop at the first command that fails
+    :return: list of result dicts as returned by `RemoteClient.run_batch`
+    """
+    results = rc.run_batch(cmds, stop_on_error)
+    for result in results:
+        wlogger.log(tid, result['command'], "debug", server_id=server_id)
+        if result['stdout']:
+            wlogger.log(tid, result['stdout'], "debug", server_id=server_id)
+        if result['stderr']:
+            wlogger.log(tid, result['stderr'], "cerror", server_id=server_id)
+    return results
 
 
 @celery.task(bind=True)
+@rcpool.releasing
 def restart_services(self, method):
     tid = self.request.id
     servers = Server.query.filter(Server.redis.is_(True)).filter(
         Server.stunnel.is_(True)).all()
     appconf = AppConfiguration.query.first()
     chdir = "/opt/gluu-server-" + appconf.gluu_version
-    ips = []
+    ips = [server.ip for server in servers]
 
-    for server in servers:
-        ips.append(server.ip)
+    @rcpool.releasing
+    def restart_in_server(server):
         wlogger.log(tid, "(Re)Starting services ... ", "info",
                     server_id=server.id)
         rc = __get_remote_client(server, tid)
         if not rc:
-            continue
-
-        def get_cmd(cmd):
-            if server.gluu_server and not server.os == "CentOS 7":
-                return 'chroot {0} /bin/bash -c "{1}"'.format(chdir, cmd)
-            elif "CentOS 7" == server.os:
-                parts = ["ssh", "-o IdentityFile=/etc/gluu/keys/gluu-console",
-                         "-o Port=60022", "-o LogLevel=QUIET",
-                         "-o StrictHostKeyChecking=no",
-                         "-o UserKnownHostsFile=/dev/null",
-                         "-o PubkeyAuthentication=yes",
-                         "root@localhost", "'{0}'".format(cmd)]
-                return " ".join(parts)
-            return cmd
+            return
+        # the services of the Gluu Server are restarted through a single
+        # shell opened inside the container
+        cs = rc.container_session(chdir if server.gluu_server else '/',
+                                  server.os == 'CentOS 7')
 
         # Common restarts for all
         if server.os == 'CentOS 6':
@@ -735,11 +813,13 @@ def restart_services(self, method):
             # sometime apache service is stopped (happened in Ubuntu 16)
             # when install_cache_components task is executed; hence we also need to
             # restart the service
-            run_and_log(rc, get_cmd('service apache2 restart'), tid, server.id)
+            run_and_log(cs, 'service apache2 restart', tid, server.id)
 
-        run_and_log(rc, get_cmd('service oxauth restart'), tid, server.id)
-        run_and_log(rc, get_cmd('service identity restart'), tid, server.id)
-        rc.close()
+        run_and_log(cs, 'service oxauth restart', tid, server.id)
+        run_and_log(cs, 'service identity restart', tid, server.id)
+        rcpool.release(rc)
+
+    fan_out(restart_in_server, servers, tid=tid, logger=wlogger)
 
     if method != 'STANDALONE':
         wlogger.log(tid, "All services restarted.", "success")
@@ -760,30 +840,37 @@ def restart_services(self, method):
     if mock_server.os in ["CentOS 7", "RHEL 7"]:
         run_and_log(rc, "systemctl restart stunnel", tid, None)
         run_and_log(rc, "systemctl restart nutcracker", tid, None)
-    rc.close()
+    rcpool.release(rc)
 
 
 @celery.task(bind=True)
 def get_cache_methods(self):
     tid = self.request.id
     servers = Server.query.all()
-    methods = []
-    for server in servers:
+
+    def get_method(server):
         try:
             dbm = DBManager(server.hostname, 1636, server.ldap_password,
                             ssl=True, ip=server.ip)
         except LDAPSocketOpenError as e:
             wlogger.log(tid, "Couldn't connect to server {0}. Error: "
                              "{1}".format(server.hostname, e), "error")
-            continue
+            return
 
         entry = dbm.get_appliance_attributes('oxCacheConfiguration')
         cache_conf = json.loads(entry.oxCacheConfiguration.value)
-        server.cache_method = cache_conf['cacheProviderType']
-        if server.cache_method == 'REDIS':
+        cache_method = cache_conf['cacheProviderType']
+        if cache_method == 'REDIS':
             method = cache_conf['redisConfiguration']['redisProviderType']
-            server.cache_method += " - " + method
-        db.session.commit()
-        methods.append({"id": server.id, "method": server.cache_method})
+            cache_method += " - " + method
+        return {"id": server.id, "method": cache_method}
+
+    results = fan_out(get_method, servers, tid=tid, logger=wlogger)
+    methods = []
+    for result in results.succeeded:
+        if result.value:
+            result.item.cache_method = result.value['method']
+            methods.append(result.value)
+    db.session.commit()
     wlogger.log(tid, "Cache Methods of servers have been updated.", "success")
     return methods
@@ -9,29 +9,37 @@ from flask import current_app as app
 from flask import flash
 
 from clustermgr.models import Server, AppConfiguration
-from clustermgr.extensions import celery, wlogger, db
-from clustermgr.core.remote import RemoteClient
-from clustermgr.core.ldap_functions import LdapOLC
+from clustermgr.extensions import celery, wlogger, db, rcpool, mmrsnapshots
+from clustermgr.core.ldap_functions import LdapOLC, mmr_status
 from clustermgr.core.olc import CnManager
+from clustermgr.core.fanout import fan_out
+from clustermgr.core.remote import CommandTimeout, GLUU_CONSOLE_OS
+from clustermgr.core.history import TaskProgress
+from clustermgr.core.hosts import hostindex
 from clustermgr.core.utils import ldap_encode
 from clustermgr.config import Config
-import uuid
 
 def run_command(tid, c, command, container=None, no_error='error'):
-    """Shorthand for RemoteClient.run(). This function automatically logs
-    the commands output at appropriate levels to the WebLogger to be shared
-    in the web frontend.
+    """Shorthand for RemoteClient.run_stream(). This function automatically
+    logs the commands output at appropriate levels to the WebLogger as it is
+    produced, so long running commands show their progress in the web
+    frontend.
 
     Args:
         tid (string): task id of the task to store the log
         c (:object:`clustermgr.core.remote.RemoteClient`): client to be used
-            for the SSH communication
+            for the SSH communication, or a
+            :object:`clustermgr.core.remote.ContainerSession` to run the
+            command in a container
         command (string): the command to be run on the remote server
         container (string, optional): location where the Gluu Server container
             is installed. For standalone LDAP servers this is not necessary.
 
     Returns:
         the output of the command or the err thrown by the command as a string
+
+    Raises:
+        CommandTimeout: when the command runs past its deadline
     """
     if container == '/':
         container = None
@@ -40,7 +48,63 @@ def run_command(tid, c, command, container=None, no_error='error'):
                                                          command)
 
     wlogger.log(tid, command, "debug")
-    cin, cout, cerr = c.run(command)
+    # the command may run for long, show the log up to here meanwhile
+    wlogger.flush()
+    stream = c.run_stream(command)
+    try:
+        for name, chunk in stream:
+            if name == 'stdout':
+                _log_output(tid, chunk, None, no_error)
+            else:
+                _log_output(tid, None, chunk, no_error)
+    except CommandTimeout as e:
+        wlogger.log(tid, "{0}. The command was killed.".format(e), "error")
+        raise
+
+    output = ''
+    if stream.stdout:
+        output += "\n" + stream.stdout
+    if stream.stderr:
+        output += "\n" + stream.stderr
+    return output
+
+
+def run_commands(tid, c, commands, container=None, no_error='error',
+                 stop_on_error=False):
+    """Shorthand for RemoteClient.run_batch(). Runs all the commands through a
+    single SSH channel and logs every command and its output to the WebLogger
+    the same way run_command() does.
+
+    Args:
+        tid (string): task id of the task to store the log
+        c (:object:`clustermgr.core.remote.RemoteClient`): client to be used
+            for the SSH communication, or a
+            :object:`clustermgr.core.remote.ContainerSession` to run the
+            commands in a container
+        commands (list): the commands to be run on the remote server
+        container (string, optional): location where the Gluu Server container
+            is installed. For standalone LDAP servers this is not necessary.
+        stop_on_error (boolean, optional): stop at the first command which
+            exits with a non-zero status
+
+    Returns:
+        list of the outputs of the commands which were run as strings
+    """
+    if container == '/':
+        container = None
+    if container:
+        commands = ['chroot {0} /bin/bash -c "{1}"'.format(container, command)
+                    for command in commands]
+
+    outputs = []
+    for result in c.run_batch(commands, stop_on_error):
+        wlogger.log(tid, result['command'], "debug")
+        outputs.append(_log_output(tid, result['stdout'], result['stderr'],
+                                   no_error))
+    return outputs
+
+
+def _log_output(tid, cout, cerr, no_error):
     output = ''
     if cout:
         wlogger.log(tid, cout, "debug")
@@ -119,7 +183,17 @@ def modifyOxLdapProperties(server, c, tid, pDict, chroot):
                 'include all providers: {1}'.format(server.hostname, temp), 
                 'warning')
         
+REPLICATION_PHASES = (
+    'Checking the server',
+    'Converting slapd.conf to OLC',
+    'Configuring the replication',
+    'Updating the providers',
+    'Restarting the Gluu Server',
+)
+
+
 @celery.task(bind=True)
+@rcpool.releasing
 def setup_ldap_replication(self, server_id):
     tid = self.request.id
     server = Server.query.get(server_id)
@@ -137,23 +211,32 @@ def setup_ldap_replication(self, server_id):
         chroot = '/'
     else:
         chroot = '/opt/gluu-server-' + app_config.gluu_version
-    
+
+    progress = TaskProgress(tid, self.name, REPLICATION_PHASES, server.os,
+                            server.hostname)
+    progress.step('Checking the server')
+
     # 2. Make SSH Connection to the remote server
     wlogger.log(tid, "Making SSH connection to the server %s" %
                 server.hostname)
-    c = RemoteClient(server.hostname, ip=server.ip)
     try:
-        c.startup()
+        c = rcpool.get(server.hostname, ip=server.ip)
     except Exception as e:
         wlogger.log(
             tid, "Cannot establish SSH connection {0}".format(e), "warning")
         wlogger.log(tid, "Ending server setup process.", "error")
         return False
+    cs = c.container_session(chroot, server.os in GLUU_CONSOLE_OS)
 
 
+    # Probe every path needed for the checks below in a single round-trip
+    accesslog_dir = '/opt/gluu/data/accesslog'
+    slaptest = os.path.join(chroot, 'opt/symas/bin/slaptest')
+    stats = c.stat_many([chroot, chroot + accesslog_dir, slaptest])
+
     # 3. For Gluu server, ensure that chroot directory is available
     if server.gluu_server:
-        if c.exists(chroot):
+        if stats[chroot]['exists']:
             wlogger.log(tid, 'Checking if remote is gluu server', 'success')
         else:
             wlogger.log(tid, "Remote is not a gluu server.", "error")
@@ -161,14 +244,12 @@ def setup_ldap_replication(self, server_id):
             return False
 
     # 3.1 Ensure the data directories are available
-    accesslog_dir = '/opt/gluu/data/accesslog'
-    if not c.exists(chroot + accesslog_dir):
-        run_command(tid, c, "mkdir -p {0}".format(accesslog_dir), chroot)
-        run_command(tid, c, "chown -R ldap:ldap {0}".format(accesslog_dir),
-                    chroot)
+    if not stats[chroot + accesslog_dir]['exists']:
+        run_commands(tid, cs, ["mkdir -p {0}".format(accesslog_dir),
+                               "chown -R ldap:ldap {0}".format(accesslog_dir)])
 
     # 4. Ensure Openldap is installed on the server
-    if c.exists(os.path.join(chroot, 'opt/symas/bin/slaptest')):
+    if stats[slaptest]['exists']:
         wlogger.log(tid, "Checking OpenLDAP is installed", "success")
     else:
         wlogger.log(tid, "Cannot find directory /opt/symas/bin. OpenLDAP is "
@@ -180,9 +261,7 @@ def setup_ldap_replication(self, server_id):
     confile = os.path.join(app.root_path, "templates", "slapd",
                            "symas-openldap.conf")
                            
-    ldap_bind_addr = server.hostname
-    if app_config.use_ip:
-        ldap_bind_addr = server.ip
+    ldap_bind_addr = hostindex.address(server.hostname, app_config.use_ip)
     
 
     values = dict(
@@ -193,10 +272,11 @@ def setup_ldap_replication(self, server_id):
     confile_content = open(confile).read()
     confile_content = confile_content.format(**values)
 
-    r = c.put_file(syconf, confile_content)
+    r = c.sync_file(syconf, content=confile_content)
 
     if r[0]:
-        wlogger.log(tid, 'symas-openldap.conf file uploaded', 'success')
+        wlogger.log(tid, 'symas-openldap.conf file uploaded' if r[1] else
+                    'symas-openldap.conf file is up to date', 'success')
     else:
         wlogger.log(tid, 'An error occured while uploading symas-openldap.conf'
                     ': {0}'.format(r[1]), "error")
@@ -204,37 +284,29 @@ def setup_ldap_replication(self, server_id):
         return
 
     # 6. Generate OLC slapd.d
+    progress.step('Converting slapd.conf to OLC')
     wlogger.log(tid, "Convert slapd.conf to slapd.d OLC")
-    
-    if server.os == 'CentOS 7' or server.os == 'RHEL 7':
-        run_command(tid, c, "ssh -o IdentityFile=/etc/gluu/keys/gluu-console -o Port=60022 -o LogLevel=QUIET -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o PubkeyAuthentication=yes root@localhost 'service solserver stop'")
-    else:
-        run_command(tid, c, 'service solserver stop', chroot)
-    run_command(tid, c, "rm -rf /opt/symas/etc/openldap/slapd.d", chroot)
-    run_command(tid, c, "mkdir -p /opt/symas/etc/openldap/slapd.d", chroot)
-    run_command(tid, c, "/opt/symas/bin/slaptest -f /opt/symas/etc/openldap/"
-                "slapd.conf -F /opt/symas/etc/openldap/slapd.d", chroot)
-    run_command(tid, c,
-                "chown -R ldap:ldap /opt/symas/etc/openldap/slapd.d", chroot)
+    run_command(tid, cs, 'service solserver stop')
+    run_commands(tid, cs, [
+        "rm -rf /opt/symas/etc/openldap/slapd.d",
+        "mkdir -p /opt/symas/etc/openldap/slapd.d",
+        "/opt/symas/bin/slaptest -f /opt/symas/etc/openldap/slapd.conf "
+        "-F /opt/symas/etc/openldap/slapd.d",
+        "chown -R ldap:ldap /opt/symas/etc/openldap/slapd.d",
+    ], stop_on_error=True)
 
     # 7. Restart the solserver with the new OLC configuration
     wlogger.log(tid, "Restarting LDAP server with OLC configuration")
-
-    if server.os == 'CentOS 7' or server.os == 'RHEL 7':
-        log= run_command(tid, c, "ssh -o IdentityFile=/etc/gluu/keys/gluu-console -o Port=60022 -o LogLevel=QUIET -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o PubkeyAuthentication=yes root@localhost 'service solserver start'")
-    else:
-        log = run_command(tid, c, "service solserver start", chroot)
+    log = run_command(tid, cs, "service solserver start")
     if 'failed' in log:
         wlogger.log(tid, "Couldn't restart solserver.", "error")
         wlogger.log(tid, "Ending server setup process.", "error")
         
-        if 'CentOS' in server.os or 'RHEL' in server.os:
-            run_command(tid, c, "ssh -o IdentityFile=/etc/gluu/keys/gluu-console -o Port=60022 -o LogLevel=QUIET -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o PubkeyAuthentication=yes root@localhost 'service solserver start -d 1'")
-        else:
-            run_command(tid, c, "service solserver start -d 1", chroot)
+        run_command(tid, cs, "service solserver start -d 1")
         return
 
     # 8. Connect to the OLC config
+    progress.step('Configuring the replication')
     ldp = LdapOLC('ldaps://{}:1636'.format(conn_addr), 'cn=config',
                   server.ldap_password)
     try:
@@ -246,6 +318,9 @@ def setup_ldap_replication(self, server_id):
         wlogger.log(tid, "Ending server setup process.", "error")
         return
 
+    # read the replication config once for the checks below
+    olc = ldp.getReplicationConfig()
+
     # 9. Set the server ID
     if ldp.setServerID(server.id):
         wlogger.log(tid, 'Setting Server ID: {0}'.format(server.id), 'success')
@@ -270,7 +345,7 @@ def setup_ldap_replication(self, server_id):
             wlogger.log(tid, "Ending server setup process.", "error")
             return
 
-    if not ldp.checkAccesslogDBEntry():
+    if not olc.has_accesslog_db:
         if ldp.accesslogDBEntry(app_config.replication_dn, accesslog_dir):
             wlogger.log(tid, 'Creating accesslog entry', 'success')
         else:
@@ -285,7 +360,7 @@ def setup_ldap_replication(self, server_id):
     ldp.conn.unbind()
     ldp.conn.bind()
 
-    if not ldp.checkSyncprovOverlaysDB1():
+    if not olc.has_syncprov('{1}mdb'):
         if ldp.syncprovOverlaysDB1():
             wlogger.log(
                 tid, 'SyncprovOverlays entry on main database was created',
@@ -301,7 +376,7 @@ def setup_ldap_replication(self, server_id):
             tid, 'SyncprovOverlays entry on main database already exists.',
             'debug')
 
-    if not ldp.checkSyncprovOverlaysDB2():
+    if not olc.has_syncprov('{2}mdb'):
         if ldp.syncprovOverlaysDB2():
             wlogger.log(
                 tid, 'SyncprovOverlay entry on accasslog database was created',
@@ -317,7 +392,7 @@ def setup_ldap_replication(self, server_id):
             tid, 'SyncprovOverlay entry on accasslog database already exists.',
             'debug')
 
-    if not ldp.checkAccesslogPurge():
+    if not olc.has_accesslog_purge:
         if ldp.accesslogPurge(app_config.log_purge):
             wlogger.log(tid, 'Creating accesslog purge entry', 'success')
         else:
@@ -362,7 +437,7 @@ def setup_ldap_replication(self, server_id):
             wlogger.log(tid, "Ending server setup process.", "error")
             return
 
-    saddr = server.ip if app_config.use_ip else server.hostname
+    saddr = hostindex.address(server.hostname, app_config.use_ip)
 
 
     # Prepare pDict for modifying ox-ldap.properties file.
@@ -372,14 +447,14 @@ def setup_ldap_replication(self, server_id):
     
     for ri in allproviders:
         
-        laddr = ri.ip if app_config.use_ip else ri.hostname
+        laddr = hostindex.address(ri.hostname, app_config.use_ip)
         oxIDP.append(laddr+':1636')
         
         ox_auth = [ laddr+':1636' ]
 
         for rj in  allproviders:
             if not ri == rj:
-                laddr = rj.ip if app_config.use_ip else rj.hostname
+                laddr = hostindex.address(rj.hostname, app_config.use_ip)
                 ox_auth.append(laddr+':1636')
 
         pDict[ri.hostname]= ','.join(ox_auth)
@@ -405,11 +480,12 @@ def setup_ldap_replication(self, server_id):
     
     providers = Server.query.filter(Server.id.isnot(server.id)).filter().all()
     
+    progress.step('Updating the providers')
     if providers:
         wlogger.log(tid, "Adding Syncrepl to integrate the server in cluster")
     for p in providers:
 
-        paddr = p.ip if app_config.use_ip else p.hostname
+        paddr = hostindex.address(p.hostname, app_config.use_ip)
         
         if not server.primary_server:
         
@@ -454,9 +530,8 @@ def setup_ldap_replication(self, server_id):
         #other.conn.unbind()
 
 
-        pc = RemoteClient(p.hostname, ip=p.ip)
         try:
-            pc.startup()
+            pc = rcpool.get(p.hostname, ip=p.ip)
         except:
             pc = None
             wlogger.log(tid, "Can't establish SSH connection to provider server: ".format(p.hostname), 'fail')
@@ -476,7 +551,7 @@ def setup_ldap_replication(self, server_id):
     if not server.primary_server:
         # 15. Enable Mirrormode in the server
         if providers:
-            if not ldp.checkMirroMode():
+            if not olc.mirror_mode:
                 if ldp.makeMirroMode():
                     wlogger.log(tid, 'Enabling mirror mode', 'success')
                 else:
@@ -486,30 +561,47 @@ def setup_ldap_replication(self, server_id):
                 wlogger.log(tid, 'LDAP Server is already in mirror mode', 'debug')
 
     
+    progress.step('Restarting the Gluu Server')
     wlogger.log(tid, 'Restarting Gluu Server')
     run_command(tid, c, restart_gluu_cmd, no_error='debug')
 
     # 16. Set the mmr flag to True to indicate it has been configured
     server.mmr = True
     db.session.commit()
+    mmrsnapshots.clear()
 
+    progress.done()
     wlogger.log(tid, "Deployment is successful")
 
 
-@celery.task
-def remove_provider(server_id):
+@celery.task(bind=True)
+def remove_provider(self, server_id):
     """Task to remove the syncrepl config of the given server from all other
     servers in the LDAP cluster.
     """
+    tid = self.request.id
     appconfig = AppConfiguration.query.first()
     server = Server.query.get(server_id)
     receivers = Server.query.filter(Server.id.isnot(server_id)).all()
-    for receiver in receivers:
-        addr = receiver.ip if appconfig.use_ip else receiver.hostname
+
+    def remove_from(receiver):
+        addr = hostindex.address(receiver.hostname, appconfig.use_ip)
         c = CnManager(addr, 1636, True, 'cn=config', receiver.ldap_password)
-        c.remove_olcsyncrepl(server_id)
-        c.close()
-        # TODO monitor for failures and report or log it somewhere
+        try:
+            c.remove_olcsyncrepl(server_id)
+        finally:
+            c.close()
+
+    results = fan_out(remove_from, receivers)
+    for result in results.failed:
+        wlogger.log(tid, "Removing the syncrepl config of server {0} from {1} "
+                    "failed: {2}".format(server_id, result.item.hostname,
+                                         result.error), "error",
+                    server_id=result.item.id)
+    for result in results.timed_out:
+        wlogger.log(tid, "Removing the syncrepl config of server {0} from {1} "
+                    "timed out".format(server_id, result.item.hostname),
+                    "error", server_id=result.item.id)
 
     # may have more than one provider - MB
     # rewrite the symas-openldap.conf to make it listen localhost only
@@ -535,15 +627,14 @@ def remove_provider(server_id):
 
 
 @celery.task(bind=True)
+@rcpool.releasing
 def InstallLdapServer(self, ldap_info):
     tid = self.request.id
 
     wlogger.log(tid, "Making SSH connection to the server %s" %
                 ldap_info['fqn_hostname'])
-    c = RemoteClient(ldap_info['fqn_hostname'], ip=ldap_info['ip_address'])
-
     try:
-        c.startup()
+        c = rcpool.get(ldap_info['fqn_hostname'], ip=ldap_info['ip_address'])
     except Exception as e:
         wlogger.log(
             tid, "Cannot establish SSH connection {0}".format(e), "warning")
@@ -605,14 +696,15 @@ def InstallLdapServer(self, ldap_info):
                                       "slapd", "schema", "custom.schema")
     gluu_schema_file = os.path.join(
         app.root_path, "templates", "slapd", "schema", "gluu.schema")
-    r1 = c.upload(custom_schema_file,
-                  "/opt/gluu/schema/openldap/custom.schema")
-    r2 = c.upload(gluu_schema_file, "/opt/gluu/schema/openldap/gluu.schema")
+    r1 = c.sync_file("/opt/gluu/schema/openldap/custom.schema",
+                     local_path=custom_schema_file)
+    r2 = c.sync_file("/opt/gluu/schema/openldap/gluu.schema",
+                     local_path=gluu_schema_file)
     err = ''
-    if 'Upload successful.' not in r1:
-        err += r1
-    if 'Upload successful.' not in r2:
-        err += r2
+    if not r1[0]:
+        err += str(r1[1])
+    if not r2[0]:
+        err += str(r2[1])
     if err:
         wlogger.log(
             tid, 'Uploading Gluu schema files failed: {0}'.format(err), 'fail')
@@ -629,8 +721,8 @@ def InstallLdapServer(self, ldap_info):
     gluu_slapd_conf_file_content = gluu_slapd_conf_file_content.replace(
         "{#ROOTPW#}", hashpw)
 
-    r = c.put_file("/opt/symas/etc/openldap/slapd.conf",
-                   gluu_slapd_conf_file_content)
+    r = c.sync_file("/opt/symas/etc/openldap/slapd.conf",
+                    content=gluu_slapd_conf_file_content)
 
     if r[0]:
         wlogger.log(tid, 'slapd.conf file uploaded', 'success')
@@ -659,17 +751,14 @@ def InstallLdapServer(self, ldap_info):
     wlogger.log(
         tid, 'Directories "/opt/gluu/data/main_db" and "/opt/gluu/data/site_db" were created', 'success')
 
-    run_command(
-        tid, c, "chown -R {0}.{1} /opt/gluu/data/".format(
-            ldap_info["ldap_user"], ldap_info["ldap_group"]))
-
-    run_command(tid, c, "mkdir -p /var/symas/run/")
-
-    run_command(
-        tid, c, "chown -R {0}.{1} /var/symas".format(
-            ldap_info["ldap_user"], ldap_info["ldap_group"]))
-
-    run_command(tid, c, "mkdir -p /etc/certs/")
+    run_commands(tid, c, [
+        "chown -R {0}.{1} /opt/gluu/data/".format(
+            ldap_info["ldap_user"], ldap_info["ldap_group"]),
+        "mkdir -p /var/symas/run/",
+        "chown -R {0}.{1} /var/symas".format(
+            ldap_info["ldap_user"], ldap_info["ldap_group"]),
+        "mkdir -p /etc/certs/",
+    ])
 
     wlogger.log(tid, "Generating Certificate")
     cmd = "/usr/bin/openssl genrsa -des3 -out /etc/certs/openldap.key.orig -passout pass:{0} 2048".format(
@@ -722,8 +811,8 @@ def InstallLdapServer(self, ldap_info):
     confile_content = open(confile).read()
     confile_content = confile_content.format(**values)
 
-    r = c.put_file('/opt/symas/etc/openldap/symas-openldap.conf',
-                   confile_content)
+    r = c.sync_file('/opt/symas/etc/openldap/symas-openldap.conf',
+                    content=confile_content)
 
     if r[0]:
         wlogger.log(tid, 'symas-openldap.conf file uploaded', 'success')
@@ -768,32 +857,26 @@ def get_os_type(c):
         return 'RHEL 7'
 
 
+def gluu_installation_marker():
+    appconf = AppConfiguration.query.first()
+    return ('/opt/gluu-server-{}/install/community-edition-setup/'
+            'setup.properties.last').format(appconf.gluu_version)
+
+
 def check_gluu_installation(c):
+    return c.exists(gluu_installation_marker())
 
-    appconf = AppConfiguration.query.first()
-    check_file = ('/opt/gluu-server-{}/install/community-edition-setup/'
-                  'setup.properties.last').format(
-                                                appconf.gluu_version
-                                            )
-    return c.exists(check_file)
-    
 
 @celery.task
+@rcpool.releasing
 def collect_server_details(server_id):
     server = Server.query.get(server_id)
     appconf = AppConfiguration.query.first()
-    c = RemoteClient(server.hostname, ip=server.ip)
     try:
-        c.startup()
+        c = rcpool.get(server.hostname, ip=server.ip)
     except:
         return
 
-    # 0. Make sure it is a Gluu Server
-    chdir = "/opt/gluu-server-" + appconf.gluu_version
-    if not c.exists(chdir):
-        server.gluu_server = False
-        chdir = '/'
-
     # 1. The components installed in the server
     components = {
         'oxAuth': 'opt/gluu/jetty/oxauth',
@@ -804,20 +887,37 @@ def collect_server_details(server_id):
         'Asimba': 'opt/gluu/jetty/asimba',
         'Passport': 'opt/gluu/node/passport',
     }
+
+    # Inventory the markers both inside and outside of the Gluu Server
+    # container with a single remote call
+    gluu_chdir = "/opt/gluu-server-" + appconf.gluu_version
+    check_file = gluu_installation_marker()
+    paths = [gluu_chdir, check_file]
+    for marker in components.values():
+        paths.append(os.path.join(gluu_chdir, marker))
+        paths.append(os.path.join('/', marker))
+    stats = c.stat_many(paths)
+
+    # 0. Make sure it is a Gluu Server
+    chdir = gluu_chdir
+    if not stats[chdir]['exists']:
+        server.gluu_server = False
+        chdir = '/'
+
     installed = []
     for component, marker in components.iteritems():
         marker = os.path.join(chdir, marker)
-        if c.exists(marker):
+        if stats[marker]['exists']:
             installed.append(component)
     server.components = ",".join(installed)
 
     server.os = get_os_type(c)
-    server.gluu_server = check_gluu_installation(c)
+    server.gluu_server = stats[check_file]['exists']
 
     db.session.commit()
 
 
-def import_key(suffix, hostname, gluu_version, tid, c, sos):
+def import_key(suffix, hostname, tid, cs):
     defaultTrustStorePW = 'changeit'
     defaultTrustStoreFN = '/opt/jre/jre/lib/security/cacerts'
     certFolder = '/etc/certs'
@@ -830,50 +930,47 @@ def import_key(suffix, hostname, gluu_version, tid, c, sos):
                     "-storepass", defaultTrustStorePW, "-noprompt"
                     ])
 
-    chroot = '/opt/gluu-server-{0}'.format(gluu_version)
-    
-    if 'CentOS' in sos:
-        command = "ssh -o IdentityFile=/etc/gluu/keys/gluu-console -o Port=60022 -o LogLevel=QUIET -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o PubkeyAuthentication=yes root@localhost '{0}'".format(cmd)
-    else:
-        command = 'chroot {0} /bin/bash -c "{1}"'.format(chroot,
-                                                         cmd)
-    
-    cin, cout, cerr = c.run(command)
+    cin, cout, cerr = cs.run(cmd)
     wlogger.log(tid, cmd, 'debug')
     wlogger.log(tid, cout+cerr, 'debug')
 
 
-def delete_key(suffix, hostname, gluu_version, tid, c, sos):
+def delete_key(suffix, hostname, tid, cs):
     defaultTrustStorePW = 'changeit'
     defaultTrustStoreFN = '/opt/jre/jre/lib/security/cacerts'
-    chroot = '/opt/gluu-server-{0}'.format(gluu_version)
     cert = "etc/certs/%s.crt" % (suffix)
-    if c.exists(os.path.join(chroot, cert)):
+    if cs.client.exists(os.path.join(cs.container, cert)):
         cmd=' '.join([  
                         '/opt/jre/bin/keytool', "-delete", "-alias", 
                         "%s_%s" % (hostname, suffix),
                         "-keystore", defaultTrustStoreFN,
                         "-storepass", defaultTrustStorePW
                         ])
-
-        if 'CentOS' in sos:
-            command = "ssh -o IdentityFile=/etc/gluu/keys/gluu-console -o Port=60022 -o LogLevel=QUIET -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o PubkeyAuthentication=yes root@localhost '{0}'".format(cmd)
-        else:
-            command = 'chroot {0} /bin/bash -c "{1}"'.format(chroot,
-                                                         cmd)
-        cin, cout, cerr = c.run(command)
+        cin, cout, cerr = cs.run(cmd)
         wlogger.log(tid, cmd, 'debug')
         wlogger.log(tid, cout+cerr, 'debug')
 
 
+INSTALL_PHASES = (
+    'Adding the Gluu repository',
+    'Removing the previous installation',
+    'Installing the package',
+    'Starting the Gluu Server',
+    'Uploading setup.properties',
+    'Running setup.py',
+    'Copying the schema and certificates',
+    'Configuring ntp',
+)
+
+
 @celery.task(bind=True)
+@rcpool.releasing
 def installGluuServer(self, server_id):
     tid = self.request.id
     server = Server.query.get(server_id)
     pserver = Server.query.filter_by(primary_server=True).first()
     
     appconf = AppConfiguration.query.first()
-    c = RemoteClient(server.hostname, ip=server.ip)
 
     setup_properties_file = os.path.join(Config.DATA_DIR, 'setup.properties')
 
@@ -884,14 +981,14 @@ def installGluuServer(self, server_id):
         wlogger.log(tid, "Ending server installation process.", "error")
         return
 
+    progress = TaskProgress(tid, self.name, INSTALL_PHASES, server.os,
+                            server.hostname)
 
     if not server.primary_server:
         wlogger.log(tid, "Check if Primary Server is Installed")
 
-        pc = RemoteClient(pserver.hostname, ip=pserver.ip)
-
         try:
-            pc.startup()
+            pc = rcpool.get(pserver.hostname, ip=pserver.ip)
         except:
             wlogger.log(tid, "Can't make SSH connection to primary server: ".format(pserver.hostname), 'error')
             wlogger.log(tid, "Ending server installation process.", "error")
@@ -907,12 +1004,13 @@ def installGluuServer(self, server_id):
     # FIXME: add gluu repo and GPG Key before starting to install
 
     try:
-        c.startup()
+        c = rcpool.get(server.hostname, ip=server.ip)
     except:
         wlogger.log(tid, "Can't establish SSH connection",'fail')
         wlogger.log(tid, "Ending server installation process.", "error")
         return
     
+    progress.step('Adding the Gluu repository')
     wlogger.log(tid, "Preparing for Installation")
 
     start_command  = 'service gluu-server-{0} start'
@@ -981,6 +1079,7 @@ def installGluuServer(self, server_id):
         cmd = 'yum clean all'
         run_command(tid, c, cmd, no_error='debug')
 
+    progress.step('Removing the previous installation')
     wlogger.log(tid, "Check if Gluu Server was installed")
 
     gluu_installed = False
@@ -1019,6 +1118,7 @@ def installGluuServer(self, server_id):
 
 
 
+    progress.step('Installing the package')
     wlogger.log(tid, "Installing Gluu Server: " + gluu_server)
 
     #FIXME : check cerr for possible issues on installing package
@@ -1033,6 +1133,7 @@ def installGluuServer(self, server_id):
             run_command(tid, c, cmd, no_error='debug')
 
 
+    progress.step('Starting the Gluu Server')
     if enable_command:
         run_command(tid, c, enable_command.format(appconf.gluu_version), no_error='debug')
         
@@ -1042,15 +1143,15 @@ def installGluuServer(self, server_id):
         wlogger.log(tid, "Sleeping 10 secs to wait for gluu server start properly.")
         time.sleep(10)
     
+    progress.step('Uploading setup.properties')
     # If this server is primary, upload local setup.properties to server
     if server.primary_server:
         wlogger.log(tid, "Uploading setup.properties")
         r = c.upload(setup_properties_file, '/opt/{}/install/community-edition-setup/setup.properties'.format(gluu_server))
     # If this server is not primary, get setup.properties.last from primary server and upload to this server
     else:
-        pc = RemoteClient(pserver.hostname, ip=pserver.ip)
         try:
-            pc.startup()
+            pc = rcpool.get(pserver.hostname, ip=pserver.ip)
         except:
             wlogger.log(tid, "Can't establish SSH connection to primary server: ".format(pserver.hostname), 'error')
             wlogger.log(tid, "Ending server installation process.", "error")
@@ -1088,90 +1189,56 @@ def installGluuServer(self, server_id):
     #    wlogger.log(tid, "Ending server setup process.", "error")
     
 
+    progress.step('Running setup.py')
     wlogger.log(tid, "Running setup.py - Be patient this process will take a while ...")
     
-    if server.os == 'CentOS 7' or server.os == 'RHEL 7':
-        cmd = "ssh -o IdentityFile=/etc/gluu/keys/gluu-console -o Port=60022 -o LogLevel=QUIET -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o PubkeyAuthentication=yes root@localhost 'cd /install/community-edition-setup/ && ./setup.py -n'"
-        run_command(tid, c, cmd)
-    else:
-        cmd = 'cd /install/community-edition-setup/ && ./setup.py -n'
-        run_command(tid, c, cmd, '/opt/'+gluu_server+'/', no_error='debug')
+    cs = c.container_session('/opt/' + gluu_server,
+                             server.os in GLUU_CONSOLE_OS)
+    cmd = 'cd /install/community-edition-setup/ && ./setup.py -n'
+    run_command(tid, cs, cmd, no_error='debug')
 
         
 
+    progress.step('Copying the schema and certificates')
     # Get slapd.conf from primary server and upload this server
     if not server.primary_server:
 
         #FIXME: Check this later
         cmd = 'rm /opt/gluu/data/main_db/*.mdb'
-        run_command(tid, c, cmd, '/opt/'+gluu_server)
+        run_command(tid, cs, cmd)
 
 
         slapd_conf_file = '/opt/{0}/opt/symas/etc/openldap/slapd.conf'.format(gluu_server)
-        r = pc.get_file(slapd_conf_file)
+        r = pc.relay_file(slapd_conf_file, [c])[0]
         if r[0]:
-            fc = r[1].read()
-            r2 = c.put_file(slapd_conf_file, fc)
-            if not r2[0]:
-                wlogger.log(tid, "Can't put slapd.conf to this server: ".format(r[1]), 'error')
-            else:
-                wlogger.log(tid, "slapd.conf was downloaded from primary server and uploaded to this server", 'success')
+            wlogger.log(tid, "slapd.conf was copied from primary server to this server", 'success')
         else:
-            wlogger.log(tid, "Can't get slapd.conf from primary server: ".format(r[1]), 'error')
+            wlogger.log(tid, "Can't copy slapd.conf from primary server: {0}".format(r[1]), 'error')
 
 
         wlogger.log(tid, 'Downloading custom schema files from primary server and upload to this server')
-        custom_schema_files = pc.listdir("/opt/{0}/opt/gluu/schema/openldap/".format(gluu_server))
+        schema_dir = "/opt/{0}/opt/gluu/schema/openldap/".format(gluu_server)
+        custom_schema_files = pc.relay_tree(schema_dir, c, schema_dir)
         
         if custom_schema_files[0]:
             for csf in custom_schema_files[1]:
-                local = '/tmp/'+csf
-                remote = '/opt/{0}/opt/gluu/schema/openldap/{1}'.format(gluu_server, csf)
-                
-                pc.download(remote, local)
-                c.upload(local, remote)
-                os.remove(local)
                 wlogger.log(tid, '{0} dowloaded from from primary and uploaded'.format(csf), 'debug')
 
-            if server.os == 'CentOS 7' or server.os == 'RHEL 7':
-                run_command(tid, c, "ssh -o IdentityFile=/etc/gluu/keys/gluu-console -o Port=60022 -o LogLevel=QUIET -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o PubkeyAuthentication=yes root@localhost 'service solserver stop'")
-            else:
-                run_command(tid, c, 'service solserver stop', '/opt/'+gluu_server)
-            
-            if server.os == 'CentOS 7' or server.os == 'RHEL 7':
-                run_command(tid, c, "ssh -o IdentityFile=/etc/gluu/keys/gluu-console -o Port=60022 -o LogLevel=QUIET -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o PubkeyAuthentication=yes root@localhost 'service solserver start'")
-            else:
-                run_command(tid, c, 'service solserver start', '/opt/'+gluu_server)
+            run_command(tid, cs, 'service solserver stop')
+            run_command(tid, cs, 'service solserver start')
 
         if appconf.gluu_version > '3.0.2':
             wlogger.log(tid, "Downloading certificates from primary server and uploading to this server")
-            certs_remote_tmp = "/tmp/certs_"+str(uuid.uuid4())[:4].upper()+".tgz"
-            certs_local_tmp = "/tmp/certs_"+str(uuid.uuid4())[:4].upper()+".tgz"
-            
-            cmd = 'tar -zcf {0} /opt/gluu-server-{1}/etc/certs/'.format(certs_remote_tmp, appconf.gluu_version)
-            wlogger.log(tid,cmd,'debug')
-            cin, cout, cerr = pc.run(cmd)
-            wlogger.log(tid, cout+cerr, 'debug')
-            wlogger.log(tid,cmd,'debug')
-            
-
-            r = pc.download(certs_remote_tmp, certs_local_tmp)
-            if 'Download successful' in r :
-                wlogger.log(tid, r,'success')
-            else:
-                wlogger.log(tid, r,'error')
-                
-            r = c.upload(certs_local_tmp, "/tmp/certs.tgz")
-            
-            if 'Upload successful' in r:
-                wlogger.log(tid, r,'success')
+            certs_dir = '/opt/gluu-server-{0}/etc/certs/'.format(appconf.gluu_version)
+            r = pc.relay_tree(certs_dir, c, certs_dir)
+            if r[0]:
+                wlogger.log(tid, 'Certificates copied to {0}'.format(certs_dir), 'success')
             else:
-                wlogger.log(tid, r,'error')
-                
-            cmd = 'tar -zxf /tmp/certs.tgz -C /'
-            run_command(tid, c, cmd)
+                wlogger.log(tid, "Can't copy certificates: {0}".format(r[1]), 'error')
         
             wlogger.log(tid, 'Manuplating keys')
+            kcs = c.container_session('/opt/' + gluu_server,
+                                      'CentOS' in server.os)
             for suffix in (
                     'httpd',
                     'shibIDP',
@@ -1179,23 +1246,23 @@ def installGluuServer(self, server_id):
                     'asimba',
                     'openldap',
                     ):
-                delete_key(suffix, appconf.nginx_host, appconf.gluu_version, tid, c, server.os)
-                import_key(suffix, appconf.nginx_host, appconf.gluu_version, tid, c, server.os)
+                delete_key(suffix, appconf.nginx_host, tid, kcs)
+                import_key(suffix, appconf.nginx_host, tid, kcs)
 
     else:
         custom_schema_dir = os.path.join(Config.DATA_DIR, 'schema')
         custom_schemas = os.listdir(custom_schema_dir)
         
         if custom_schemas:
-            for sf in custom_schemas:
-                local = os.path.join(custom_schema_dir, sf)
-                remote = '/opt/{0}/opt/gluu/schema/openldap/{1}'.format(gluu_server, sf)
-                r = c.upload(local, remote)
-                if r[0]:
+            remote = '/opt/{0}/opt/gluu/schema/openldap/'.format(gluu_server)
+            r = c.push_tree(custom_schema_dir, remote)
+            if r[0]:
+                for sf in r[1]:
                     wlogger.log(tid, 'Custom schame file {0} uploaded'.format(sf), 'success')
-                else:
-                    wlogger.log(tid, "Can't upload custom schame file {0}: ".format(sf, r[1]), 'error')
+            else:
+                wlogger.log(tid, "Can't upload custom schame files: {0}".format(r[1]), 'error')
 
+    progress.step('Configuring ntp')
     wlogger.log(tid, "Checking if ntp is installed and configured.")
 
     if c.exists('/usr/sbin/ntpdate'):
@@ -1217,10 +1284,12 @@ def installGluuServer(self, server_id):
 
     server.gluu_server = True
     db.session.commit()
+    progress.done()
     wlogger.log(tid, "Gluu Server successfully installed")
 
 
 @celery.task(bind=True)
+@rcpool.releasing
 def removeMultiMasterDeployement(self, server_id):
     app_config = AppConfiguration.query.first()
     server = Server.query.get(server_id)
@@ -1233,19 +1302,24 @@ def removeMultiMasterDeployement(self, server_id):
 
     wlogger.log(tid, "Making SSH connection to the server %s" %
                 server.hostname)
-    c = RemoteClient(server.hostname, ip=server.ip)
-
     try:
-        c.startup()
+        c = rcpool.get(server.hostname, ip=server.ip)
     except Exception as e:
         wlogger.log(
             tid, "Cannot establish SSH connection {0}".format(e), "warning")
         wlogger.log(tid, "Ending server setup process.", "error")
         return False
+    cs = c.container_session(chroot)
+
+    symas_conf = os.path.join(chroot,
+                              'opt/symas/etc/openldap/symas-openldap.conf')
+    slapd_conf = os.path.join(chroot, 'opt/symas/etc/openldap/slapd.conf')
+    slapd_d_dir = os.path.join(chroot, 'opt/symas/etc/openldap/')
+    stats = c.stat_many([chroot, symas_conf, slapd_conf, slapd_d_dir])
 
     if server.gluu_server:
         # check if remote is gluu server
-        if c.exists(chroot):
+        if stats[chroot]['exists']:
             wlogger.log(tid, 'Checking if remote is gluu server', 'success')
         else:
             wlogger.log(tid, "Remote is not a gluu server.", "error")
@@ -1253,7 +1327,7 @@ def removeMultiMasterDeployement(self, server_id):
             return False
 
     # symas-openldap.conf file exists
-    if c.exists(os.path.join(chroot, 'opt/symas/etc/openldap/symas-openldap.conf')):
+    if stats[symas_conf]['exists']:
         wlogger.log(tid, 'Checking symas-openldap.conf exists', 'success')
     else:
         wlogger.log(tid, 'Checking if symas-openldap.conf exists', 'fail')
@@ -1261,7 +1335,7 @@ def removeMultiMasterDeployement(self, server_id):
         return
 
     # sldapd.conf file exists
-    if c.exists(os.path.join(chroot, 'opt/symas/etc/openldap/slapd.conf')):
+    if stats[slapd_conf]['exists']:
         wlogger.log(tid, 'Checking slapd.conf exists', 'success')
     else:
         wlogger.log(tid, 'Checking if slapd.conf exists', 'fail')
@@ -1280,8 +1354,7 @@ def removeMultiMasterDeployement(self, server_id):
 
     confile_content = confile_content.format(**vals)
 
-    r = c.put_file(os.path.join(
-        chroot, 'opt/symas/etc/openldap/symas-openldap.conf'), confile_content)
+    r = c.sync_file(symas_conf, content=confile_content)
 
     if r[0]:
         wlogger.log(tid, 'symas-openldap.conf file uploaded', 'success')
@@ -1291,49 +1364,52 @@ def removeMultiMasterDeployement(self, server_id):
         wlogger.log(tid, "Ending server setup process.", "error")
         return
 
-    run_command(tid, c, "chown -R ldap:ldap /opt/symas/etc/openldap", chroot)
+    run_command(tid, cs, "chown -R ldap:ldap /opt/symas/etc/openldap")
 
 
-    slapd_d_dir = os.path.join(chroot, 'opt/symas/etc/openldap/')
-    if c.exists(slapd_d_dir):
+    if stats[slapd_d_dir]['exists']:
         cmd = "rm -rf /opt/symas/etc/openldap/slapd.d"
-        run_command(tid, c, cmd, chroot)
+        run_command(tid, cs, cmd)
 
 
     server.mmr = False
     db.session.commit()
+    mmrsnapshots.clear()
     
     #modifyOxLdapProperties(server, c, tid)
 
     # Restart the solserver with slapd.conf configuration
     wlogger.log(tid, "Restarting LDAP server with slapd.conf configuration")
     
-    if 'CentOS' in server.os:
-        run_command(tid, c, "ssh -o IdentityFile=/etc/gluu/keys/gluu-console -o Port=60022 -o LogLevel=QUIET -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o PubkeyAuthentication=yes root@localhost 'service solserver restart'")
-    else:
-        log = run_command(tid, c, "service solserver restart", chroot)
-                
-        if 'failed' in log:
-            wlogger.log(tid,
-                        "There seems to be some issue in restarting the server.",
-                        "error")
-            wlogger.log(tid, "Ending server setup process.", "error")
-            return
+    rs = c.container_session(chroot, 'CentOS' in server.os)
+    log = run_command(tid, rs, "service solserver restart")
+    if 'failed' in log:
+        wlogger.log(tid,
+                    "There seems to be some issue in restarting the server.",
+                    "error")
+        wlogger.log(tid, "Ending server setup process.", "error")
+        return
     
     wlogger.log(tid, 'Deployment of Ldap Server was successfully removed')
 
     return True
 
+NGINX_PHASES = (
+    'Installing NGINX',
+    'Copying the certificates',
+    'Configuring NGINX',
+)
+
+
 @celery.task(bind=True)
+@rcpool.releasing
 def installNGINX(self, nginx_host):
     tid = self.request.id
     app_config = AppConfiguration.query.first()
     pserver = Server.query.filter_by(primary_server=True).first()
     wlogger.log(tid, "Making SSH connection to the server {}".format(nginx_host))
-    c = RemoteClient(nginx_host)
-
     try:
-        c.startup()
+        c = rcpool.get(nginx_host)
     except Exception as e:
         wlogger.log(
             tid, "Cannot establish SSH connection {0}".format(e), "warning")
@@ -1342,6 +1418,8 @@ def installNGINX(self, nginx_host):
     wlogger.log(tid, "Determining OS type")
     os_type = get_os_type(c)
     wlogger.log(tid, "OS is determined as {0}".format(os_type),'debug')
+    progress = TaskProgress(tid, self.name, NGINX_PHASES, os_type, nginx_host)
+    progress.step('Installing NGINX')
     wlogger.log(tid, "Check if NGINX installed")
     
     r = c.exists("/usr/sbin/nginx")
@@ -1377,36 +1455,39 @@ def installNGINX(self, nginx_host):
         wlogger.log(tid, "Directory /etc/nginx/ssl/ exists.", "debug")
 
 
+    progress.step('Copying the certificates')
     wlogger.log(tid, "Making SSH connection to primary server {} for downloading certificates".format(pserver.hostname))
-    pc = RemoteClient(pserver.hostname, pserver.ip)
     try:
-        pc.startup()
+        pc = rcpool.get(pserver.hostname, ip=pserver.ip)
     except Exception as e:
         wlogger.log(
             tid, "Cannot establish SSH connection to primary server {0}".format(e), "warning")
         wlogger.log(tid, "Ending server setup process.", "error")
         return False
+    changed = False
     for crt in ('httpd.crt', 'httpd.key'):
-        wlogger.log(tid, "Downloading {0} from primary server".format(crt), "debug")
+        wlogger.log(tid, "Copying {0} from primary server".format(crt), "debug")
         remote_file = '/opt/gluu-server-{0}/etc/certs/{1}'.format(app_config.gluu_version, crt)
-        r = pc.get_file(remote_file)
-        if not r[0]:
-            wlogger.log(tid, "Can't download {0} from primary server: {1}".format(crt,r[1]), "error")
+        remote = os.path.join("/etc/nginx/ssl/", crt)
+        checksum = pc.checksum(remote_file)
+        if not checksum:
+            wlogger.log(tid, "Can't read {0} on primary server".format(crt), "error")
             wlogger.log(tid, "Ending server setup process.", "error")
             return False
-        else:
-            wlogger.log(tid, "File {} was downloaded.".format(remote_file), "success")
-        fc = r[1].read()
-        remote = os.path.join("/etc/nginx/ssl/", crt)
-        r = c.put_file(remote, fc)
+        if checksum == c.checksum(remote):
+            wlogger.log(tid, "File {} is up to date".format(remote), "debug")
+            continue
+        r = pc.relay_file(remote_file, [c], remote)[0]
         
         if r[0]:
+            changed = True
             wlogger.log(tid, "File {} uploaded".format(remote), "success")
         else:
             wlogger.log(tid, "Can't upload {0}: {1}".format(remote,r[1]), "error")
             wlogger.log(tid, "Ending server setup process.", "error")
             return False
     
+    progress.step('Configuring NGINX')
     servers = Server.query.all()
     nginx_backends = []
     
@@ -1422,17 +1503,33 @@ def installNGINX(self, nginx_host):
     nginx_tmp = nginx_tmp.replace('{#SERVERS#}', '\n'.join(nginx_backends))
 
     remote = "/etc/nginx/nginx.conf"
-    r = c.put_file(remote, nginx_tmp)
+    r = c.sync_file(remote, content=nginx_tmp)
     
     if r[0]:
-         wlogger.log(tid, "File {} uploaded".format(remote), "success")
+        changed = changed or r[1]
+        wlogger.log(tid, "File {} uploaded".format(remote), "success")
     else:
         wlogger.log(tid, "Can't upload {0}: {1}".format(remote,r[1]), "error")
         wlogger.log(tid, "Ending server setup process.", "error")
         return False
 
-    cmd = 'service nginx restart'
-    
-    run_command(tid, c, cmd, no_error='debug')
+    if changed:
+        cmd = 'service nginx restart'
+        run_command(tid, c, cmd, no_error='debug')
+    else:
+        wlogger.log(tid, "NGINX configuration is unchanged, skipping restart",
+                    "debug")
     
+    progress.done()
     wlogger.log(tid, "NGINX successfully installed")
+
+
+@celery.task
+def snapshot_replication_status():
+    """Takes a snapshot of the replication status of all the servers, for
+    the pages to show it without searching the LDAP servers themselves.
+    """
+    servers = Server.query.all()
+    if servers:
+        mmr_status(servers, refresh=True,
+                   timeout=app.config.get('MMR_STATUS_TIMEOUT', 5))
@@ -3,8 +3,9 @@ the servers managed in the cluster-manager
 """
 from flask import Blueprint, render_template, url_for, flash, redirect, \
     request, session
+from flask import current_app as app
 
-from clustermgr.core.ldap_functions import LdapOLC
+from clustermgr.core.ldap_functions import mmr_status
 from clustermgr.models import Server, AppConfiguration
 from clustermgr.tasks.cluster import setup_ldap_replication, \
     InstallLdapServer, installGluuServer, remove_provider, \
@@ -39,18 +40,20 @@ def remove_deployment(server_id):
     servers = Server.query.filter(Server.id.isnot(server_id)).filter(
                                     Server.mmr.is_(True)).all()
 
+    # the providers of the servers come from the last replication snapshot
+    snapshot = mmr_status(Server.query.all(),
+                          timeout=app.config.get('MMR_STATUS_TIMEOUT', 5))
     for m in servers:
-        ldp = LdapOLC('ldaps://{}:1636'.format(m.hostname),
-                      "cn=config", m.ldap_password)
-        r = None
-        try:
-            r = ldp.connect()
-        except Exception as e:
+        result = snapshot['servers'].get(m.hostname)
+        if not result:
+            continue
+        if result['error'] or result['timed_out']:
             flash("Connection to LDAPserver {0} at port 1636 was failed:"
-                  " {1}".format(m.hostname, e), "danger")
+                  " {1}".format(m.hostname, result['error'] or 'timed out'),
+                  "danger")
 
-        if r:
-            pd = ldp.getProviders()
+        if result['status']:
+            pd = result['status']['providers']
 
             if thisServer.hostname in pd:
                 flash("This server is a provider for Ldap Server {0}."
@@ -1,17 +1,24 @@
 # -*- coding: utf-8 -*-
 import os
+import json
+import time
+
 from flask import Blueprint, render_template, redirect, url_for, flash, \
-    request, jsonify, session
+    request, jsonify, session, Response, stream_with_context
 from flask import current_app as app
 from werkzeug.utils import secure_filename
+from celery.backends.redis import RedisBackend
 from celery.result import AsyncResult
+from celery.states import READY_STATES, PENDING
 
-from clustermgr.extensions import db, wlogger, celery
-from clustermgr.models import AppConfiguration, KeyRotation, Server
+from clustermgr.extensions import db, wlogger, celery, mmrsnapshots
+from clustermgr.models import AppConfiguration, KeyRotation, Server, TaskRun
 from clustermgr.forms import AppConfigForm, KeyRotationForm, SchemaForm, \
     TestUser, InstallServerForm
 
-from clustermgr.core.ldap_functions import LdapOLC
+from clustermgr.core.ldap_functions import LdapOLC, mmr_status
+from clustermgr.core.history import slowest_steps
+from clustermgr.core.hosts import hostindex
 from clustermgr.tasks.all import rotate_pub_keys
 from clustermgr.core.utils import encrypt_text
 from clustermgr.core.utils import generate_random_key
@@ -233,17 +240,175 @@ def delete_oxauth_server(id):
     return jsonify({}), 204
 
 
+def _result_key(task_id):
+    """Returns the key celery keeps the result of the task under, when it is
+    kept in the Redis database of the task logs."""
+    backend = celery.backend
+    if not isinstance(backend, RedisBackend):
+        return None
+    params = backend.connparams
+    if (params.get('host'), params.get('port'), params.get('db')) != (
+            app.config['REDIS_HOST'], app.config['REDIS_PORT'],
+            app.config['REDIS_LOG_DB']):
+        return None
+    return backend.get_key_for_task(task_id)
+
+
 @index.route('/log/<task_id>')
 def get_log(task_id):
-    msgs = wlogger.get_messages(task_id)
+    """Returns the state of the task and its log messages. Pass the `next`
+    value of the previous response as `?since=` to only get the messages
+    logged after it, and `?server_id=` to only get those of a server. The
+    `eta` of the tasks which report one tells the phase they are in and the
+    time they still need, refer :class:`clustermgr.core.history.TaskProgress`.
+
+    The messages, the estimate and the state of the task are read in a single
+    round-trip to Redis. The ETag of the response changes only with them, so
+    pollers sending it back get an empty 304 while nothing happened."""
+    since = request.args.get('since', 0, type=int)
+    server_id = request.args.get('server_id')
+    result_key = _result_key(task_id)
+    msgs, eta, meta, cursor = wlogger.poll(task_id, since, server_id,
+                                           result_key)
+    if result_key:
+        if meta is None:
+            state, value = PENDING, None
+        else:
+            meta = celery.backend.decode_result(meta)
+            state, value = meta['status'], meta['result']
+    else:
+        result = AsyncResult(id=task_id, app=celery)
+        state = result.state
+        value = result.result if state == 'SUCCESS' else None
+
+    if state in READY_STATES:
+        value = value if state == 'SUCCESS' else 0
+        # the logs of the servers are read by the pages of the whole task
+        if server_id is None:
+            wlogger.clean(task_id)
+    else:
+        value = 0
+    log = {'task_id': task_id, 'state': state, 'messages': msgs,
+           'result': value, 'next': cursor, 'eta': eta}
+
+    response = jsonify(log)
+    response.set_etag('{0}-{1}-{2}-{3}'.format(
+        since, log['next'], state, eta['step'] if eta else 0))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+def _sse(data, event=None, event_id=None):
+    lines = []
+    if event:
+        lines.append('event: {0}'.format(event))
+    if event_id is not None:
+        lines.append('id: {0}'.format(event_id))
+    lines.append('data: {0}'.format(json.dumps(data, default=str)))
+    return '\n'.join(lines) + '\n\n'
+
+
+@index.route('/log/<task_id>/stream')
+def stream_log(task_id):
+    """Streams the log messages of the task as Server-Sent Events while they
+    are logged. The id of every event is the cursor to resume from, which
+    browsers send back as the Last-Event-ID header when they reconnect;
+    `?since=` can be used for the first connection and `?server_id=` to only
+    follow the messages of a server. The estimates of the task come as `eta`
+    events when they change. The stream ends with an `end` event carrying the
+    state and the result of the task."""
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+    server_id = request.args.get('server_id')
+
+    def events():
+        cursor = since
+        last_eta = None
+        for msgs, eta, state, last in wlogger.follow(task_id, since,
+                                                     server_id=server_id):
+            # the oldest messages may have been dropped past the cursor
+            cursor = last - len(msgs)
+            for msg in msgs:
+                cursor += 1
+                yield _sse(msg, event_id=cursor)
+            if eta and eta != last_eta:
+                last_eta = eta
+                yield _sse(eta, event='eta', event_id=cursor)
+                if state is None and not msgs:
+                    continue
+            if state is None and not msgs:
+                # nothing happened for a while, check whether the task ended
+                # without announcing it
+                state = AsyncResult(id=task_id, app=celery).state
+                if state not in READY_STATES:
+                    yield ': keepalive\n\n'
+                    continue
+            if state in READY_STATES:
+                result = AsyncResult(id=task_id, app=celery)
+                value = result.result if state == 'SUCCESS' else 0
+                yield _sse({'state': state, 'result': value},
+                           event='end', event_id=cursor)
+                if server_id is None:
+                    wlogger.clean(task_id)
+                return
+
+    return Response(stream_with_context(events()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+@index.route('/log/<task_id>/progress')
+def get_progress(task_id):
+    """Returns the number of messages logged for every server of the task by
+    level, so the progress of many servers can be shown without their logs.
+    """
     result = AsyncResult(id=task_id, app=celery)
-    value = 0
-    if result.state == 'SUCCESS' or result.state == 'FAILED':
-        value = result.result
-        wlogger.clean(task_id)
-    log = {'task_id': task_id, 'state': result.state, 'messages': msgs,
-           'result': value}
-    return jsonify(log)
+    return jsonify({'task_id': task_id, 'state': result.state,
+                    'servers': wlogger.get_progress(task_id)})
+
+
+@index.route('/log/<task_id>/output/<handle>')
+def get_output(task_id, handle):
+    """Returns the full text of a command output which the log only shows a
+    preview of. `?start=` and `?end=` select a range of characters."""
+    start = request.args.get('start', 0, type=int)
+    end = request.args.get('end', None, type=int)
+    found = wlogger.get_output(task_id, handle, start, end)
+    if found is None:
+        return jsonify({'message': 'The output has expired'}), 404
+    output, size = found
+    return jsonify({'output': output, 'start': start,
+                    'end': start + len(output), 'size': size})
+
+
+@index.route('/log/<task_id>/cancel', methods=['POST'])
+def cancel_task(task_id):
+    """Revokes the task. SIGUSR1 raises SoftTimeLimitExceeded inside the
+    running task, which kills the remote command it is waiting for. Only the
+    tasks which have started and not ended yet can be cancelled."""
+    state = AsyncResult(id=task_id, app=celery).state
+    if state in READY_STATES:
+        return jsonify({'task_id': task_id, 'state': state,
+                        'message': 'The task has already ended'}), 409
+    if state == PENDING:
+        return jsonify({'task_id': task_id, 'state': state,
+                        'message': 'The task is not running'}), 409
+    celery.control.revoke(task_id, terminate=True, signal='SIGUSR1')
+    wlogger.log(task_id, "Task cancelled by the user", "error")
+    return jsonify({'task_id': task_id}), 202
+
+
+@index.route('/history/')
+def task_history():
+    """Lists the slowest remote steps of the recorded task runs, optionally
+    of the runs of a single task given as `?task=`."""
+    name = request.args.get('task')
+    names = [n for (n,) in db.session.query(TaskRun.name).distinct()]
+    steps = slowest_steps(request.args.get('limit', 50, type=int), name)
+    return render_template('task_history.html', steps=steps, names=names,
+                           name=name)
 
 
 def getLdapConn(addr, dn, passwd):
@@ -306,7 +471,8 @@ def install_ldap_server():
 
 @index.route('/mmr/')
 def multi_master_replication():
-    """Multi Master Replication view"""
+    """Multi Master Replication view. The status of the servers comes from
+    the last snapshot taken, refer mmr_status()."""
     
     #Check if replication user (dn) and password has been configured
     app_config = AppConfiguration.query.first()
@@ -322,39 +488,45 @@ def multi_master_replication():
 
     ldaps = Server.query.all()
     serverStats = {}
-
-
-    #Collect replication information for all configured servers
-    for ldp in ldaps:
-
-        s = LdapOLC(
-            "ldaps://{0}:1636".format(ldp.hostname), "cn=config",
-            ldp.ldap_password)
-        r = None
-        try:
-            r = s.connect()
-        except Exception as e:
-            ldap_errors.append(
-                "Connection to LDAPserver {0} at port 1636 was failed:"
-                " {1}".format(ldp.hostname, e))
-
-        if r:
-            sstat = s.getMMRStatus()
-            if sstat['server_id']:
-                serverStats[ldp.hostname] = sstat
+    timed_out = []
 
     #If there is no ldap server, return to home
     if not ldaps:
         flash("Please add ldap servers.", "warning")
         return redirect(url_for('index.home'))
+
+    timeout = app.config.get('MMR_STATUS_TIMEOUT', 5)
+    snapshot = mmr_status(ldaps, timeout=timeout)
+    for hostname, result in snapshot['servers'].items():
+        if result['timed_out']:
+            timed_out.append(hostname)
+            ldap_errors.append(
+                "LDAPserver {0} did not answer in {1} seconds".format(
+                    hostname, timeout))
+        elif result['error']:
+            ldap_errors.append(
+                "Connection to LDAPserver {0} at port 1636 was failed:"
+                " {1}".format(hostname, result['error']))
+        elif result['status'] and result['status']['server_id']:
+            serverStats[hostname] = result['status']
         
     return render_template('multi_master.html', 
                            ldapservers=ldaps,
                            serverStats=serverStats,
                            ldap_errors=ldap_errors,
+                           timed_out=timed_out,
+                           age=int(time.time() - snapshot['taken_at']),
                            )
 
 
+@index.route('/mmr/refresh', methods=['POST'])
+def refresh_mmr_status():
+    """Takes a new snapshot of the replication status right away."""
+    mmr_status(Server.query.all(), refresh=True,
+               timeout=app.config.get('MMR_STATUS_TIMEOUT', 5))
+    return redirect(url_for('index.multi_master_replication'))
+
+
 @index.route('/addtestuser/<int:server_id>', methods=['GET', 'POST'])
 def add_test_user(server_id):
     """This view provides adding test user UI"""
@@ -459,6 +631,7 @@ def remove_provider_from_consumer(consumer_id, provider_addr):
         else:
             flash("Removing provider was failed: {0}".format(
                 ldp.conn.result['description']), "danger")
+        mmrsnapshots.clear()
 
     return redirect(url_for('index.multi_master_replication'))
 
@@ -477,10 +650,7 @@ def add_provider_to_consumer(consumer_id, provider_id):
     if ldp:
         provider = Server.query.get(provider_id)
 
-        if app_config.use_ip:
-            p_addr = provider.ip
-        else:
-            p_addr = provider.hostname
+        p_addr = hostindex.address(provider.hostname, app_config.use_ip)
 
         status = ldp.add_provider(
             provider.id, "ldaps://{0}:1636".format(p_addr),
@@ -496,6 +666,7 @@ def add_provider_to_consumer(consumer_id, provider_id):
 
         if not ldp.checkMirroMode():
             ldp.makeMirroMode()
+        mmrsnapshots.clear()
 
     return redirect(url_for('index.multi_master_replication'))
 
@@ -1,9 +1,82 @@
 """weblogger.py - flask extension providing storage facility via Redis.
 """
 
+import logging
+import os
+import threading
+import time
+import uuid
+import zlib
+
 import redis
 import json
 
+from contextlib import contextmanager
+
+
+# Log items are stored as the version byte followed by the compact JSON array
+# [msg, level, server_id, {other keys}], with the trailing empty fields left
+# out and the common levels stored as their index in LEVELS. Items written as
+# a JSON object by older versions are still read.
+ITEM_VERSION = '\x01'
+LEVELS = ('info', 'debug', 'success', 'warning', 'error', 'fail', 'cerror',
+          'danger')
+
+# Logs past max_items keep their newest messages. The number of the oldest
+# ones dropped is kept in the offset key of the log, so the cursors of the
+# readers, which count every message logged, stay valid. Both scripts take
+# the keys of the log and of its offset.
+CAP_SCRIPT = """
+local dropped = redis.call('llen', KEYS[1]) - tonumber(ARGV[1])
+if dropped > 0 then
+    redis.call('ltrim', KEYS[1], dropped, -1)
+    redis.call('incrby', KEYS[2], dropped)
+    redis.call('expire', KEYS[2], ARGV[2])
+end
+return dropped
+"""
+
+# returns the cursor of the first message read and the messages from ARGV[1]
+READ_SCRIPT = """
+local dropped = tonumber(redis.call('get', KEYS[2]) or '0')
+local start = math.max(tonumber(ARGV[1]) - dropped, 0)
+return {dropped + start, redis.call('lrange', KEYS[1], start, -1)}
+"""
+
+
+def pack_item(logitem):
+    """Encodes a log item dict in the compact format of the log lists."""
+    extra = dict((k, v) for k, v in logitem.iteritems()
+                 if k not in ('msg', 'level', 'server_id'))
+    level = logitem.get('level', 'info')
+    fields = [logitem['msg'], LEVELS.index(level) if level in LEVELS
+              else level, logitem.get('server_id'), extra]
+    while fields[-1] is None or fields[-1] == {}:
+        fields.pop()
+    return ITEM_VERSION + json.dumps(fields, separators=(',', ':'))
+
+
+def unpack_items(items):
+    """Decodes a list of log items, of either format, with a single call to
+    the JSON parser.
+    """
+    decoded = json.loads('[' + ','.join(
+        item[1:] if item[:1] == ITEM_VERSION else item for item in items) +
+        ']')
+    logitems = []
+    for fields in decoded:
+        if isinstance(fields, dict):
+            logitems.append(fields)
+            continue
+        logitem = fields[3] if len(fields) > 3 else {}
+        logitem['msg'] = fields[0]
+        level = fields[1] if len(fields) > 1 else 0
+        logitem['level'] = LEVELS[level] if isinstance(level, int) else level
+        if len(fields) > 2 and fields[2] is not None:
+            logitem['server_id'] = fields[2]
+        logitems.append(logitem)
+    return logitems
+
 
 class WebLogger(object):
     """WebLogger is a Redis wrapper to store task logs for flask view access.
@@ -24,6 +97,23 @@ class WebLogger(object):
         following values in the Flask application config:
         REDIS_HOST, REDIS_PORT, REDIS_LOG_DB
 
+        The buffering done inside buffered() is tuned with:
+        WEBLOGGER_BUFFER_SIZE - number of messages which trigger a flush
+        WEBLOGGER_BUFFER_AGE - seconds a message can wait in the buffer
+
+        The Redis memory used by the logs is bounded with:
+        WEBLOGGER_TTL - seconds a task log is kept after it was started
+        WEBLOGGER_MAX_ITEMS - number of messages kept per task, the oldest
+        ones are dropped
+        WEBLOGGER_MAX_ITEM_SIZE - characters kept of a single message
+
+        Command outputs are kept out of the log with:
+        WEBLOGGER_SPILL_SIZE - messages longer than this are stored compressed
+        under a key of their own, the log gets a preview. 0 disables it
+        WEBLOGGER_PREVIEW_SIZE - characters of the head and of the tail of a
+        stored output shown in the preview
+        WEBLOGGER_MAX_OUTPUT_SIZE - characters kept of a stored output
+
     Initialization::
 
         from flask import Flask
@@ -43,19 +133,45 @@ class WebLogger(object):
         the prefix `weblogger`
 
     Logging:
-        Refer log()
+        Refer log(). Inside buffered() the messages are sent in batches,
+        refer flush()
 
     Retrival:
-        Refer get_messages()
+        Refer get_messages(). Use the `since` argument to read a log
+        incrementally, with the cursor returned by poll(), or follow() to get
+        the messages as they are logged.
+        The messages logged with a `server_id` are indexed per server, pass
+        it to read the log of a single server and refer get_progress() for
+        the counters of every server.
+        The full text of the stored outputs is read with get_output()
 
     Cleanup:
-        Refer clean()
+        Refer clean() and sweep()
     """
 
-    def __init__(self, app=None):
+    def __init__(self, app=None, buffer_size=100, buffer_age=0.5,
+                 ttl=86400, max_items=10000, max_item_size=65536,
+                 spill_size=8192, preview_size=1024,
+                 max_output_size=16777216):
         self.app = app
         self.r = redis.Redis()
         self.prefix = 'weblogger'
+        self.buffer_size = buffer_size
+        self.buffer_age = buffer_age
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_item_size = max_item_size
+        self.spill_size = spill_size
+        self.preview_size = preview_size
+        self.max_output_size = max_output_size
+        self._buffer = []
+        self._buffered_since = None
+        self._buffering = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._flusher_pid = None
+        self._register_scripts()
         if app is not None:
             self.init_app(app)
 
@@ -64,13 +180,58 @@ class WebLogger(object):
         port = app.config['REDIS_PORT']
         db = app.config['REDIS_LOG_DB']
         self.prefix = app.name
+        self.buffer_size = app.config.get('WEBLOGGER_BUFFER_SIZE',
+                                          self.buffer_size)
+        self.buffer_age = app.config.get('WEBLOGGER_BUFFER_AGE',
+                                         self.buffer_age)
+        self.ttl = app.config.get('WEBLOGGER_TTL', self.ttl)
+        self.max_items = app.config.get('WEBLOGGER_MAX_ITEMS', self.max_items)
+        self.max_item_size = app.config.get('WEBLOGGER_MAX_ITEM_SIZE',
+                                            self.max_item_size)
+        self.spill_size = app.config.get('WEBLOGGER_SPILL_SIZE',
+                                         self.spill_size)
+        self.preview_size = app.config.get('WEBLOGGER_PREVIEW_SIZE',
+                                           self.preview_size)
+        self.max_output_size = app.config.get('WEBLOGGER_MAX_OUTPUT_SIZE',
+                                              self.max_output_size)
 
         self.r.connection_pool.disconnect()
         self.r = redis.Redis(host=host, port=port, db=db)
+        self._register_scripts()
+
+    def _register_scripts(self):
+        self._cap_script = self.r.register_script(CAP_SCRIPT)
+        self._read_script = self.r.register_script(READ_SCRIPT)
 
     def __key(self, taskid):
         return "{0}:{1}".format(self.prefix, taskid)
 
+    def __channel(self, taskid):
+        return "{0}:{1}:events".format(self.prefix, taskid)
+
+    def __output_key(self, taskid, handle):
+        return "{0}:{1}:output:{2}".format(self.prefix, taskid, handle)
+
+    def __server_key(self, taskid, server_id):
+        return "{0}:{1}:server:{2}".format(self.prefix, taskid, server_id)
+
+    def __progress_key(self, taskid, server_id):
+        return "{0}:{1}:progress:{2}".format(self.prefix, taskid, server_id)
+
+    def __servers_key(self, taskid):
+        return "{0}:{1}:servers".format(self.prefix, taskid)
+
+    def __eta_key(self, taskid):
+        return "{0}:{1}:eta".format(self.prefix, taskid)
+
+    def __log_key(self, taskid, server_id):
+        if server_id is None:
+            return self.__key(taskid)
+        return self.__server_key(taskid, server_id)
+
+    def __dropped_key(self, key):
+        return "{0}:dropped".format(key)
+
     def log(self, taskid, message, level=None, **kwargs):
         """R Pushes the message into REDIS as a list for that task id with the key
         <app.name>:<taskid>.
@@ -80,15 +241,30 @@ class WebLogger(object):
         { 'msg : <your_message>, 'level': <your_level>,
           'other_keys_from_kwargs': <kwarg_value>
         }
-        This dictionary would be json dumped into a string and Rpushed into the
-        redis with the key `<app.name>:<task_id>`
+        This dictionary would be packed into a string, refer pack_item(), and
+        Rpushed into the redis with the key `<app.name>:<task_id>`. Messages
+        with a `server_id` are also pushed to the log of that server and
+        counted in its progress, refer get_progress(). The keys expire `ttl`
+        seconds after the first message, messages longer than `max_item_size`
+        are cut in the middle and only the newest `max_items` messages are
+        kept.
+
+        Messages longer than `spill_size`, like the output of a chatty
+        command, are stored compressed under a key of their own, which
+        expires with the log. The entry of the log then carries a preview of
+        the head and tail of the message as `msg`, the handle to read it back
+        with get_output() as `output` and its length as `size`.
 
         Args:
             taskid (string) - a unique id to identify the task
             message (string) - the log message to be stored
             level (string)  - levels like 'info', 'debug'. Defaults to info
         """
-        logitem = {'msg': message.strip()}
+        message = message.strip()
+        if self.spill_size and len(message) > self.spill_size:
+            logitem = self._spill(taskid, message)
+        else:
+            logitem = {'msg': self._cut(message, self.max_item_size)}
         if level:
             logitem['level'] = level
         else:
@@ -97,27 +273,382 @@ class WebLogger(object):
         for k, v in kwargs.iteritems():
             logitem[k] = v
 
-        self.r.rpush(self.__key(taskid), json.dumps(logitem))
+        item = (taskid, pack_item(logitem), logitem.get('server_id'),
+                logitem['level'])
+        if not self._buffering:
+            self._send([item])
+            return
+
+        with self._lock:
+            if not self._buffer:
+                self._buffered_since = time.time()
+            self._buffer.append(item)
+            full = len(self._buffer) >= self.buffer_size or \
+                time.time() - self._buffered_since >= self.buffer_age
+        if full:
+            self.flush()
+
+    @contextmanager
+    def buffered(self):
+        """Buffers the messages logged inside the block, from any thread of
+        the process, and sends them to Redis in batches through a pipeline.
+        A batch is sent when it holds `buffer_size` messages, when its oldest
+        message is `buffer_age` seconds old and at the end of the block.
+        Call flush() before an operation which blocks for long without
+        logging, so its preceding messages are visible while it runs.
+        """
+        with self._lock:
+            self._buffering += 1
+        self._start_flusher()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._buffering -= 1
+            self.flush()
+
+    def flush(self):
+        """Sends the buffered messages to Redis in a single round-trip,
+        keeping the order in which they were logged.
+        """
+        with self._flush_lock:
+            with self._lock:
+                items, self._buffer = self._buffer, []
+            if not items:
+                return
+            self._send(items)
+
+    def _send(self, items):
+        # pushes the messages, indexes the ones logged for a server and tells
+        # the followers in a single round-trip, the logs which went past
+        # max_items are capped in a second one
+        pipe = self.r.pipeline(transaction=False)
+        keys = []
+        taskids = []
+        for taskid, logitem, _, _ in items:
+            keys.append(self.__key(taskid))
+            pipe.rpush(keys[-1], logitem)
+            if taskid not in taskids:
+                taskids.append(taskid)
+        indexed = [item for item in items if item[2] is not None]
+        keys.extend(self._index(pipe, indexed))
+        for taskid in taskids:
+            pipe.expire(self.__key(taskid), self.ttl)
+            pipe.publish(self.__channel(taskid), 'log')
+        results = pipe.execute()
+
+        # every indexed message took six commands, the first is the push
+        lengths = results[:len(items)] + \
+            results[len(items):len(items) + 6 * len(indexed):6]
+        full = set(key for key, length in zip(keys, lengths)
+                   if length > self.max_items)
+        if full:
+            self._cap(full)
+
+    def _index(self, pipe, items):
+        # queues the pushes of the messages to the logs of their servers and
+        # their counts by level, returns the keys of the server logs
+        keys = []
+        for taskid, logitem, server_id, level in items:
+            key = self.__server_key(taskid, server_id)
+            progress = self.__progress_key(taskid, server_id)
+            keys.append(key)
+            pipe.rpush(key, logitem)
+            pipe.expire(key, self.ttl)
+            pipe.hincrby(progress, level, 1)
+            pipe.expire(progress, self.ttl)
+            pipe.sadd(self.__servers_key(taskid), server_id)
+            pipe.expire(self.__servers_key(taskid), self.ttl)
+        return keys
+
+    @staticmethod
+    def _cut(message, size):
+        if len(message) <= size:
+            return message
+        if isinstance(message, str):
+            # don't cut a multibyte character in half
+            message = message.decode('utf-8', 'replace')
+        half = size // 2
+        return message[:half] + "\n... [%d characters truncated] ...\n" % (
+            len(message) - 2 * half) + message[-half:]
+
+    def _spill(self, taskid, message):
+        # the output is stored before the log entry pointing to it is pushed,
+        # so the handle is valid as soon as a reader sees it
+        if isinstance(message, str):
+            message = message.decode('utf-8', 'replace')
+        message = self._cut(message, self.max_output_size)
+        handle = uuid.uuid4().hex
+        self.r.setex(self.__output_key(taskid, handle),
+                     zlib.compress(message.encode('utf-8')), self.ttl)
+        preview = self._cut(message, 2 * self.preview_size)
+        return {'msg': preview, 'output': handle, 'size': len(message)}
+
+    def _cap(self, keys):
+        # drops the oldest messages and counts them in the offset of the log,
+        # returns the number dropped from every key, refer CAP_SCRIPT
+        pipe = self.r.pipeline(transaction=False)
+        for key in keys:
+            self._cap_script(keys=[key, self.__dropped_key(key)],
+                             args=[self.max_items, self.ttl], client=pipe)
+        return pipe.execute()
+
+    def _read(self, taskid, since, server_id, client=None):
+        # the messages from the cursor `since`, refer READ_SCRIPT
+        key = self.__log_key(taskid, server_id)
+        return self._read_script(keys=[key, self.__dropped_key(key)],
+                                 args=[max(since, 0)], client=client)
+
+    def _start_flusher(self):
+        # flushes the messages past buffer_age when no new message triggers
+        # it; threads do not survive a fork, so every worker starts its own
+        with self._lock:
+            if self._flusher_pid == os.getpid() and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._flush_aged)
+            self._flusher.daemon = True
+            self._flusher_pid = os.getpid()
+            self._flusher.start()
+
+    def _flush_aged(self):
+        while True:
+            time.sleep(self.buffer_age)
+            with self._lock:
+                aged = self._buffer and \
+                    time.time() - self._buffered_since >= self.buffer_age
+            if aged:
+                try:
+                    self.flush()
+                except redis.RedisError:
+                    logging.exception("Could not flush the buffered logs")
+
+    def finish(self, taskid, state):
+        """Announces to the followers of the log that the task has ended.
+
+        Args:
+            taskid (string) - the unique id of the task
+            state (string) - the final celery state of the task
+        """
+        self.flush()
+        self.r.publish(self.__channel(taskid), 'end:{0}'.format(state))
+
+    def set_eta(self, taskid, eta):
+        """Stores the estimate of how far the task is and how long it still
+        needs, replacing the previous one, and tells the followers of the log.
 
-    def get_messages(self, taskid):
-        """Returns all the messages pushed by a task.
+        Args:
+            taskid (string) - the unique id of the task
+            eta (dict) - the estimate, refer
+                :class:`clustermgr.core.history.TaskProgress`
+        """
+        pipe = self.r.pipeline(transaction=False)
+        pipe.setex(self.__eta_key(taskid), json.dumps(eta), self.ttl)
+        pipe.publish(self.__channel(taskid), 'eta')
+        pipe.execute()
+
+    def get_eta(self, taskid):
+        """Returns the last estimate stored by set_eta() for the task, or None
+        when the task does not report one.
+
+        Args:
+            taskid (string) - the unique id of the task
+        """
+        eta = self.r.get(self.__eta_key(taskid))
+        return json.loads(eta) if eta else None
+
+    def get_messages(self, taskid, since=0, server_id=None):
+        """Returns the messages pushed by a task. Pollers can pass the number
+        of messages they already have as `since` to get only the new ones,
+        instead of fetching the whole log every time.
+
+        The cursor counts every message logged, including the oldest ones
+        dropped past `max_items`, so it stays valid when the log is capped.
+        The messages are returned from the oldest one kept when `since`
+        points before it, use poll() to get the cursor past them.
 
         Args:
             taskid (string) - The unique id of the task
+            since (int) - index of the first message to return. Defaults to 0
+            server_id - only return the messages logged for this server, the
+                cursor `since` then counts the messages of the server
 
         Returns:
-            list of dicts containing all the messages posted with the given
-            task id
+            list of dicts containing the messages posted with the given
+            task id, starting from `since`
         """
-        messages = self.r.lrange(self.__key(taskid), 0, -1)
+        first, messages = self._read(taskid, since, server_id)
         if not messages:
             return []
-        return [json.loads(msg) for msg in messages]
+        return unpack_items(messages)
+
+    def poll(self, taskid, since=0, server_id=None, result_key=None):
+        """Returns the new messages of a task like get_messages() along with
+        its estimate, refer get_eta(), and the value of another key, like the
+        one where celery keeps the result of the task, reading all of them in
+        a single round-trip.
+
+        Args:
+            taskid (string) - The unique id of the task
+            since (int) - index of the first message to return. Defaults to 0
+            server_id - only return the messages logged for this server
+            result_key (string) - the key to read along with the messages
+
+        Returns:
+            tuple of the list of the messages, the estimate, the value of
+            `result_key`, which is None when it is not given or does not
+            exist, and the cursor to pass as `since` for the next messages
+        """
+        pipe = self.r.pipeline(transaction=False)
+        self._read(taskid, since, server_id, client=pipe)
+        pipe.get(self.__eta_key(taskid))
+        if result_key:
+            pipe.get(result_key)
+        results = pipe.execute()
+        first, messages = results[0]
+        messages = unpack_items(messages) if messages else []
+        eta = json.loads(results[1]) if results[1] else None
+        return (messages, eta, results[2] if result_key else None,
+                first + len(messages))
+
+    def get_output(self, taskid, handle, start=0, end=None):
+        """Returns the full text of a message stored apart from the log,
+        refer log(). It can be read in ranges of characters.
+
+        Args:
+            taskid (string) - the unique id of the task
+            handle (string) - the `output` value of the log entry
+            start (int) - index of the first character to return
+            end (int) - index past the last character to return, defaults to
+                the end of the output
+
+        Returns:
+            tuple of the requested text and the length of the whole output,
+            or None when the output does not exist or has expired
+        """
+        if not all(c in '0123456789abcdef' for c in handle):
+            return None
+        data = self.r.get(self.__output_key(taskid, handle))
+        if data is None:
+            return None
+        output = zlib.decompress(data).decode('utf-8')
+        return output[start:end], len(output)
+
+    def get_progress(self, taskid, server_id=None):
+        """Returns the number of messages logged for a server by level, like
+        the `success` steps done or the `error` ones, without reading its
+        log.
+
+        Args:
+            taskid (string) - the unique id of the task
+            server_id - the server to count the messages of. Defaults to all
+                the servers the task logged messages for
+
+        Returns:
+            dict of the counts by level, or a dict of those by server id
+            when `server_id` is not given
+        """
+        def counts(progress):
+            return dict((level, int(n)) for level, n in progress.iteritems())
+
+        if server_id is not None:
+            return counts(self.r.hgetall(
+                self.__progress_key(taskid, server_id)))
+
+        servers = sorted(self.r.smembers(self.__servers_key(taskid)))
+        pipe = self.r.pipeline(transaction=False)
+        for sid in servers:
+            pipe.hgetall(self.__progress_key(taskid, sid))
+        return dict((sid, counts(progress)) for sid, progress
+                    in zip(servers, pipe.execute()))
+
+    def follow(self, taskid, since=0, timeout=5, server_id=None):
+        """Generator over the messages of a task as they are logged. It waits
+        on a Redis pub/sub channel instead of polling the log.
+
+        Every item is a tuple of the list of the new messages, the current
+        estimate of the task, refer get_eta(), its final state, which is
+        None until finish() is called for the task, and the cursor past the
+        messages, refer poll(). An empty list is yielded
+        when nothing happened for `timeout` seconds, so the caller can send
+        keepalives or check on the task.
+
+        Args:
+            taskid (string) - the unique id of the task
+            since (int) - index of the first message to return. Defaults to 0
+            timeout (int) - seconds to wait for new messages at a time
+            server_id - only follow the messages logged for this server
+        """
+        pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.__channel(taskid))
+        try:
+            # the messages logged before the subscription
+            messages, eta, _, since = self.poll(taskid, since, server_id)
+            yield messages, eta, None, since
+
+            while True:
+                event = pubsub.get_message(timeout=timeout)
+                state = None
+                # one read for all the messages announced meanwhile
+                while event:
+                    if event['data'].startswith('end:'):
+                        state = event['data'][4:]
+                    event = pubsub.get_message()
+                messages, eta, _, since = self.poll(taskid, since, server_id)
+                yield messages, eta, state, since
+        finally:
+            pubsub.reset()
+
+    def sweep(self):
+        """Applies the retention limits to the task logs which do not have
+        them, like the ones written by older versions. Meant to be run
+        periodically.
+
+        Returns:
+            dict with the number of `keys` checked, how many got an
+            expiry (`expired`) or were `trimmed`, and the number of messages
+            `dropped` by the trimming
+        """
+        stats = {'keys': 0, 'expired': 0, 'trimmed': 0, 'dropped': 0}
+
+        for key in self.r.scan_iter("{0}:*".format(self.prefix), count=500):
+            pipe = self.r.pipeline(transaction=False)
+            pipe.type(key)
+            pipe.ttl(key)
+            pipe.llen(key)
+            try:
+                kind, ttl, length = pipe.execute()
+            except redis.ResponseError:
+                continue  # not a list
+            if kind != 'list':
+                continue
+
+            stats['keys'] += 1
+            if ttl is None or ttl < 0:
+                self.r.expire(key, self.ttl)
+                stats['expired'] += 1
+            if length > self.max_items:
+                stats['dropped'] += sum(self._cap([key]))
+                stats['trimmed'] += 1
+
+        logging.info("Swept %(keys)s task logs: %(expired)s got an expiry, "
+                     "%(trimmed)s trimmed, %(dropped)s messages dropped",
+                     stats)
+        return stats
 
     def clean(self, taskid):
-        """Removes the log for the particular task id
+        """Removes the log for the particular task id, along with its
+        estimate and the logs and the progress of its servers. The outputs
+        stored apart from it are left to expire, as they are read on demand
+        after the task has ended.
 
         Args:
             taskid (string) - the unique id of the task
         """
-        self.r.delete(self.__key(taskid))
+        servers = self.r.smembers(self.__servers_key(taskid))
+        keys = [self.__key(taskid), self.__dropped_key(self.__key(taskid)),
+                self.__servers_key(taskid), self.__eta_key(taskid)]
+        for sid in servers:
+            keys.append(self.__server_key(taskid, sid))
+            keys.append(self.__dropped_key(self.__server_key(taskid, sid)))
+            keys.append(self.__progress_key(taskid, sid))
+        self.r.delete(*keys)
@@ -0,0 +1,72 @@
+import threading
+import time
+import unittest
+
+from mock import MagicMock
+
+from clustermgr.core.fanout import FanOut
+
+
+class Host(object):
+    def __init__(self, id, hostname):
+        self.id = id
+        self.hostname = hostname
+
+
+class FanOutTestCase(unittest.TestCase):
+    def test_run_returns_results_in_order_of_items(self):
+        result = FanOut(max_workers=3).run(lambda x: x * 2, [1, 2, 3, 4])
+        self.assertEqual(result.values(), [2, 4, 6, 8])
+        assert result.all_ok
+
+    def test_run_limits_concurrency_to_max_workers(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+        both_running = threading.Event()
+
+        def work(item):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+                if state['running'] == 2:
+                    both_running.set()
+            # the first two hold their slot until they run side by side
+            if item < 2:
+                both_running.wait(5)
+            with lock:
+                state['running'] -= 1
+
+        FanOut(max_workers=2).run(work, range(6))
+        self.assertEqual(state['peak'], 2)
+
+    def test_errors_are_collected_and_logged_with_server_id(self):
+        logger = MagicMock()
+
+        def work(host):
+            if host.id == 2:
+                raise ValueError('boom')
+            return host.id
+
+        hosts = [Host(1, 'one'), Host(2, 'two')]
+        result = FanOut(tid='tid', logger=logger).run(work, hosts)
+
+        self.assertEqual(result.values(), [1])
+        self.assertEqual([r.item for r in result.failed], [hosts[1]])
+        args, kwargs = logger.log.call_args
+        self.assertIn('boom', args[1])
+        self.assertEqual(kwargs['server_id'], 2)
+
+    def test_slow_hosts_are_marked_timed_out(self):
+        def work(delay):
+            time.sleep(delay)
+            return delay
+
+        start = time.time()
+        result = FanOut(timeout=0.1).run(work, [0, 1])
+        assert time.time() - start < 0.5
+        self.assertEqual(result.values(), [0])
+        self.assertEqual([r.item for r in result.timed_out], [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
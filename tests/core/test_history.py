@@ -0,0 +1,123 @@
+import time
+import unittest
+
+from mock import patch
+
+from clustermgr.application import create_app
+from clustermgr.extensions import db
+from clustermgr.models import TaskRun, TaskStep
+from clustermgr.core.history import TaskHistory, TaskProgress, \
+    task_history, slowest_steps
+from clustermgr.core.remote import record_step
+
+
+def step(command, duration, exit_status=0):
+    started = time.time()
+    return dict(host='server', kind='command', command=command,
+                started=started, ended=started + duration,
+                exit_status=exit_status, sent=0, received=10)
+
+
+class TaskHistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.app.config.from_object('clustermgr.config.TestingConfig')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_runs_without_steps_are_not_stored(self):
+        with task_history('tid', 'clustermgr.tasks.all.rotate_pub_keys'):
+            pass
+        self.assertEqual(TaskRun.query.count(), 0)
+
+    def test_steps_are_written_in_batches(self):
+        history = TaskHistory('tid', 'clustermgr.tasks.cluster.setup', 2)
+        history(step('ls', 1))
+        self.assertEqual(TaskStep.query.count(), 0)
+        history(step('slaptest', 5, 1))
+        self.assertEqual(TaskStep.query.count(), 2)
+        history(step('pwd', 0.5))
+        history.finish('SUCCESS')
+
+        run = TaskRun.query.one()
+        self.assertEqual((run.task_id, run.state), ('tid', 'SUCCESS'))
+        self.assertEqual(run.steps.count(), 3)
+
+    def test_task_history_records_remote_steps_and_failures(self):
+        with self.assertRaises(ValueError):
+            with task_history('tid', 'clustermgr.tasks.cluster.setup'):
+                record_step('server', 'upload', '/etc/slapd.conf',
+                            time.time() - 2, sent=100)
+                raise ValueError()
+
+        self.assertEqual(TaskRun.query.one().state, 'FAILURE')
+        self.assertEqual(TaskStep.query.one().bytes_sent, 100)
+
+    def test_slowest_steps_are_sorted_by_duration(self):
+        history = TaskHistory('tid', 'clustermgr.tasks.cluster.setup')
+        for command, duration in (('ls', 1), ('yum update', 60),
+                                  ('slaptest', 5)):
+            history(step(command, duration))
+        history.finish('SUCCESS')
+
+        steps = slowest_steps(2)
+        self.assertEqual([s.command for s in steps], ['yum update', 'slaptest'])
+        self.assertEqual(slowest_steps(name='other'), [])
+
+    def test_slowest_steps_leave_out_the_phases(self):
+        history = TaskHistory('tid', 'clustermgr.tasks.cluster.installNGINX')
+        history(step('apt-get install -y nginx', 20))
+        phase = step('Installing NGINX', 25)
+        phase.update(kind='phase', exit_status=None)
+        history(phase)
+        history.finish('SUCCESS')
+
+        steps = slowest_steps()
+        self.assertEqual([(s.kind, s.command) for s in steps],
+                         [('command', 'apt-get install -y nginx')])
+
+    @patch('clustermgr.core.history.wlogger')
+    def test_progress_is_estimated_from_the_phases_of_past_runs(self, mocklog):
+        name = 'clustermgr.tasks.cluster.installNGINX'
+        phases = ['Installing NGINX', 'Configuring NGINX']
+        history = TaskHistory('old', name)
+        for label, seconds, os_type in (('Installing NGINX', 30, 'CentOS 7'),
+                                        ('Installing NGINX', 90, 'Ubuntu 16'),
+                                        ('Configuring NGINX', 10, None)):
+            started = time.time()
+            history(dict(host='nginx', kind='phase', command=label,
+                         started=started, ended=started + seconds,
+                         exit_status=None, sent=0, received=0, os=os_type))
+        history.finish('SUCCESS')
+
+        progress = TaskProgress('new', name, phases, 'CentOS 7')
+        progress.step('Installing NGINX')
+        mocklog.set_eta.assert_called_with('new', {
+            'step': 1, 'steps': 2, 'label': 'Installing NGINX', 'percent': 0,
+            'remaining': 40})
+        progress.started -= 20
+        self.assertEqual(progress.eta()['remaining'], 20)
+        # a phase running past its estimate counts as about to end
+        progress.started -= 15
+        self.assertEqual(progress.eta()['remaining'], 10)
+        progress.step('Configuring NGINX')
+        self.assertEqual(progress.eta()['percent'], 75)
+        progress.done()
+        mocklog.set_eta.assert_called_with('new', {
+            'step': 2, 'steps': 2, 'label': None, 'percent': 100,
+            'remaining': 0})
+
+        # a phase never timed before gives no time estimate
+        progress = TaskProgress('other', name, phases + ['Restarting NGINX'])
+        progress.step('Configuring NGINX')
+        self.assertEqual(progress.eta()['remaining'], None)
+        self.assertEqual(progress.eta()['percent'], 33)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from clustermgr.application import create_app
+from clustermgr.extensions import db
+from clustermgr.models import Server
+from clustermgr.core.hosts import hostindex
+
+
+class HostIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.app.config.from_object('clustermgr.config.TestingConfig')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        hostindex.invalidate()
+        self.add_server('ldap.example.com', '10.0.0.2')
+
+    def tearDown(self):
+        db.drop_all()
+        self.ctx.pop()
+
+    def add_server(self, hostname, ip):
+        server = Server()
+        server.hostname = hostname
+        server.ip = ip
+        db.session.add(server)
+        db.session.commit()
+        return server
+
+    def test_lookups_work_both_ways(self):
+        self.assertEqual(hostindex.hostname('10.0.0.2'), 'ldap.example.com')
+        self.assertEqual(hostindex.ip('ldap.example.com'), '10.0.0.2')
+        self.assertIsNone(hostindex.hostname('10.0.0.9'))
+        self.assertEqual(hostindex.address('ldap.example.com'),
+                         'ldap.example.com')
+        self.assertEqual(hostindex.address('ldap.example.com', use_ip=True),
+                         '10.0.0.2')
+
+    def test_index_is_not_read_again_until_invalidated(self):
+        hostindex.ip('ldap.example.com')
+        db.session.execute("UPDATE server SET ip='10.0.0.3'")
+        db.session.commit()
+        self.assertEqual(hostindex.ip('ldap.example.com'), '10.0.0.2')
+        hostindex.invalidate()
+        self.assertEqual(hostindex.ip('ldap.example.com'), '10.0.0.3')
+
+    def test_changes_to_servers_invalidate_the_index(self):
+        hostindex.ip('ldap.example.com')
+        server = self.add_server('other.example.com', '10.0.0.4')
+        self.assertEqual(hostindex.hostname('10.0.0.4'), 'other.example.com')
+        server.ip = '10.0.0.5'
+        db.session.commit()
+        self.assertEqual(hostindex.hostname('10.0.0.5'), 'other.example.com')
+        db.session.delete(server)
+        db.session.commit()
+        self.assertIsNone(hostindex.ip('other.example.com'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,11 +3,14 @@ import unittest
 from mock import patch
 
 from clustermgr.core.ldap_functions import LdapOLC, MODIFY_ADD, MODIFY_DELETE
+from clustermgr.core.ldap_pool import LdapConnectionPool
 
 
 class LdapOlcTestCase(unittest.TestCase):
     def setUp(self):
-        with patch('clustermgr.core.ldap_functions.Connection') as mockconn:
+        with patch('clustermgr.core.ldap_pool.Connection') as mockconn, \
+                patch('clustermgr.core.ldap_functions.ldappool',
+                      LdapConnectionPool()):
             self.conn = mockconn.return_value
             self.mgr = LdapOLC("0.0.0.0", "cn=config", "secret")
             self.mgr.connect()
@@ -29,6 +32,26 @@ class LdapOlcTestCase(unittest.TestCase):
         # modify should be called twice, once with delete and another with add
         assert self.mgr.conn.modify.call_count == 2
 
+    def test_get_mmr_status_reads_cn_config_with_one_search(self):
+        self.mgr.conn.search.return_value = True
+        self.mgr.conn.response = [
+            {'dn': 'cn=config', 'attributes': {'olcServerID': ['2']}},
+            {'dn': 'olcDatabase={1}mdb,cn=config', 'attributes': {
+                'olcMirrorMode': True, 'olcSyncrepl': [
+                    '{0}rid=1 provider=ldaps://a.example.com:1636']}},
+            {'dn': 'olcOverlay={0}syncprov,olcDatabase={1}mdb,cn=config',
+             'attributes': {'olcOverlay': ['{0}syncprov'],
+                            'objectClass': ['olcOverlayConfig']}},
+            {'dn': 'olcDatabase={2}mdb,cn=config',
+             'attributes': {'olcSuffix': ['cn=accesslog']}},
+        ]
+        status = self.mgr.getMMRStatus()
+        self.mgr.conn.search.assert_called_once()
+        self.assertEqual(status, {
+            'server_id': '2', 'overlaysDB1': True, 'overlaysDB2': False,
+            'mirrorMode': True, 'accesslogDB': True, 'accesslogPurge': False,
+            'providers': {'a.example.com': ('1', '1636', 'a.example.com')}})
+
 
 if __name__ == '__main__':
     unittest.main()
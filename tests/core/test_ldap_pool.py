@@ -0,0 +1,91 @@
+import unittest
+
+from mock import patch, MagicMock
+
+from ldap3.core.exceptions import LDAPSocketReceiveError
+
+from clustermgr.core.ldap_pool import LdapConnectionPool
+
+
+class Owner(object):
+    pass
+
+
+class LdapConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.patcher = patch('clustermgr.core.ldap_pool.Connection')
+        self.mockconn = self.patcher.start()
+        self.mockconn.side_effect = lambda *args, **kwargs: MagicMock(
+            bound=True, closed=False)
+        self.pool = LdapConnectionPool(ttl=60, max_size=1, check_interval=10)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def get(self, **kwargs):
+        return self.pool.get('ldaps://server:1636', 'cn=config', 'secret',
+                             **kwargs)
+
+    def test_released_connection_is_reused_for_same_dn(self):
+        c1 = self.get()
+        self.pool.release(c1)
+        c2 = self.get()
+        assert c1 is c2
+        self.mockconn.assert_called_once()
+        c1.bind.assert_called_once()
+
+    def test_borrowed_connection_is_not_shared(self):
+        c1 = self.get()
+        c2 = self.get()
+        assert c1 is not c2
+        self.pool.release(c1)
+        self.pool.release(c2)
+        # only max_size idle connections are kept
+        c2.unbind.assert_called_once()
+
+    def test_connection_of_another_dn_or_password_is_not_reused(self):
+        c1 = self.get()
+        self.pool.release(c1)
+        c2 = self.pool.get('ldaps://server:1636', 'cn=directory manager',
+                           'secret')
+        assert c1 is not c2
+        self.pool.release(c2)
+        c3 = self.pool.get('ldaps://server:1636', 'cn=config', 'changed')
+        assert c3 is not c1
+        c1.unbind.assert_called_once()
+
+    @patch('clustermgr.core.ldap_pool.time.time')
+    def test_idle_connection_is_checked_and_rebound(self, mocktime):
+        mocktime.return_value = 1000
+        c1 = self.get()
+        self.pool.release(c1)
+        mocktime.return_value = 1011
+        c1.search.side_effect = LDAPSocketReceiveError
+        assert self.get() is c1
+        c1.unbind.assert_called_once()
+        assert c1.bind.call_count == 2
+
+    @patch('clustermgr.core.ldap_pool.time.time')
+    def test_evict_idle_unbinds_connections_past_ttl(self, mocktime):
+        mocktime.return_value = 1000
+        c1 = self.get()
+        self.pool.release(c1)
+        mocktime.return_value = 1061
+        assert self.pool.evict_idle() == 1
+        c1.unbind.assert_called_once()
+
+    def test_connection_goes_back_when_owner_is_collected(self):
+        owner = Owner()
+        c1 = self.get(owner=owner)
+        del owner
+        assert self.get() is c1
+
+    def test_unbound_connection_is_not_pooled(self):
+        c1 = self.get()
+        c1.bound = False
+        self.pool.release(c1)
+        assert self.get() is not c1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,47 @@
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
+from StringIO import StringIO
+
 from mock import patch, MagicMock
 from paramiko import SSHException
 
-from clustermgr.core.remote import RemoteClient, ClientNotSetupException
+from clustermgr.core.remote import RemoteClient, ClientNotSetupException, \
+    RemoteClientPool, CommandStream, parse_batch_output, tree_member_selected, \
+    CommandTimeout, RunningCommand, task_deadline, command_deadline, \
+    ContainerSession, FramedChannel, recording_steps
+
+
+class FakeChannel(object):
+    """Channel replaying a scripted list of (stream, data) reads."""
+    closed = False
+
+    def __init__(self, reads, status=0):
+        self.reads = list(reads)
+        self.status = status
+
+    def _ready(self, name):
+        return bool(self.reads) and self.reads[0][0] == name
+
+    def recv_ready(self):
+        return self._ready('stdout')
+
+    def recv_stderr_ready(self):
+        return self._ready('stderr')
+
+    def recv(self, size):
+        return self.reads.pop(0)[1]
+
+    recv_stderr = recv
+
+    def exit_status_ready(self):
+        return not self.reads
+
+    def recv_exit_status(self):
+        return self.status
 
 
 class RemoteClientTestCase(unittest.TestCase):
@@ -62,6 +100,413 @@ class RemoteClientTestCase(unittest.TestCase):
             self.rc.exists('s')
         with self.assertRaises(ClientNotSetupException):
             self.rc.run('s')
+        with self.assertRaises(ClientNotSetupException):
+            self.rc.run_batch(['s'])
+        with self.assertRaises(ClientNotSetupException):
+            self.rc.run_stream('s')
+
+    def test_stat_many_probes_all_paths_in_one_command(self):
+        cout = MagicMock()
+        cout.read.return_value = ("0|4096|1500000000|755|directory\n"
+                                  "1|\n"
+                                  "2|12|1500000001|644|regular file\n")
+        self.rc.client.exec_command.return_value = (MagicMock(), cout,
+                                                    MagicMock())
+        stats = self.rc.stat_many(['/opt', '/missing', "/it's"])
+
+        self.rc.client.exec_command.assert_called_once()
+        self.assertEqual(stats['/opt']['type'], 'dir')
+        self.assertEqual(stats['/opt']['mode'], 0o755)
+        self.assertFalse(stats['/missing']['exists'])
+        self.assertIsNone(stats['/missing']['size'])
+        self.assertEqual(stats["/it's"]['size'], 12)
+        self.assertEqual(stats["/it's"]['mtime'], 1500000001)
+
+    def test_exists_uses_stat_many(self):
+        cout = MagicMock()
+        cout.read.return_value = "0|\n"
+        self.rc.client.exec_command.return_value = (MagicMock(), cout,
+                                                    MagicMock())
+        self.assertFalse(self.rc.exists('/missing'))
+
+    def test_sync_file_skips_upload_when_checksum_matches(self):
+        cout = MagicMock()
+        cout.read.return_value = "9a0364b9e99bb480dd25e1f0284c8555  /etc/f\n"
+        self.rc.client.exec_command.return_value = (MagicMock(), cout,
+                                                    MagicMock())
+        self.assertEqual(self.rc.sync_file('/etc/f', content='content'),
+                         (True, False))
+        self.rc.sftpclient.putfo.assert_not_called()
+
+    def test_sync_file_uploads_when_remote_differs_or_is_missing(self):
+        cout = MagicMock()
+        cout.read.return_value = ""
+        self.rc.client.exec_command.return_value = (MagicMock(), cout,
+                                                    MagicMock())
+        self.assertEqual(self.rc.sync_file('/etc/f', content='content'),
+                         (True, True))
+        self.assertEqual(self.rc.sftpclient.putfo.call_args[0][0].read(),
+                         'content')
+
+    def test_sync_file_writes_unicode_content_as_utf8(self):
+        cout = MagicMock()
+        cout.read.return_value = ""
+        self.rc.client.exec_command.return_value = (MagicMock(), cout,
+                                                    MagicMock())
+        self.assertEqual(self.rc.sync_file('/etc/f', content=u'caf\xe9'),
+                         (True, True))
+        self.assertEqual(self.rc.sftpclient.putfo.call_args[0][0].read(),
+                         'caf\xc3\xa9')
+
+    def test_sync_file_never_takes_content_for_a_local_path(self):
+        cout = MagicMock()
+        cout.read.return_value = ""
+        self.rc.client.exec_command.return_value = (MagicMock(), cout,
+                                                    MagicMock())
+        self.rc.sync_file('/etc/f', content=__file__)
+        self.assertEqual(self.rc.sftpclient.putfo.call_args[0][0].read(),
+                         __file__)
+        self.rc.sync_file('/etc/f', local_path=__file__)
+        with open(__file__, 'rb') as f:
+            self.assertEqual(
+                self.rc.sftpclient.putfo.call_args[0][0].read(), f.read())
+
+    def test_relay_file_streams_chunks_to_every_target(self):
+        src = StringIO('x' * 10)
+        src.prefetch = MagicMock()
+        self.rc.sftpclient.open.return_value = src
+        written = StringIO()
+        good, bad = MagicMock(), MagicMock()
+        good.sftpclient.open.return_value = MagicMock(write=written.write)
+        bad.sftpclient.open.return_value.write.side_effect = IOError('full')
+
+        results = self.rc.relay_file('/etc/f', [good, bad], '/etc/g',
+                                     chunk_size=3, max_chunks=1)
+        self.assertEqual(results[0], (True, 10))
+        self.assertFalse(results[1][0])
+        self.assertEqual(written.getvalue(), 'x' * 10)
+        good.sftpclient.open.assert_called_once_with('/etc/g', 'wb')
+
+    def test_push_tree_and_pull_tree_transfer_one_tar_stream(self):
+        src, dst = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src)
+        self.addCleanup(shutil.rmtree, dst)
+        os.mkdir(os.path.join(src, 'sub'))
+        for name in ('a.schema', 'b.txt', 'sub/c.schema'):
+            with open(os.path.join(src, name), 'w') as f:
+                f.write(name)
+
+        cin, cout = StringIO(), MagicMock()
+        cin.channel = MagicMock()
+        cout.channel.recv_exit_status.return_value = 0
+        self.rc.client.exec_command.return_value = (cin, cout, MagicMock())
+        status, pushed = self.rc.push_tree(src, '/remote', include=['*.schema'])
+        self.assertTrue(status)
+        self.assertEqual(sorted(pushed), ['a.schema', 'sub/c.schema'])
+        cin.channel.shutdown_write.assert_called_once()
+
+        cout = StringIO(cin.getvalue())
+        cout.channel = MagicMock()
+        cout.channel.recv_exit_status.return_value = 0
+        self.rc.client.exec_command.return_value = (MagicMock(), cout,
+                                                    MagicMock())
+        status, pulled = self.rc.pull_tree('/remote', dst, exclude=['sub/*'])
+        self.assertEqual(pulled, ['a.schema'])
+        with open(os.path.join(dst, 'a.schema')) as f:
+            self.assertEqual(f.read(), 'a.schema')
+
+    def test_relay_tree_closes_both_channels_on_failure(self):
+        sout, tin = MagicMock(), MagicMock()
+        sout.read.side_effect = IOError('lost')
+        target = MagicMock()
+        self.rc.client.exec_command.return_value = (MagicMock(), sout,
+                                                    MagicMock())
+        target._tar_channel.return_value = (tin, MagicMock(), MagicMock())
+        status, err = self.rc.relay_tree('/src', target, '/dst')
+        self.assertFalse(status)
+        self.assertEqual(str(err), 'lost')
+        sout.channel.close.assert_called_once()
+        tin.channel.close.assert_called_once()
+        tin.flush.assert_not_called()
+
+    def test_stat_many_is_killed_past_deadline(self):
+        cout = MagicMock()
+        cout.channel.recv_ready.return_value = False
+        cout.channel.recv_stderr_ready.return_value = False
+        cout.channel.exit_status_ready.return_value = False
+        self.rc.client.exec_command.return_value = (MagicMock(), cout,
+                                                    MagicMock())
+        self.rc.command_timeout = 0
+        with self.assertRaises(CommandTimeout):
+            self.rc.stat_many(['/opt/gluu'])
+
+        calls = self.rc.client.exec_command.call_args_list
+        self.assertIn('echo $$ > /tmp/clustermgr-', calls[0][0][0])
+        self.assertIn('kill -TERM', calls[1][0][0])
+
+    def test_tree_member_selected_applies_filters(self):
+        assert tree_member_selected('./x/a.schema', include=['*.schema'])
+        assert not tree_member_selected('x/a.ldif', include=['*.schema'])
+        assert not tree_member_selected('x/a.schema', exclude=['x/*'])
+
+    def test_run_stream_yields_output_from_command_channel(self):
+        cout = MagicMock()
+        cout.channel = FakeChannel([('stdout', 'one\n'), ('stderr', 'bad\n')],
+                                   status=3)
+        self.rc.client.exec_command.return_value = (MagicMock(), cout,
+                                                    MagicMock())
+        stream = self.rc.run_stream('ls', flush_interval=0)
+        self.assertEqual(list(stream), [('stdout', 'one\n'),
+                                        ('stderr', 'bad\n')])
+        self.assertEqual(stream.exit_status, 3)
+
+    def test_run_stream_records_the_step(self):
+        cout = MagicMock()
+        cout.channel = FakeChannel([('stdout', 'one\n')], status=3)
+        self.rc.client.exec_command.return_value = (MagicMock(), cout,
+                                                    MagicMock())
+        steps = []
+        with recording_steps(steps.append):
+            list(self.rc.run_stream('ls', flush_interval=0))
+        self.assertEqual(len(steps), 1)
+        self.assertEqual((steps[0]['host'], steps[0]['command'],
+                          steps[0]['exit_status'], steps[0]['received']),
+                         ('server', 'ls', 3, 4))
+        self.assertTrue(steps[0]['ended'] >= steps[0]['started'])
+
+    def test_run_stream_kills_process_group_past_deadline(self):
+        cout = MagicMock()
+        cout.channel.recv_ready.return_value = False
+        cout.channel.recv_stderr_ready.return_value = False
+        cout.channel.exit_status_ready.return_value = False
+        self.rc.client.exec_command.return_value = (MagicMock(), cout,
+                                                    MagicMock())
+        with self.assertRaises(CommandTimeout):
+            list(self.rc.run_stream('apt-get install -y ntp', timeout=0))
+
+        calls = self.rc.client.exec_command.call_args_list
+        self.assertIn('echo $$ > /tmp/clustermgr-', calls[0][0][0])
+        self.assertIn('kill -TERM', calls[1][0][0])
+        cout.channel.close.assert_called_once()
+        self.assertEqual(self.rc.stuck_commands(), [])
+
+    def test_task_deadline_caps_command_timeout(self):
+        self.assertIsNone(command_deadline())
+        with task_deadline(10):
+            with task_deadline(60):
+                self.assertLessEqual(command_deadline(100), time.time() + 10)
+        self.assertIsNone(command_deadline())
+
+    @patch('clustermgr.core.remote.uuid.uuid4')
+    def test_run_batch_sends_all_commands_in_one_channel(self, mockuuid):
+        mockuuid.return_value.hex = 'tok'
+        cin, cout, cerr = MagicMock(), MagicMock(), MagicMock()
+        cout.read.return_value = ("\n__BATCH_tok_BEGIN_0\nout\n\n"
+                                  "__BATCH_tok_END_0_0_2000000000\n"
+                                  "\n__BATCH_tok_BEGIN_1\n\n"
+                                  "__BATCH_tok_END_1_2_\n")
+        cerr.read.return_value = ("\n__BATCH_tok_BEGIN_0\n\n__BATCH_tok_END_0\n"
+                                  "\n__BATCH_tok_BEGIN_1\nerr\n\n"
+                                  "__BATCH_tok_END_1\n")
+        self.rc.client.exec_command.return_value = (cin, cout, cerr)
+
+        results = self.rc.run_batch(['ls', 'false'])
+
+        self.rc.client.exec_command.assert_called_once_with('/bin/bash -s')
+        script = cin.write.call_args[0][0]
+        assert 'ls' in script and 'false' in script
+        self.assertEqual(results[0]['stdout'], 'out\n')
+        self.assertEqual(results[0]['exit_status'], 0)
+        self.assertEqual(results[0]['duration'], 2.0)
+        self.assertEqual(results[1]['stderr'], 'err\n')
+        self.assertEqual(results[1]['exit_status'], 2)
+        self.assertIsNone(results[1]['duration'])
+
+    def test_parse_batch_output_skips_commands_not_started(self):
+        out = "\n__BATCH_t_BEGIN_0\n\n__BATCH_t_END_0_1_10\n"
+        results = parse_batch_output(['false', 'ls'], 't', out, '')
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['exit_status'], 1)
+
+
+class CommandStreamTestCase(unittest.TestCase):
+    def test_partial_lines_are_held_until_complete(self):
+        channel = FakeChannel([('stdout', 'ab'), ('stdout', 'c\nde'),
+                               ('stdout', 'f\n')])
+        stream = CommandStream(channel, flush_interval=0)
+        self.assertEqual(list(stream), [('stdout', 'abc\n'),
+                                        ('stdout', 'def\n')])
+        self.assertEqual(stream.stdout, 'abc\ndef\n')
+
+    def test_long_partial_line_is_flushed_at_max_buffer(self):
+        channel = FakeChannel([('stdout', 'x' * 10), ('stdout', 'y\n')])
+        stream = CommandStream(channel, max_buffer=8, flush_interval=0)
+        self.assertEqual([c for _, c in stream], ['x' * 10, 'y\n'])
+
+    def test_output_retained_is_bounded(self):
+        channel = FakeChannel([('stderr', 'a\n'), ('stderr', 'b\n'),
+                               ('stderr', 'c\n')])
+        stream = CommandStream(channel, flush_interval=0, keep=4)
+        list(stream)
+        self.assertEqual(stream.stderr, 'b\nc\n')
+
+    def test_all_output_is_retained_unless_bounded(self):
+        chunks = [('stdout', 'x' * 70000 + '\n')]
+        stream = CommandStream(FakeChannel(chunks), flush_interval=0)
+        list(stream)
+        self.assertEqual(len(stream.stdout), 70001)
+        stream = CommandStream(FakeChannel(chunks), flush_interval=0, keep=0)
+        list(stream)
+        self.assertEqual(stream.stdout, '')
+
+
+class ContainerSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        with patch("clustermgr.core.remote.SSHClient"):
+            self.rc = RemoteClient('server')
+            self.rc.startup()
+
+    def test_shell_depends_on_container_and_os(self):
+        chroot = '/opt/gluu-server-3.1.1'
+        self.assertEqual(ContainerSession(self.rc, '/').shell, '/bin/bash -s')
+        self.assertEqual(ContainerSession(self.rc, chroot).shell,
+                         'chroot /opt/gluu-server-3.1.1 /bin/bash -s')
+        self.assertIn('-o Port=60022',
+                      ContainerSession(self.rc, chroot, console=True).shell)
+        self.assertIn('-o Port=60022',
+                      ContainerSession(self.rc, '/', console=True).shell)
+
+    def test_framed_channel_splits_output_at_markers(self):
+        channel = FakeChannel([('stdout', 'one\ntwo __CS_tok_E'),
+                               ('stdout', 'ND_3\n'),
+                               ('stderr', 'bad\n__CS_tok_END\n')])
+        stream = CommandStream(FramedChannel(channel, 'tok'))
+        list(stream)
+        self.assertEqual(stream.stdout, 'one\ntwo ')
+        self.assertEqual(stream.stderr, 'bad\n')
+        self.assertEqual(stream.exit_status, 3)
+
+    @patch('clustermgr.core.remote.uuid.uuid4')
+    def test_run_sends_framed_command_to_session_shell(self, mockuuid):
+        mockuuid.return_value.hex = 'tok'
+        cin, cout = MagicMock(), MagicMock()
+        cout.channel = FakeChannel([('stdout', 'ok\n__CS_tok_END_0\n'),
+                                    ('stderr', '__CS_tok_END\n')])
+        self.rc.client.exec_command.return_value = (cin, cout, MagicMock())
+        cs = self.rc.container_session('/opt/gluu-server-3.1.1')
+
+        self.assertEqual(cs.run('service solserver start'), ('', 'ok\n', ''))
+        self.assertIs(self.rc.container_session('/opt/gluu-server-3.1.1'),
+                      cs)
+        self.assertIsNot(self.rc.container_session('/opt/gluu-server-3.1.1',
+                                                   console=True), cs)
+        self.assertIn('chroot /opt/gluu-server-3.1.1 /bin/bash -s',
+                      self.rc.client.exec_command.call_args[0][0])
+        self.assertIn("setsid /bin/bash -c 'service solserver start' "
+                      "< /dev/null &", cin.write.call_args[0][0])
+
+    @patch('clustermgr.core.remote.uuid.uuid4')
+    def test_timeout_kills_only_the_process_group_of_the_command(self,
+                                                                 mockuuid):
+        mockuuid.return_value.hex = 'tok'
+        cin, cout = MagicMock(), MagicMock()
+        cout.channel.closed = False
+        cout.channel.recv_ready.return_value = False
+        cout.channel.recv_stderr_ready.return_value = False
+        cout.channel.exit_status_ready.return_value = False
+        cout.channel.recv_exit_status.return_value = 0
+        self.rc.client.exec_command.return_value = (cin, cout, MagicMock())
+        cs = self.rc.container_session('/opt/gluu-server-3.1.1')
+
+        with self.assertRaises(CommandTimeout):
+            cs.run('setup.py -n', timeout=0)
+
+        calls = self.rc.client.exec_command.call_args_list
+        self.assertEqual(len(calls), 2)
+        kill = calls[1][0][0]
+        self.assertTrue(kill.startswith(
+            'chroot /opt/gluu-server-3.1.1 /bin/bash -c'))
+        self.assertIn('/tmp/clustermgr-tok.pid', kill)
+        self.assertIn('kill -TERM -- -$p', kill)
+        cin.close.assert_called_once()
+        self.assertFalse(cs.is_open())
+
+
+class RemoteClientPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.patcher = patch("clustermgr.core.remote.SSHClient")
+        self.mock_client = self.patcher.start()
+        self.pool = RemoteClientPool(ttl=60, watchdog_interval=0)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_get_reuses_live_session_for_same_host(self):
+        c1 = self.pool.get('server', ip='0.0.0.0')
+        c2 = self.pool.get('server', ip='0.0.0.0')
+        assert c1 is c2
+        self.mock_client.return_value.connect.assert_called_once()
+
+    def test_get_reconnects_when_transport_is_dead(self):
+        c1 = self.pool.get('server')
+        transport = c1.client.get_transport.return_value
+        transport.is_active.return_value = False
+        self.pool.get('server')
+        assert self.mock_client.return_value.connect.call_count == 2
+        c1.client.close.assert_called_once()
+
+    def test_get_raises_error_when_connection_fails(self):
+        self.mock_client.return_value.connect.side_effect = SSHException
+        with self.assertRaises(ClientNotSetupException):
+            self.pool.get('server')
+
+    @patch('clustermgr.core.remote.time.time')
+    def test_evict_idle_closes_sessions_past_ttl(self, mocktime):
+        mocktime.return_value = 1000
+        c = self.pool.get('server')
+        self.pool.release(c)
+        mocktime.return_value = 1061
+        assert self.pool.evict_idle() == 1
+        c.client.close.assert_called_once()
+
+    @patch('clustermgr.core.remote.time.time')
+    def test_evict_idle_keeps_sessions_still_borrowed(self, mocktime):
+        mocktime.return_value = 1000
+        c = self.pool.get('server')
+        self.pool.get('server')
+        self.pool.release(c)
+        mocktime.return_value = 2000
+        assert self.pool.evict_idle() == 0
+        c.client.close.assert_not_called()
+        self.pool.release(c)
+        mocktime.return_value = 3000
+        assert self.pool.evict_idle() == 1
+
+    def test_releasing_releases_what_the_function_borrowed(self):
+        @self.pool.releasing
+        def task(fail):
+            c = self.pool.get('server')
+            self.pool.get('other')
+            self.pool.release(self.pool.get('server'))
+            if fail:
+                raise ValueError()
+            return c
+
+        c = task(False)
+        self.assertEqual([e[2] for e in self.pool._sessions.values()], [0, 0])
+        with self.assertRaises(ValueError):
+            task(True)
+        self.assertEqual([e[2] for e in self.pool._sessions.values()], [0, 0])
+        self.pool.get('server')
+        self.assertEqual(self.pool._sessions[('server', None, 'root')][2], 1)
+        c.client.close.assert_not_called()
+
+    def test_reap_stuck_kills_overdue_commands_and_discards_session(self):
+        c = self.pool.get('server')
+        c._running.add(RunningCommand(c, 'sleep 1000', time.time() - 60))
+        assert self.pool.reap_stuck() == 1
+        c.client.close.assert_called_once()
+        assert self.pool.get('server') is not c
 
 
 if __name__ == '__main__':
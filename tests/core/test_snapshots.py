@@ -0,0 +1,37 @@
+import json
+import time
+import unittest
+
+from mock import patch
+
+from clustermgr.core.snapshots import ReplicationSnapshots
+
+
+class ReplicationSnapshotsTestCase(unittest.TestCase):
+    def setUp(self):
+        with patch('clustermgr.core.snapshots.redis.Redis') as mockredis:
+            self.r = mockredis.return_value
+            self.snapshots = ReplicationSnapshots(max_age=60)
+
+    def test_store_keeps_the_status_with_the_time(self):
+        snapshot = self.snapshots.store({'ldap.example.com': {'status': None}})
+        key, value = self.r.set.call_args[0]
+        assert key == 'clustermgr:mmr:status'
+        assert json.loads(value) == snapshot
+        self.r.get.return_value = value
+        assert self.snapshots.get() == snapshot
+
+    def test_old_snapshots_or_of_other_servers_are_not_fresh(self):
+        snapshot = {'taken_at': time.time() - 30,
+                    'servers': {'a.example.com': {}, 'b.example.com': {}}}
+        assert self.snapshots.is_fresh(snapshot, ['b.example.com',
+                                                  'a.example.com'])
+        assert not self.snapshots.is_fresh(snapshot, ['a.example.com'])
+        snapshot['taken_at'] -= 60
+        assert not self.snapshots.is_fresh(snapshot, ['a.example.com',
+                                                      'b.example.com'])
+        assert not self.snapshots.is_fresh(None, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,51 +3,251 @@ import json
 
 from mock import patch, MagicMock
 
-from clustermgr.weblogger import WebLogger
+from clustermgr.weblogger import WebLogger, pack_item, unpack_items
 
 
 class WebLoggerTestCase(unittest.TestCase):
     def setUp(self):
         with  patch('clustermgr.weblogger.redis.Redis') as mockredis:
             self.r = mockredis.return_value
+            self.r.register_script.side_effect = lambda script: MagicMock()
             self.wlog = WebLogger()
+        self.read = self.wlog._read_script
+        self.pipe = self.r.pipeline.return_value
+        self.pipe.execute.return_value = []
 
     def test_log_adds_messages_in_info_level_by_default(self):
         self.wlog.log('id1', 'message 1')
-        assert json.loads(self.r.rpush.call_args[0][1])['level'] == 'info'
+        assert unpack_items([self.pipe.rpush.call_args[0][1]])[0]['level'] == 'info'
 
     def test_log_adds_messages_with_supplied_level(self):
         self.wlog.log('id1', 'message', 'debug')
-        assert self.r.rpush.call_args[0][0] == 'weblogger:id1'
-        assert json.loads(self.r.rpush.call_args[0][1])['level'] == 'debug'
-        assert json.loads(self.r.rpush.call_args[0][1])['msg'] == 'message'
+        assert self.pipe.rpush.call_args[0][0] == 'weblogger:id1'
+        assert unpack_items([self.pipe.rpush.call_args[0][1]])[0]['level'] == 'debug'
+        assert unpack_items([self.pipe.rpush.call_args[0][1]])[0]['msg'] == 'message'
 
         self.wlog.log('id2', 'message 2', 'warning')
-        assert self.r.rpush.call_args[0][0] == 'weblogger:id2'
-        assert json.loads(self.r.rpush.call_args[0][1])['level'] == 'warning'
+        assert self.pipe.rpush.call_args[0][0] == 'weblogger:id2'
+        assert unpack_items([self.pipe.rpush.call_args[0][1]])[0]['level'] == 'warning'
 
         self.wlog.log('id3', 'message 3', 'danger')
-        assert self.r.rpush.call_args[0][0] == 'weblogger:id3'
-        assert json.loads(self.r.rpush.call_args[0][1])['level'] == 'danger'
+        assert self.pipe.rpush.call_args[0][0] == 'weblogger:id3'
+        assert unpack_items([self.pipe.rpush.call_args[0][1]])[0]['level'] == 'danger'
 
     def test_log_adds_extra_keyword_args_to_entry(self):
         self.wlog.log('id', 'message', 'info', name="test", run=1)
-        assert json.loads(self.r.rpush.call_args[0][1])['name'] == 'test'
-        assert json.loads(self.r.rpush.call_args[0][1])['run'] == 1
+        assert unpack_items([self.pipe.rpush.call_args[0][1]])[0]['name'] == 'test'
+        assert unpack_items([self.pipe.rpush.call_args[0][1]])[0]['run'] == 1
 
     def test_get_message_returns_empty_list_for_no_messages(self):
-        self.r.lrange.return_value = None
+        self.read.return_value = [0, []]
         assert self.wlog.get_messages('non existent id') == []
 
     def test_get_message_returns_list_of_messages(self):
         message = [json.dumps(dict(level="info", msg="test message"))]
-        self.r.lrange.return_value = message
+        self.read.return_value = [0, message]
         assert len(self.wlog.get_messages('test id')) == 1
         assert self.wlog.get_messages('test id') == [dict(level="info", msg="test message")]
 
+    def test_get_message_returns_messages_since_cursor(self):
+        self.read.return_value = [2, [json.dumps(dict(level="info", msg="3"))]]
+        assert self.wlog.get_messages('test id', since=2) == [
+            dict(level="info", msg="3")]
+        self.read.assert_called_with(
+            keys=['weblogger:test id', 'weblogger:test id:dropped'], args=[2],
+            client=None)
+
+    def test_items_are_packed_compactly(self):
+        item = pack_item({'msg': 'm', 'level': 'debug', 'server_id': 3})
+        assert item == '\x01["m",1,3]'
+        assert unpack_items([item]) == [
+            {'msg': 'm', 'level': 'debug', 'server_id': 3}]
+        item = pack_item({'msg': 'm', 'level': 'custom', 'name': 'x'})
+        assert unpack_items([item]) == [
+            {'msg': 'm', 'level': 'custom', 'name': 'x'}]
+
+    def test_get_message_reads_items_of_both_formats(self):
+        self.read.return_value = [0, [
+            json.dumps(dict(level="info", msg="old")),
+            pack_item(dict(level="error", msg="new"))]]
+        assert self.wlog.get_messages('test id') == [
+            dict(level="info", msg="old"), dict(level="error", msg="new")]
+
+    def test_poll_reads_messages_and_result_in_one_roundtrip(self):
+        pipe = self.r.pipeline.return_value
+        pipe.execute.return_value = [
+            [3, [pack_item(dict(level="info", msg="m"))]], '{"step": 2}',
+            'meta']
+        assert self.wlog.poll('id1', 3, result_key='result') == (
+            [dict(level="info", msg="m")], {'step': 2}, 'meta', 4)
+        self.read.assert_called_with(
+            keys=['weblogger:id1', 'weblogger:id1:dropped'], args=[3],
+            client=pipe)
+        pipe.get.assert_any_call('weblogger:id1:eta')
+        pipe.get.assert_called_with('result')
+        self.r.lrange.assert_not_called()
+
+    def test_poll_moves_the_cursor_past_the_dropped_messages(self):
+        pipe = self.r.pipeline.return_value
+        pipe.execute.return_value = [
+            [10, [pack_item(dict(level="info", msg="m"))]], None]
+        assert self.wlog.poll('id1', 3) == (
+            [dict(level="info", msg="m")], None, None, 11)
+
+    def test_set_eta_stores_the_estimate_and_notifies_followers(self):
+        pipe = self.r.pipeline.return_value
+        self.wlog.set_eta('id1', {'step': 1, 'steps': 3})
+        key, value, ttl = pipe.setex.call_args[0]
+        assert key == 'weblogger:id1:eta'
+        assert json.loads(value) == {'step': 1, 'steps': 3}
+        pipe.publish.assert_called_with('weblogger:id1:events', 'eta')
+
+    def test_log_notifies_followers(self):
+        self.wlog.log('id1', 'message')
+        self.pipe.publish.assert_called_with('weblogger:id1:events', 'log')
+
+    def test_follow_yields_backlog_then_new_messages_until_end(self):
+        pubsub = self.r.pubsub.return_value
+        pubsub.get_message.side_effect = [{'data': 'log'}, {'data': 'end:SUCCESS'},
+                                          None]
+        pipe = self.r.pipeline.return_value
+        pipe.execute.side_effect = [[[3, [json.dumps(dict(msg="1"))]], None],
+                                    [[4, [json.dumps(dict(msg="2"))]],
+                                     '{"step": 1}']]
+        follow = self.wlog.follow('id1', since=3)
+
+        assert next(follow) == ([dict(msg="1")], None, None, 4)
+        assert next(follow) == ([dict(msg="2")], {'step': 1}, 'SUCCESS', 5)
+        self.read.assert_called_with(
+            keys=['weblogger:id1', 'weblogger:id1:dropped'], args=[4],
+            client=pipe)
+        pubsub.subscribe.assert_called_with('weblogger:id1:events')
+
+    def test_buffered_logs_are_flushed_in_order_through_a_pipeline(self):
+        pipe = self.r.pipeline.return_value
+        with self.wlog.buffered():
+            self.wlog.log('id1', 'message 1')
+            self.wlog.log('id1', 'message 2')
+            self.pipe.rpush.assert_not_called()
+            pipe.execute.assert_not_called()
+
+        pipe.execute.assert_called_once()
+        msgs = [unpack_items([c[0][1]])[0]['msg'] for c in pipe.rpush.call_args_list]
+        assert msgs == ['message 1', 'message 2']
+        pipe.publish.assert_called_once_with('weblogger:id1:events', 'log')
+
+    def test_buffered_logs_are_flushed_when_buffer_is_full(self):
+        self.wlog.buffer_size = 2
+        pipe = self.r.pipeline.return_value
+        with self.wlog.buffered():
+            self.wlog.log('id1', 'message 1')
+            pipe.execute.assert_not_called()
+            self.wlog.log('id1', 'message 2')
+            pipe.execute.assert_called_once()
+
+    def test_log_sets_expiry_and_truncates_long_messages(self):
+        self.wlog.max_item_size = 10
+        self.wlog.log('id1', 'a' * 5 + 'b' * 20 + 'c' * 5)
+        msg = unpack_items([self.pipe.rpush.call_args[0][1]])[0]['msg']
+        assert msg.startswith('aaaaa\n... [20 characters truncated]')
+        assert msg.endswith('ccccc')
+        self.pipe.expire.assert_called_with('weblogger:id1', self.wlog.ttl)
+
+    def test_flush_drops_the_oldest_messages_past_max_items(self):
+        self.wlog.max_items = 2
+        pipe = self.r.pipeline.return_value
+        pipe.execute.return_value = [2, 3, True, 1]
+        with self.wlog.buffered():
+            self.wlog.log('id1', 'message 2')
+            self.wlog.log('id1', 'message 3')
+        self.wlog._cap_script.assert_called_once_with(
+            keys=['weblogger:id1', 'weblogger:id1:dropped'],
+            args=[2, self.wlog.ttl], client=pipe)
+
+    def test_sweep_sets_expiry_on_logs_without_one(self):
+        self.r.scan_iter.return_value = ['weblogger:id1']
+        self.r.pipeline.return_value.execute.return_value = ['list', None, 5]
+        stats = self.wlog.sweep()
+        self.r.expire.assert_called_with('weblogger:id1', self.wlog.ttl)
+        assert stats['expired'] == 1 and stats['trimmed'] == 0
+
+    def test_sweep_counts_the_messages_dropped_from_long_logs(self):
+        self.r.scan_iter.return_value = ['weblogger:id1']
+        self.r.pipeline.return_value.execute.side_effect = [
+            ['list', 60, self.wlog.max_items + 7], [7]]
+        stats = self.wlog.sweep()
+        self.r.expire.assert_not_called()
+        assert stats['trimmed'] == 1 and stats['dropped'] == 7
+
+    def test_log_stores_long_outputs_apart_with_a_preview(self):
+        self.wlog.spill_size = 100
+        self.wlog.preview_size = 10
+        output = 'a' * 10 + 'b' * 200 + 'c' * 10
+        self.wlog.log('id1', output, 'debug')
+        key, data, ttl = self.r.setex.call_args[0]
+        item = unpack_items([self.pipe.rpush.call_args[0][1]])[0]
+        assert key == 'weblogger:id1:output:' + item['output']
+        assert item['size'] == 220 and len(item['msg']) < 100
+        assert item['msg'].startswith('a' * 10)
+
+        self.r.get.return_value = data
+        assert self.wlog.get_output('id1', item['output']) == (output, 220)
+        assert self.wlog.get_output('id1', item['output'], 10, 12) == ('bb', 220)
+
+    def test_get_output_returns_none_for_expired_outputs(self):
+        self.r.get.return_value = None
+        assert self.wlog.get_output('id1', 'abc') is None
+        assert self.wlog.get_output('id1', '*') is None
+
+    def test_log_indexes_messages_by_server(self):
+        pipe = self.r.pipeline.return_value
+        pipe.execute.return_value = [1, 1, True, 1, True, 1, True, True, 1]
+        self.wlog.log('id1', 'message', 'success', server_id=3)
+        pushes = pipe.rpush.call_args_list
+        assert [c[0][0] for c in pushes] == ['weblogger:id1',
+                                             'weblogger:id1:server:3']
+        assert pushes[0][0][1] == pushes[1][0][1]
+        pipe.hincrby.assert_called_with('weblogger:id1:progress:3',
+                                        'success', 1)
+        pipe.sadd.assert_called_with('weblogger:id1:servers', 3)
+        pipe.publish.assert_called_once_with('weblogger:id1:events', 'log')
+        pipe.execute.assert_called_once()
+        self.r.rpush.assert_not_called()
+
+    def test_log_caps_the_logs_past_max_items(self):
+        self.wlog.max_items = 2
+        pipe = self.r.pipeline.return_value
+        pipe.execute.return_value = [3, 2, True, 1, True, 1, True, True, 1]
+        self.wlog.log('id1', 'message', 'success', server_id=3)
+        self.wlog._cap_script.assert_called_once_with(
+            keys=['weblogger:id1', 'weblogger:id1:dropped'],
+            args=[2, self.wlog.ttl], client=pipe)
+
+    def test_get_messages_of_a_server(self):
+        self.read.return_value = [2, [json.dumps(dict(level="info", msg="m"))]]
+        self.wlog.get_messages('id1', since=2, server_id=3)
+        self.read.assert_called_with(
+            keys=['weblogger:id1:server:3', 'weblogger:id1:server:3:dropped'],
+            args=[2], client=None)
+
+    def test_get_progress_counts_messages_by_level(self):
+        self.r.hgetall.return_value = {'success': '4', 'error': '1'}
+        assert self.wlog.get_progress('id1', 3) == {'success': 4, 'error': 1}
+        self.r.hgetall.assert_called_with('weblogger:id1:progress:3')
+
+        self.r.smembers.return_value = set(['1', '2'])
+        self.r.pipeline.return_value.execute.return_value = [
+            {'success': '2'}, {}]
+        assert self.wlog.get_progress('id1') == {'1': {'success': 2}, '2': {}}
+
     def test_clean_deletes_all_messages(self):
+        self.r.smembers.return_value = set(['3'])
         self.wlog.clean('test-id')
-        self.r.delete.assert_called_with('weblogger:test-id')
+        self.r.delete.assert_called_with(
+            'weblogger:test-id', 'weblogger:test-id:dropped',
+            'weblogger:test-id:servers', 'weblogger:test-id:eta',
+            'weblogger:test-id:server:3', 'weblogger:test-id:server:3:dropped',
+            'weblogger:test-id:progress:3')
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 import unittest
 import json
+import time
 
-from mock import patch
+from mock import patch, MagicMock
 
 from clustermgr.application import create_app
 from clustermgr.extensions import db, wlogger
@@ -76,43 +77,223 @@ class IndexViewTestCase(unittest.TestCase):
         self.assertIn('replication manager', rv.data)
         self.assertIn('nginx.example.com', rv.data)
 
+    @patch('clustermgr.views.index._result_key', lambda task_id: None)
     @patch('clustermgr.views.index.wlogger')
     @patch('clustermgr.views.index.AsyncResult')
     def test_get_log_returns_the_messages_as_json(self, mockresult, mocklogger):
         instance = mockresult.return_value
         instance.state = 'PENDING'
-        mocklogger.get_messages.return_value = [{'level': 'info', 'msg': 'Message 1'},
-                                                {'level': 'debug', 'msg': 'Message 2'}]
+        mocklogger.poll.return_value = ([{'level': 'info', 'msg': 'Message 1'},
+                                          {'level': 'debug', 'msg': 'Message 2'}], None, None, 2)
         rv = self.client.get('/log/dummy-id')
         self.assertIn("Message 1", rv.data)
         self.assertIn("Message 2", rv.data)
 
+    @patch('clustermgr.views.index._result_key', lambda task_id: None)
+    @patch('clustermgr.views.index.wlogger')
+    @patch('clustermgr.views.index.AsyncResult')
+    def test_get_log_returns_messages_since_cursor(self, mockresult, mocklogger):
+        mockresult.return_value.state = 'PENDING'
+        mocklogger.poll.return_value = ([{'level': 'info', 'msg': 'm'}], None, None, 5)
+        rv = self.client.get('/log/dummy-id?since=4')
+        mocklogger.poll.assert_called_with('dummy-id', 4, None, None)
+        self.assertEqual(json.loads(rv.data)['next'], 5)
+
+    @patch('clustermgr.views.index._result_key', lambda task_id: None)
+    @patch('clustermgr.views.index.wlogger')
+    @patch('clustermgr.views.index.AsyncResult')
+    def test_get_log_skips_the_cursor_past_dropped_messages(self, mockresult,
+                                                            mocklogger):
+        mockresult.return_value.state = 'PENDING'
+        mocklogger.poll.return_value = ([{'level': 'info', 'msg': 'm'}], None,
+                                        None, 11)
+        rv = self.client.get('/log/dummy-id?since=4')
+        self.assertEqual(json.loads(rv.data)['next'], 11)
+
+    @patch('clustermgr.views.index.wlogger')
+    @patch('clustermgr.views.index.AsyncResult')
+    def test_stream_log_resumes_from_last_event_id(self, mockresult, mocklogger):
+        mockresult.return_value.result = 7
+        mocklogger.follow.return_value = iter([
+            ([{'level': 'info', 'msg': 'm'}], None, None, 5),
+            ([], {'step': 1, 'steps': 2}, None, 5), ([], None, 'SUCCESS', 5)])
+        rv = self.client.get('/log/dummy-id/stream',
+                             headers={'Last-Event-ID': '4'})
+        mocklogger.follow.assert_called_with('dummy-id', 4, server_id=None)
+        self.assertIn('id: 5\ndata: ', rv.data)
+        self.assertIn('event: eta\nid: 5\ndata: ', rv.data)
+        self.assertIn('event: end\nid: 5\ndata: ', rv.data)
+        self.assertIn('"result": 7', rv.data)
+        mocklogger.clean.assert_called_once()
+
+    @patch('clustermgr.views.index._result_key', lambda task_id: None)
+    @patch('clustermgr.views.index.wlogger')
+    @patch('clustermgr.views.index.AsyncResult')
+    def test_get_log_of_a_server_keeps_the_task_log(self, mockresult, mocklogger):
+        mockresult.return_value.state = 'SUCCESS'
+        mocklogger.poll.return_value = ([], None, None, 0)
+        self.client.get('/log/test-id?server_id=3')
+        mocklogger.poll.assert_called_with('test-id', 0, '3', None)
+        mocklogger.clean.assert_not_called()
+
+    @patch('clustermgr.views.index.wlogger')
+    @patch('clustermgr.views.index.AsyncResult')
+    def test_get_progress_returns_the_counters_of_every_server(self, mockresult, mocklogger):
+        mockresult.return_value.state = 'STARTED'
+        mocklogger.get_progress.return_value = {'3': {'success': 2}}
+        rv = self.client.get('/log/test-id/progress')
+        self.assertEqual(json.loads(rv.data)['servers'], {'3': {'success': 2}})
+
+    @patch('clustermgr.views.index.celery')
+    @patch('clustermgr.views.index.wlogger')
+    @patch('clustermgr.views.index.AsyncResult')
+    def test_cancel_task_only_revokes_running_tasks(self, mockresult,
+                                                    mocklogger, mockcelery):
+        for state in ('SUCCESS', 'REVOKED', 'PENDING'):
+            mockresult.return_value.state = state
+            rv = self.client.post('/log/tid/cancel')
+            self.assertEqual(rv.status_code, 409)
+        mockcelery.control.revoke.assert_not_called()
+        mocklogger.log.assert_not_called()
+
+        mockresult.return_value.state = 'STARTED'
+        rv = self.client.post('/log/tid/cancel')
+        self.assertEqual(rv.status_code, 202)
+        mockcelery.control.revoke.assert_called_once_with(
+            'tid', terminate=True, signal='SIGUSR1')
+        mocklogger.log.assert_called_once_with(
+            'tid', "Task cancelled by the user", "error")
+
+    @patch('clustermgr.views.index.wlogger')
+    def test_get_output_returns_a_range_of_the_output(self, mocklogger):
+        mocklogger.get_output.return_value = ('bc', 5)
+        rv = self.client.get('/log/dummy-id/output/abc?start=1&end=3')
+        mocklogger.get_output.assert_called_with('dummy-id', 'abc', 1, 3)
+        self.assertEqual(json.loads(rv.data),
+                         {'output': 'bc', 'start': 1, 'end': 3, 'size': 5})
+
+        mocklogger.get_output.return_value = None
+        rv = self.client.get('/log/dummy-id/output/abc')
+        self.assertEqual(rv.status_code, 404)
+
+    @patch('clustermgr.views.index._result_key', lambda task_id: None)
     @patch('clustermgr.views.index.wlogger')
     @patch('clustermgr.views.index.AsyncResult')
     def test_get_log_cleans_messages_when_task_completes(self, mockresult, mocklogger):
         instance = mockresult.return_value
         instance.state = 'SUCCESS'
         instance.result = 5
-        mocklogger.get_messages.return_value = [{'level': 'info', 'msg': 'message 1'}]
+        mocklogger.poll.return_value = ([{'level': 'info', 'msg': 'message 1'}], None, None, 1)
         self.client.get('/log/test-id')
         mocklogger.clean.assert_called_once()
 
 
+    @patch('clustermgr.views.index._result_key', lambda task_id: None)
     @patch('clustermgr.views.index.wlogger')
     @patch('clustermgr.views.index.AsyncResult')
     def test_get_log_returns_the_task_result_when_task_ends(self, mockresult, mocklogger):
         instance = mockresult.return_value
         instance.state = 'PENDING'
-        mocklogger.get_messages.return_value = [{'level': 'info', 'msg': 'message 1'}]
+        mocklogger.poll.return_value = ([{'level': 'info', 'msg': 'message 1'}], None, None, 1)
         rv = self.client.get('/log/test-id')
         assert json.loads(rv.data)['result'] == 0
 
         instance.state = 'SUCCESS'
         instance.result = 'TASK RESULT'
-        mocklogger.get_messages.return_value = [{'level': 'info', 'msg': 'message 1'}]
+        mocklogger.poll.return_value = ([{'level': 'info', 'msg': 'message 1'}], None, None, 1)
         rv = self.client.get('/log/test-id')
         self.assertEqual(json.loads(rv.data)['result'], 'TASK RESULT')
 
+    @patch('clustermgr.views.index.wlogger')
+    def test_get_log_reads_the_task_state_with_the_messages(self, mocklogger):
+        meta = json.dumps({'status': 'SUCCESS', 'result': 3, 'task_id': 'id',
+                           'traceback': None, 'children': []})
+        mocklogger.poll.return_value = ([{'level': 'info', 'msg': 'm'}], None, meta, 1)
+        rv = self.client.get('/log/test-id')
+        mocklogger.poll.assert_called_with('test-id', 0, None,
+                                           'celery-task-meta-test-id')
+        log = json.loads(rv.data)
+        self.assertEqual((log['state'], log['result']), ('SUCCESS', 3))
+
+    @patch('clustermgr.views.index._result_key', lambda task_id: None)
+    @patch('clustermgr.views.index.wlogger')
+    @patch('clustermgr.views.index.AsyncResult')
+    def test_get_log_returns_the_estimate_of_the_task(self, mockresult, mocklogger):
+        mockresult.return_value.state = 'STARTED'
+        eta = {'step': 2, 'steps': 5, 'label': 'Running setup.py',
+               'percent': 30, 'remaining': 600}
+        mocklogger.poll.return_value = ([], eta, None, 0)
+        rv = self.client.get('/log/test-id')
+        self.assertEqual(json.loads(rv.data)['eta'], eta)
+
+    @patch('clustermgr.views.index.wlogger')
+    def test_get_log_is_not_modified_while_nothing_changes(self, mocklogger):
+        mocklogger.poll.return_value = ([], None, None, 2)
+        rv = self.client.get('/log/test-id?since=2')
+        self.assertEqual(json.loads(rv.data)['state'], 'PENDING')
+        rv = self.client.get('/log/test-id?since=2',
+                             headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, '')
+
+    def _add_servers(self, *hostnames):
+        with self.app.app_context():
+            for hostname in hostnames:
+                server = Server()
+                server.hostname = hostname
+                server.ip = '0.0.0.0'
+                db.session.add(server)
+            db.session.commit()
+
+    @patch('clustermgr.core.ldap_functions.mmrsnapshots')
+    @patch('clustermgr.core.ldap_functions.LdapOLC')
+    def test_mmr_marks_the_servers_which_do_not_answer_in_time(self, mockolc,
+                                                               snapshots):
+        snapshots.get.return_value = None
+        snapshots.is_fresh.return_value = False
+        snapshots.store.side_effect = lambda servers: {
+            'taken_at': time.time(), 'servers': servers}
+        self.app.config['MMR_STATUS_TIMEOUT'] = 0.2
+        self._add_servers('fast.example.com', 'slow.example.com')
+
+        def ldap(addr, binddn, passwd):
+            olc = MagicMock()
+            if 'slow' in addr:
+                olc.connect.side_effect = lambda timeout: time.sleep(2)
+            olc.getMMRStatus.return_value = {'server_id': '1',
+                                             'providers': {}}
+            return olc
+        mockolc.side_effect = ldap
+
+        started = time.time()
+        rv = self.client.get('/mmr/')
+        self.assertLess(time.time() - started, 2)
+        self.assertIn('Timed out', rv.data)
+        self.assertIn('slow.example.com did not answer', rv.data)
+        self.assertIn('Configured', rv.data)
+
+    @patch('clustermgr.core.ldap_functions.mmrsnapshots')
+    @patch('clustermgr.core.ldap_functions.LdapOLC')
+    def test_mmr_shows_the_last_snapshot_until_refreshed(self, mockolc,
+                                                        snapshots):
+        self._add_servers('ldap.example.com')
+        snapshots.is_fresh.return_value = True
+        snapshots.get.return_value = {'taken_at': time.time() - 30, 'servers': {
+            'ldap.example.com': {'status': {'server_id': '1', 'providers': {}},
+                                 'error': None, 'timed_out': False}}}
+        rv = self.client.get('/mmr/')
+        self.assertIn('Configured', rv.data)
+        self.assertIn('Status as of 30 seconds ago', rv.data)
+        mockolc.assert_not_called()
+
+        snapshots.store.side_effect = lambda servers: {
+            'taken_at': time.time(), 'servers': servers}
+        mockolc.return_value.getMMRStatus.return_value = {'server_id': None}
+        rv = self.client.post('/mmr/refresh')
+        self.assertEqual(rv.status_code, 302)
+        mockolc.return_value.connect.assert_called_once()
+        snapshots.store.assert_called_once()
+
 
 if __name__ == '__main__':
     unittest.main()